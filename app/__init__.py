@@ -4,6 +4,14 @@ from .chain import node_registry, wallet, session_manager, model_registry
 from .cost import cost_calculator
 from .ipfs import ipfs_node
 from .models import model_storage
+from .inference.pool import model_pool
+from .inference.executor import inference_executor
+from .inference.prefix_cache import prefix_cache
+from .inference.workers import worker_pool
+from .inference.admission import admission_controller
+from .inference.response_cache import response_cache
+from .inference.guided_decoding import guide_cache
+from .inference.preload import model_preloader
 from .setup import prompt_user_for_node_setup, is_node_setup_complete
 from config import get_config
 from contextlib import asynccontextmanager
@@ -15,9 +23,12 @@ async def lifespan(app: FastAPI):
     await ipfs_node.init_config(config)
     ipfs_client = ipfs_node.get_client()
     model_storage.init(config, ipfs_client)
+    # in the background, so the server answers liveness checks meanwhile
+    model_preloader.start()
 
     yield # this yield is required, it basically tells it the setup is done and it can run the app
     # any cleanup code can go here (after the yield)
+    await model_preloader.stop()
 
 async def setup_app(config):
     import logging
@@ -62,6 +73,14 @@ def create_app(config):
     cache_storage.init_config(config)
     persistent_storage.init_config(config)
     cost_calculator.init_config(config)
+    model_pool.init_config(config)
+    inference_executor.init_config(config)
+    prefix_cache.init_config(config)
+    worker_pool.init_config(config)
+    admission_controller.init_config(config)
+    response_cache.init_config(config)
+    guide_cache.init_config(config)
+    model_preloader.init_config(config)
 
     wallet.init_config(config)
     priva_api.init_config(config)
@@ -57,6 +57,22 @@ class CostCalculator:
         if currency == "ETH_WEI":
             return self.convert_to_wei(usd_cost)
         
+    def calculate_max_tokens(self, cost, model=None, currency="USD"):
+        """
+        The most tokens that cost no more than `cost`, or None if the price
+        can't be determined.
+        """
+        cost_per_1000_tokens = self.calculate_cost(1000, model, currency)
+        if not cost_per_1000_tokens:
+            return None
+        tokens = max(int(cost * 1000 / cost_per_1000_tokens), 0)
+        # calculate_cost rounds, settle on its exact boundary
+        while tokens > 0 and self.calculate_cost(tokens, model, currency) > cost:
+            tokens -= 1
+        while self.calculate_cost(tokens + 1, model, currency) <= cost:
+            tokens += 1
+        return tokens
+
     def convert_to_eth(self, usd_cost):
         eth_to_usd_rate = get_usd_to_eth_conversion_rate()
         if eth_to_usd_rate is not None:
@@ -0,0 +1,163 @@
+from collections import deque
+from typing import Optional
+import asyncio
+import logging
+import math
+import time
+
+# number of recent requests the published timings are computed over
+TIMING_WINDOW = 1000
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when the admission queue is full. `retry_after` is a hint, in
+    seconds, of when a slot is likely to be free again.
+    """
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a request's deadline passed before anything could be
+    generated for it.
+    """
+    pass
+
+
+class AdmissionTicket:
+    """
+    A request's slot in the controller. Must be released exactly once the
+    response is done; releasing it again is a no-op.
+    """
+    def __init__(self, controller: "AdmissionController"):
+        self.controller = controller
+        self.admitted_at = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.controller._release(self)
+
+
+def _percentile(values: list, percentile: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * percentile), len(values) - 1)]
+
+
+class AdmissionController:
+    """
+    Bounds how many inference requests run at once and how many may wait
+    for a slot. Requests over the queue depth are rejected straight away
+    rather than piling up and slowing everyone down.
+
+    Slots are handed out first come, first served. All methods must be
+    called from the event loop.
+    """
+    def __init__(self):
+        self.max_concurrency = None
+        self.max_queue_depth = None
+        self.max_generation_seconds = None
+
+        self.num_running = 0
+        self.num_rejected = 0
+        self._waiters = deque()
+        self._queue_waits = deque(maxlen=TIMING_WINDOW)
+        self._service_times = deque(maxlen=TIMING_WINDOW)
+
+    def init_config(self, config):
+        self.max_concurrency = config.INFERENCE_MAX_CONCURRENCY
+        self.max_queue_depth = config.INFERENCE_MAX_QUEUE_DEPTH
+        self.max_generation_seconds = config.MAX_GENERATION_SECONDS
+
+    @property
+    def num_waiting(self) -> int:
+        return len(self._waiters)
+
+    def get_deadline(self, timeout: Optional[float] = None) -> Optional[float]:
+        """
+        The time.monotonic() by which a request arriving now has to be done
+        generating: after the `timeout` the client waits for, if any, and at
+        most MAX_GENERATION_SECONDS. None if neither is set.
+        """
+        limits = [limit for limit in (timeout, self.max_generation_seconds) if limit is not None]
+        if not limits:
+            return None
+        return time.monotonic() + min(limits)
+
+    def has_capacity(self) -> bool:
+        return self.num_waiting < self.max_queue_depth
+
+    async def admit(self) -> AdmissionTicket:
+        """
+        Wait for a slot. Raises AdmissionRejected if the queue is full.
+        """
+        start = time.monotonic()
+        if self.num_running < self.max_concurrency and not self._waiters:
+            self.num_running += 1
+            self._queue_waits.append(0.0)
+            return AdmissionTicket(self)
+
+        if not self.has_capacity():
+            self.num_rejected += 1
+            raise AdmissionRejected("server is at capacity, try again later", self._estimate_retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was handed over right before the cancellation
+                self._release(None)
+            else:
+                self._waiters.remove(future)
+            raise
+
+        queue_wait = time.monotonic() - start
+        self._queue_waits.append(queue_wait)
+        logging.debug(f"Admitted request after waiting {queue_wait:.3f}s in the queue")
+        return AdmissionTicket(self)
+
+    def _release(self, ticket: Optional[AdmissionTicket]):
+        if ticket is not None:
+            self._service_times.append(time.monotonic() - ticket.admitted_at)
+        # hand the slot straight to the next waiter, if any
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.num_running -= 1
+
+    def _estimate_retry_after(self) -> int:
+        if not self._service_times:
+            return 1
+        mean_service_time = sum(self._service_times) / len(self._service_times)
+        # time for the queue ahead to drain through the running slots
+        return max(1, math.ceil(mean_service_time * (self.num_waiting + 1) / self.max_concurrency))
+
+    def get_stats(self) -> dict:
+        queue_waits = list(self._queue_waits)
+        return {
+            'running': self.num_running,
+            'waiting': self.num_waiting,
+            'max_concurrency': self.max_concurrency,
+            'max_queue_depth': self.max_queue_depth,
+            'rejected': self.num_rejected,
+            'queue_wait_seconds': {
+                'avg': sum(queue_waits) / len(queue_waits) if queue_waits else None,
+                'p50': _percentile(queue_waits, 0.5),
+                'p95': _percentile(queue_waits, 0.95),
+                'max': max(queue_waits) if queue_waits else None,
+            },
+        }
+
+# Global instance of the AdmissionController
+admission_controller = AdmissionController()
@@ -0,0 +1,79 @@
+from threading import Lock
+from typing import Callable, Optional
+
+
+class TokenBudget:
+    """
+    Tokens a session can still pay for.
+
+    The scheduler takes one for every token it generates, and a sequence
+    ends with finish_reason "length" on the token that uses the budget up.
+    Tokens sampled once nothing is left, e.g. by another sequence of the
+    same session in the same step, are dropped, so the session is never
+    billed past its cost limit.
+    """
+    def __init__(self, num_tokens: int):
+        self.num_tokens = num_tokens
+        self._lock = Lock()
+
+    @property
+    def is_exhausted(self) -> bool:
+        return self.num_tokens <= 0
+
+    def consume(self, num_tokens: int = 1) -> bool:
+        """
+        Take `num_tokens` from the budget, if there are that many left.
+        """
+        with self._lock:
+            if self.num_tokens < num_tokens:
+                return False
+            self.num_tokens -= num_tokens
+            return True
+
+    def charge(self, num_tokens: int):
+        """
+        Take tokens that were already spent elsewhere, e.g. by a worker
+        process. This can leave the budget overdrawn.
+        """
+        with self._lock:
+            self.num_tokens -= num_tokens
+
+
+class SessionBudgets:
+    """
+    The TokenBudget of every session with requests in flight.
+
+    Concurrent requests of a session share a budget, so together they can't
+    run past the session's cost limit either. A budget lives while any
+    request holds it; the next request after that starts over from the
+    session ledger, which by then has all earlier tokens billed. Must be
+    called from the event loop.
+    """
+    def __init__(self):
+        # session_id -> [budget, number of requests holding it]
+        self._budgets = {}
+
+    def acquire(self, session_id: int, get_num_tokens: Callable[[], Optional[int]]) -> Optional[TokenBudget]:
+        """
+        The session's budget, created with `get_num_tokens()` tokens if no
+        request of the session holds one. None if that is unknown.
+        """
+        entry = self._budgets.get(session_id)
+        if entry is None:
+            num_tokens = get_num_tokens()
+            if num_tokens is None:
+                return None
+            entry = self._budgets[session_id] = [TokenBudget(num_tokens), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, session_id: int, budget: Optional[TokenBudget]):
+        entry = self._budgets.get(session_id)
+        if entry is None or entry[0] is not budget:
+            return
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._budgets[session_id]
+
+# Global instance of the SessionBudgets
+session_budgets = SessionBudgets()
@@ -0,0 +1,206 @@
+from typing import List, Tuple
+from packaging.version import Version
+from transformers.cache_utils import StaticCache
+import inspect
+import logging
+import time
+import torch
+import transformers
+
+# _StaticKVCache takes over StaticCache's fields rather than calling its
+# __init__, so it only works with the versions it was written against
+SUPPORTED_TRANSFORMERS_VERSIONS = (Version("4.38"), Version("4.39"))
+
+
+def is_transformers_supported(version: str = transformers.__version__) -> bool:
+    """
+    Whether the installed transformers is one whose StaticCache the
+    compiled decoder works with. Other versions decode eagerly.
+    """
+    lowest, below = SUPPORTED_TRANSFORMERS_VERSIONS
+    return lowest <= Version(Version(version).base_version) < below
+
+
+def is_compilable(model) -> bool:
+    """
+    Whether the model can decode on a static KV cache, which takes models
+    that address the cache by `cache_position` (e.g. llama in this version
+    of transformers).
+    """
+    return "cache_position" in inspect.signature(model.forward).parameters
+
+
+def _get_cache_shape(model, max_batch_size: int, max_context: int) -> Tuple[int, int, int, int]:
+    config = model.config
+    num_heads = config.num_attention_heads
+    num_key_value_heads = getattr(config, "num_key_value_heads", None) or num_heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_heads
+    return (max_batch_size, num_key_value_heads, max_context, head_dim)
+
+
+def get_static_cache_size(model, max_batch_size: int, max_context: int) -> int:
+    """
+    Bytes taken by the static KV cache of a CompiledDecoder.
+    """
+    batch_size, num_heads, length, head_dim = _get_cache_shape(model, max_batch_size, max_context)
+    element_size = torch.empty((), dtype=model.dtype).element_size()
+    # a key and a value tensor per layer
+    return 2 * model.config.num_hidden_layers * batch_size * num_heads * length * head_dim * element_size
+
+
+class _StaticKVCache(StaticCache):
+    """
+    KV cache of every layer, preallocated for `max_batch_size` rows of
+    `max_context` tokens. The model writes the keys and values of a step at
+    `cache_position` and attends over the whole cache, the attention mask
+    hides the columns that aren't in use.
+
+    It is a StaticCache so the model uses it as is, rather than converting
+    it to a DynamicCache; unlike transformers' own, it holds all layers.
+    """
+    def __init__(self, model, max_batch_size: int, max_context: int):
+        shape = _get_cache_shape(model, max_batch_size, max_context)
+        self.max_batch_size = max_batch_size
+        self.max_cache_len = max_context
+        self.seen_tokens = 0
+        self.key_cache: List[torch.Tensor] = []
+        self.value_cache: List[torch.Tensor] = []
+        for _ in range(model.config.num_hidden_layers):
+            self.key_cache.append(torch.zeros(shape, dtype=model.dtype, device=model.device))
+            self.value_cache.append(torch.zeros(shape, dtype=model.dtype, device=model.device))
+
+    def update(self, key_states, value_states, layer_idx: int, cache_kwargs=None):
+        batch_size = key_states.shape[0]
+        cache_position = cache_kwargs.get("cache_position")
+        key_cache = self.key_cache[layer_idx][:batch_size]
+        value_cache = self.value_cache[layer_idx][:batch_size]
+        key_cache[:, :, cache_position] = key_states
+        value_cache[:, :, cache_position] = value_states
+        return key_cache, value_cache
+
+    def get_seq_length(self, layer_idx: int = 0) -> int:
+        # steps always pass their cache_position
+        return 0
+
+    def to_legacy_cache(self):
+        return self
+
+    def load(self, past_key_values: tuple):
+        """
+        Copy a legacy KV cache into the first rows and columns.
+        """
+        for layer_idx, (key, value) in enumerate(past_key_values):
+            batch_size, _, length, _ = key.shape
+            self.key_cache[layer_idx][:batch_size, :, :length].copy_(key)
+            self.value_cache[layer_idx][:batch_size, :, :length].copy_(value)
+
+    def get_past(self, batch_size: int, length: int) -> tuple:
+        """
+        The first rows and columns as a legacy KV cache, without copying.
+        """
+        return tuple(
+            (key[:batch_size, :, :length], value[:batch_size, :, :length])
+            for key, value in zip(self.key_cache, self.value_cache)
+        )
+
+
+class CompiledDecoder:
+    """
+    Runs a scheduler's decode steps through `torch.compile`, on a static KV
+    cache, instead of growing the cache of the batch by concatenation every
+    step.
+
+    Inputs always have the full context length, and the batch is padded to
+    the next power of two, so there is one compiled graph per padded batch
+    size; `warm_up` compiles all of them. The batch's `past_key_values` are
+    views into the static cache after a step, and are only copied back in
+    when the batch has changed in between, e.g. because sequences joined or
+    finished. Batches that would outgrow the cache are decoded eagerly.
+    """
+    def __init__(self, model, max_batch_size: int, max_context: int):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        max_position_embeddings = getattr(model.config, "max_position_embeddings", None)
+        if max_position_embeddings is not None:
+            # the model's causal mask doesn't go any further
+            max_context = min(max_context, max_position_embeddings)
+        self.max_context = max_context
+        self.device = model.device
+
+        self.cache = _StaticKVCache(model, max_batch_size, max_context)
+        self._forward = torch.compile(model.forward, dynamic=False)
+        # past_key_values of the batch the cache holds, as handed out by the last step
+        self._past = None
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(tensor.nelement() * tensor.element_size() for tensor in self.cache.key_cache + self.cache.value_cache)
+
+    def _get_padded_batch_size(self, batch_size: int) -> int:
+        padded = 1
+        while padded < batch_size:
+            padded *= 2
+        return min(padded, self.max_batch_size)
+
+    def _get_padded_batch_sizes(self) -> List[int]:
+        sizes = []
+        batch_size = 1
+        while not sizes or sizes[-1] < self.max_batch_size:
+            sizes.append(self._get_padded_batch_size(batch_size))
+            batch_size = sizes[-1] + 1
+        return sizes
+
+    def can_decode(self, batch) -> bool:
+        return len(batch) <= self.max_batch_size and batch.cache_length < self.max_context
+
+    def _run(self, input_ids, attention_mask, position_ids, cache_position: int) -> torch.Tensor:
+        outputs = self._forward(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self.cache,
+            cache_position=torch.tensor([cache_position], device=self.device),
+            use_cache=True,
+        )
+        return outputs.logits[:, -1, :]
+
+    @torch.inference_mode()
+    def warm_up(self):
+        """
+        Compile the graph of every padded batch size, so no request has to
+        wait for it.
+        """
+        for batch_size in self._get_padded_batch_sizes():
+            start = time.monotonic()
+            input_ids = torch.zeros((batch_size, 1), dtype=torch.long, device=self.device)
+            attention_mask = torch.zeros((batch_size, self.max_context), dtype=torch.long, device=self.device)
+            attention_mask[:, 0] = 1
+            position_ids = torch.zeros((batch_size, 1), dtype=torch.long, device=self.device)
+            self._run(input_ids, attention_mask, position_ids, 0)
+            logging.debug(f"Compiled decode step for batch size {batch_size} in {time.monotonic() - start:.1f}s")
+        self._past = None
+
+    def decode(self, batch, attention_mask: torch.Tensor, position_ids: torch.Tensor) -> torch.Tensor:
+        """
+        Run a decode step of `batch`, whose cache then lives in the static
+        cache. `attention_mask` and `position_ids` are those of the step,
+        including the new token. Returns the logits of the step.
+        """
+        batch_size = len(batch)
+        length = batch.cache_length
+        if batch.past_key_values is not self._past:
+            self.cache.load(batch.past_key_values)
+
+        # padding rows attend to nothing, and their output is dropped
+        padded_batch_size = self._get_padded_batch_size(batch_size)
+        input_ids = torch.zeros((padded_batch_size, 1), dtype=torch.long, device=self.device)
+        input_ids[:batch_size] = batch.next_input_ids
+        padded_attention_mask = torch.zeros((padded_batch_size, self.max_context), dtype=torch.long, device=self.device)
+        padded_attention_mask[:batch_size, :length + 1] = attention_mask
+        padded_position_ids = torch.zeros((padded_batch_size, 1), dtype=torch.long, device=self.device)
+        padded_position_ids[:batch_size] = position_ids
+
+        logits = self._run(input_ids, padded_attention_mask, padded_position_ids, length)
+        self._past = self.cache.get_past(batch_size, length + 1)
+        batch.past_key_values = self._past
+        return logits[:batch_size]
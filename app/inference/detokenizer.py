@@ -0,0 +1,57 @@
+from typing import List
+
+
+class IncrementalDetokenizer:
+    """
+    Turns a growing list of token ids into text, one step at a time.
+
+    Every step only decodes a short window: the ids of the last emitted
+    chunk, which give the tokenizer enough context for leading spaces, plus
+    the ids that have not been emitted yet. Text is held back while it ends
+    in an incomplete UTF-8 sequence, so multi-byte characters split across
+    tokens come out whole.
+    """
+    # prompt tokens used as context before the first generated token
+    PROMPT_CONTEXT_TOKENS = 5
+
+    def __init__(self, tokenizer, prompt_ids: List[int] = None, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+
+        self.token_ids = list(prompt_ids or [])
+        # token_ids[prefix_offset:read_offset] were already emitted and are
+        # only decoded as context, token_ids[read_offset:] are still pending
+        self.read_offset = len(self.token_ids)
+        self.prefix_offset = max(self.read_offset - self.PROMPT_CONTEXT_TOKENS, 0)
+
+    def _decode(self, token_ids: List[int]) -> str:
+        return self.tokenizer.decode(token_ids, skip_special_tokens=self.skip_special_tokens)
+
+    def _new_text(self) -> str:
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text):
+            return ""
+        return new_text[len(prefix_text):]
+
+    def add(self, token_ids: List[int]) -> str:
+        """
+        Add newly generated ids and return the text that became printable.
+        """
+        self.token_ids.extend(token_ids)
+        text = self._new_text()
+        if not text or text.endswith("\ufffd"):
+            # nothing printable yet, e.g. half of a multi-byte character
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        return text
+
+    def flush(self) -> str:
+        """
+        Return whatever text is still pending, complete or not.
+        """
+        text = self._new_text()
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        return text
@@ -0,0 +1,218 @@
+from collections import deque
+from threading import Lock, Thread
+from typing import Dict, List, Optional
+from .logprobs import MAX_LOGPROBS
+import time
+
+# engines a model can be served by, see INFERENCE_ENGINES in config.py
+ENGINES = ("transformers", "vllm", "stub")
+# finish reasons of sequences that didn't run to their end, never returned
+# as a choice's finish_reason
+FAILED_FINISH_REASONS = ("error", "cancelled")
+# weight of the latest prefill in the running estimate of prefill speed
+PREFILL_TIME_SMOOTHING = 0.2
+# shorter prefills are mostly fixed overhead, and aren't timed
+MIN_TIMED_PREFILL_TOKENS = 32
+
+
+class GenerationFailed(Exception):
+    """
+    Raised for requests whose sequences the engine couldn't finish, i.e.
+    that ended with one of FAILED_FINISH_REASONS. Nothing generated for
+    them is returned or billed.
+    """
+
+
+def get_eos_token_ids(tokenizer, generation_config=None) -> set:
+    """
+    Token ids that end a sequence: the model's own if it has a generation
+    config that sets them, else the tokenizer's.
+    """
+    eos_token_id = generation_config.eos_token_id if generation_config is not None else None
+    if eos_token_id is None:
+        eos_token_id = tokenizer.eos_token_id
+    if isinstance(eos_token_id, int):
+        eos_token_id = [eos_token_id]
+    return set(eos_token_id or [])
+
+
+def parse_logit_bias(logit_bias: dict, vocab_size: int) -> Dict[int, float]:
+    # token ids arrive as strings, as in the OpenAI API
+    parsed = {}
+    for token_id, bias in logit_bias.items():
+        try:
+            token_id = int(token_id)
+        except ValueError:
+            raise ValueError(f"logit_bias keys must be token ids, got {token_id!r}")
+        if not 0 <= token_id < vocab_size:
+            raise ValueError(f"logit_bias token id {token_id} is not in the vocabulary")
+        parsed[token_id] = bias
+    return parsed
+
+
+class Engine:
+    """
+    Generates the sequences of one loaded model. services.py only talks to
+    a model through its engine, so an engine is picked per model without
+    the rest of the node knowing which one runs it.
+
+    An engine turns a request into the parameters of its sequences
+    (`to_sequence_params`), takes sequences with `submit_all` and runs
+    their prefill and decode steps on its own loop, which runs on a thread
+    of its own while there is work, like the scheduler's. Output goes
+    through the sequence: tokens are appended with `Sequence._append`,
+    which also streams them, and `Sequence._finish` ends it. A sequence
+    that was cancelled is finished with reason "cancelled" at its next
+    token boundary, and one whose `deadline` can't be met is dropped
+    before its prefill (`Sequence._expire`) or stopped with reason
+    "length". `num_running` and `num_waiting` against `max_batch_size`
+    tell how busy the engine is.
+
+    The transformers engine is the Scheduler; other engines may not keep
+    a prefix cache or support guided decoding.
+    """
+    supports_prefix_cache = False
+    supports_guided_decoding = False
+    speculative_decoder = None
+
+    def __init__(
+        self, tokenizer, max_batch_size: int = 16, eos_token_ids: set = (),
+        max_context: Optional[int] = None
+    ):
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.eos_token_ids = set(eos_token_ids)
+        self.max_context = max_context
+        # memory taken by the model, for the model pool's budget
+        self.size_bytes = 0
+        # running estimate of how long prefills take, None until one was timed
+        self.prefill_seconds_per_token: Optional[float] = None
+
+        self._waiting = deque()
+        self._lock = Lock()
+        self._running = False
+
+    @property
+    def vocab_size(self) -> int:
+        return len(self.tokenizer)
+
+    @property
+    def num_running(self) -> int:
+        raise NotImplementedError
+
+    @property
+    def num_waiting(self) -> int:
+        return len(self._waiting)
+
+    def to_sequence_params(self, request) -> dict:
+        """
+        Keyword arguments of the Sequences of `request`, from its
+        engine-neutral `to_sampling_params`, which are also kept whole in
+        `sampling_params` for engines that take them as they are.
+        """
+        sampling_params = request.to_sampling_params()
+        temperature = sampling_params["temperature"]
+        return self._check_sequence_params({
+            "max_new_tokens": sampling_params["max_tokens"],
+            "temperature": temperature,
+            "top_p": sampling_params["top_p"],
+            "do_sample": temperature is None or temperature > 0,
+            "seed": sampling_params["seed"],
+            "presence_penalty": sampling_params["presence_penalty"],
+            "frequency_penalty": sampling_params["frequency_penalty"],
+            "logit_bias": request.logit_bias,
+            "stop": sampling_params["stop"],
+            "stop_token_ids": sampling_params["stop_token_ids"],
+            "logprobs": sampling_params["logprobs"],
+            "prompt_logprobs": sampling_params.get("prompt_logprobs"),
+            "sampling_params": sampling_params,
+        })
+
+    def _check_sequence_params(self, params: dict) -> dict:
+        if params.get("logit_bias"):
+            params["logit_bias"] = parse_logit_bias(params["logit_bias"], self.vocab_size)
+        if params.get("logprobs") is not None and not 0 <= params["logprobs"] <= MAX_LOGPROBS:
+            raise ValueError(f"the number of logprobs must be between 0 and {MAX_LOGPROBS}")
+        return params
+
+    def submit(self, sequence):
+        """
+        Queue a sequence for generation. Returns immediately; use
+        `sequence.wait()` or its streamer to get the output.
+        """
+        self.submit_all([sequence])
+        return sequence
+
+    def submit_all(self, sequences: List):
+        """
+        Queue several sequences at once, so they are admitted at the same
+        token boundary and prefilled together.
+        """
+        with self._lock:
+            self._waiting.extend(sequences)
+            if not self._running:
+                self._running = True
+                # not on the inference executor: the loop holds its thread
+                # while there is work, and tokenizing or loading must not
+                # queue behind busy models
+                Thread(target=self._run, name="engine-loop", daemon=True).start()
+
+    def _run(self):
+        """
+        The engine's loop: steps every sequence until there is no work left,
+        then clears `_running` under `_lock` and returns.
+        """
+        raise NotImplementedError
+
+    def _record_prefill_time(self, num_tokens: int, seconds: float):
+        if num_tokens < MIN_TIMED_PREFILL_TOKENS:
+            return
+        seconds_per_token = seconds / num_tokens
+        if self.prefill_seconds_per_token is None:
+            self.prefill_seconds_per_token = seconds_per_token
+        else:
+            self.prefill_seconds_per_token += PREFILL_TIME_SMOOTHING * (seconds_per_token - self.prefill_seconds_per_token)
+
+    def _cannot_finish_in_time(self, seq) -> bool:
+        """
+        Whether the rest of the prompt of `seq` can't be prefilled before its
+        deadline, going by how long prefills have taken so far.
+        """
+        if seq.deadline is None:
+            return False
+        prefill_seconds = 0.0
+        if self.prefill_seconds_per_token is not None:
+            prefill_seconds = (len(seq.input_ids) - seq.num_cached_tokens) * self.prefill_seconds_per_token
+        return time.monotonic() + prefill_seconds >= seq.deadline
+
+    def _get_finish_reason(self, seq, token_id: int) -> Optional[str]:
+        if seq.is_cancelled:
+            return "cancelled"
+        if token_id in self.eos_token_ids or token_id in seq.stop_token_ids:
+            return "stop"
+        if seq.stop_checker is not None and seq.stop_checker.is_stopped(self.tokenizer, seq.output_ids):
+            return "stop"
+        if seq.max_new_tokens is not None and len(seq.output_ids) >= seq.max_new_tokens:
+            return "length"
+        if self.max_context is not None and len(seq.input_ids) + len(seq.output_ids) >= self.max_context:
+            return "length"
+        if seq.budget is not None and seq.budget.is_exhausted:
+            return "length"
+        if seq.deadline is not None and time.monotonic() >= seq.deadline:
+            return "length"
+        return None
+
+
+def load_engine(engine_name: str, model_path: str, max_batch_size: int, **options) -> Engine:
+    """
+    Load a model on an engine other than transformers, whose loading is
+    tied to the model pool and lives in services.py. `options` are those
+    of the model in INFERENCE_ENGINES.
+    """
+    if engine_name == "stub":
+        from .stub_engine import StubEngine
+        return StubEngine.load(model_path, max_batch_size, **options)
+    if engine_name == "vllm":
+        from .vllm_engine import VLLMEngine
+        return VLLMEngine.load(model_path, max_batch_size, **options)
+    raise ValueError(f"unknown inference engine {engine_name!r}, expected one of {', '.join(ENGINES)}")
@@ -0,0 +1,35 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import asyncio
+import functools
+
+
+class InferenceExecutor:
+    """
+    Bounded thread pool that runs the short blocking inference work: model
+    loading, tokenization, guide compilation and decoding outputs. Keeps
+    that work off the asyncio event loop so the HTTP server stays
+    responsive. Engine loops, which hold a thread for as long as they have
+    work, run on threads of their own.
+    """
+    def __init__(self):
+        self.executor = None
+
+    def init_config(self, config):
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.INFERENCE_MAX_WORKERS,
+            thread_name_prefix="inference",
+        )
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        return self.executor.submit(fn, *args, **kwargs)
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Run `fn` on the executor and wait for its result without blocking
+        the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+# Global instance of the InferenceExecutor
+inference_executor = InferenceExecutor()
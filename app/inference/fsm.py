@@ -0,0 +1,368 @@
+from bisect import bisect_right
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+import re
+
+MAX_CODEPOINT = 0x10FFFF
+# bounded repetitions are unrolled, which keeps the automaton a sane size
+MAX_REPEAT = 1000
+MAX_NFA_STATES = 200000
+MAX_DFA_STATES = 20000
+
+# sorted, disjoint, inclusive ranges of code points
+Ranges = Tuple[Tuple[int, int], ...]
+
+_DIGIT: Ranges = ((ord("0"), ord("9")),)
+_WORD: Ranges = ((ord("0"), ord("9")), (ord("A"), ord("Z")), (ord("_"), ord("_")), (ord("a"), ord("z")))
+_SPACE: Ranges = ((ord("\t"), ord("\r")), (ord(" "), ord(" ")))
+_CLASS_ESCAPES = {"d": _DIGIT, "w": _WORD, "s": _SPACE}
+_CHAR_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v", "a": "\a", "0": "\0"}
+_QUANTIFIER = re.compile(r"\{(\d*)(,(\d*))?\}")
+
+
+def _normalize(ranges) -> Ranges:
+    merged = []
+    for lo, hi in sorted(ranges):
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+        else:
+            merged.append((lo, hi))
+    return tuple(merged)
+
+def _negate(ranges: Ranges) -> Ranges:
+    negated = []
+    start = 0
+    for lo, hi in ranges:
+        if lo > start:
+            negated.append((start, lo - 1))
+        start = hi + 1
+    if start <= MAX_CODEPOINT:
+        negated.append((start, MAX_CODEPOINT))
+    return tuple(negated)
+
+
+class _Parser:
+    """
+    Parses the commonly used subset of Python's regular expression syntax:
+    literals and escapes, character classes, `.`, groups, alternation and
+    greedy or lazy quantifiers. Class escapes like \\d are ASCII only.
+    Anchors are accepted at the ends of the pattern, which always has to
+    match as a whole; backreferences and lookarounds are not supported.
+
+    Nodes are tuples: ("chars", ranges), ("cat", nodes), ("alt", nodes)
+    and ("repeat", node, min, max or None).
+    """
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.pos = 0
+
+    def _error(self, message: str) -> ValueError:
+        return ValueError(f"Unsupported regex {self.pattern!r}: {message} at position {self.pos}")
+
+    def _peek(self) -> Optional[str]:
+        return self.pattern[self.pos] if self.pos < len(self.pattern) else None
+
+    def _next(self) -> str:
+        if self.pos >= len(self.pattern):
+            raise self._error("unexpected end of pattern")
+        char = self.pattern[self.pos]
+        self.pos += 1
+        return char
+
+    def parse(self) -> tuple:
+        node = self._alternation()
+        if self.pos < len(self.pattern):
+            raise self._error("unbalanced parenthesis")
+        return node
+
+    def _alternation(self) -> tuple:
+        branches = [self._concatenation()]
+        while self._peek() == "|":
+            self.pos += 1
+            branches.append(self._concatenation())
+        return branches[0] if len(branches) == 1 else ("alt", branches)
+
+    def _concatenation(self) -> tuple:
+        items = []
+        while self._peek() is not None and self._peek() not in "|)":
+            items.append(self._repeat())
+        return ("cat", items)
+
+    def _quantifier(self) -> Optional[Tuple[int, Optional[int]]]:
+        char = self._peek()
+        if char == "*":
+            self.pos += 1
+            return 0, None
+        if char == "+":
+            self.pos += 1
+            return 1, None
+        if char == "?":
+            self.pos += 1
+            return 0, 1
+        # a brace that doesn't start a quantifier is a literal, as in Python
+        match = _QUANTIFIER.match(self.pattern, self.pos) if char == "{" else None
+        if match is None:
+            return None
+        self.pos = match.end()
+        lo = int(match.group(1) or 0)
+        hi = lo if match.group(2) is None else (int(match.group(3)) if match.group(3) else None)
+        return lo, hi
+
+    def _repeat(self) -> tuple:
+        node = self._atom()
+        bounds = self._quantifier()
+        if bounds is None:
+            return node
+        if max(bounds[0], bounds[1] or 0) > MAX_REPEAT:
+            raise self._error(f"repetitions over {MAX_REPEAT}")
+        if bounds[1] is not None and bounds[1] < bounds[0]:
+            raise self._error("bad repetition bounds")
+        # lazy and possessive quantifiers match the same strings
+        if self._peek() in ("?", "+"):
+            self.pos += 1
+        if self._quantifier() is not None:
+            raise self._error("multiple repeat")
+        return ("repeat", node, bounds[0], bounds[1])
+
+    def _atom(self) -> tuple:
+        char = self._next()
+        if char == "(":
+            if self.pattern.startswith("?:", self.pos):
+                self.pos += 2
+            elif self.pattern.startswith("?P<", self.pos):
+                self.pos = self.pattern.index(">", self.pos) + 1
+            elif self._peek() == "?":
+                raise self._error("lookarounds and inline flags are not supported")
+            node = self._alternation()
+            if self._next() != ")":
+                raise self._error("missing )")
+            return node
+        if char == "[":
+            return ("chars", self._class())
+        if char == ".":
+            return ("chars", _negate(((ord("\n"), ord("\n")),)))
+        if char in "^$":
+            # the whole output has to match anyway
+            return ("cat", [])
+        if char == "\\":
+            return ("chars", self._escape(in_class=False))
+        if char in "*+?":
+            raise self._error("nothing to repeat")
+        return ("chars", ((ord(char), ord(char)),))
+
+    def _class(self) -> Ranges:
+        negate = self._peek() == "^"
+        if negate:
+            self.pos += 1
+        ranges = []
+        first = True
+        while True:
+            char = self._next()
+            if char == "]" and not first:
+                break
+            first = False
+            if char == "\\":
+                item = self._escape(in_class=True)
+            else:
+                item = ((ord(char), ord(char)),)
+            if self._peek() == "-" and self.pattern[self.pos + 1:self.pos + 2] not in ("]", "") and len(item) == 1 and item[0][0] == item[0][1]:
+                self.pos += 1
+                end = self._next()
+                end_item = self._escape(in_class=True) if end == "\\" else ((ord(end), ord(end)),)
+                if len(end_item) != 1 or end_item[0][0] != end_item[0][1] or end_item[0][0] < item[0][0]:
+                    raise self._error("bad character range")
+                item = ((item[0][0], end_item[0][0]),)
+            ranges.extend(item)
+        ranges = _normalize(ranges)
+        return _negate(ranges) if negate else ranges
+
+    def _escape(self, in_class: bool) -> Ranges:
+        char = self._next()
+        if char.lower() in _CLASS_ESCAPES:
+            ranges = _CLASS_ESCAPES[char.lower()]
+            return _negate(ranges) if char.isupper() else ranges
+        if char in _CHAR_ESCAPES:
+            code = ord(_CHAR_ESCAPES[char])
+        elif char in "xuU":
+            length = {"x": 2, "u": 4, "U": 8}[char]
+            digits = self.pattern[self.pos:self.pos + length]
+            if len(digits) != length or not all(c in "0123456789abcdefABCDEF" for c in digits):
+                raise self._error(f"bad \\{char} escape")
+            self.pos += length
+            code = int(digits, 16)
+        elif char == "b" and in_class:
+            code = ord("\b")
+        elif char.isalnum():
+            # \b, \A, backreferences and the like
+            raise self._error(f"\\{char} is not supported")
+        else:
+            code = ord(char)
+        return ((code, code),)
+
+
+class _NFA:
+    """
+    Thompson construction of a parsed pattern. Every fragment gets fresh
+    start and end states, joined by epsilon moves.
+    """
+    def __init__(self):
+        self.epsilon: List[List[int]] = []
+        self.edges: List[List[Tuple[Ranges, int]]] = []
+
+    def add_state(self) -> int:
+        if len(self.epsilon) >= MAX_NFA_STATES:
+            raise ValueError("Regex is too complex for guided decoding")
+        self.epsilon.append([])
+        self.edges.append([])
+        return len(self.epsilon) - 1
+
+    def build(self, node: tuple) -> Tuple[int, int]:
+        kind = node[0]
+        if kind == "chars":
+            start, end = self.add_state(), self.add_state()
+            if node[1]:
+                self.edges[start].append((node[1], end))
+            return start, end
+        if kind == "cat":
+            start = current = self.add_state()
+            for item in node[1]:
+                item_start, item_end = self.build(item)
+                self.epsilon[current].append(item_start)
+                current = item_end
+            return start, current
+        if kind == "alt":
+            start, end = self.add_state(), self.add_state()
+            for branch in node[1]:
+                branch_start, branch_end = self.build(branch)
+                self.epsilon[start].append(branch_start)
+                self.epsilon[branch_end].append(end)
+            return start, end
+
+        _, body, lo, hi = node
+        start = current = self.add_state()
+        for _ in range(lo):
+            body_start, body_end = self.build(body)
+            self.epsilon[current].append(body_start)
+            current = body_end
+        if hi is None:
+            body_start, body_end = self.build(body)
+            loop = self.add_state()
+            self.epsilon[current].append(loop)
+            self.epsilon[loop].append(body_start)
+            self.epsilon[body_end].append(loop)
+            return start, loop
+        for _ in range(hi - lo):
+            body_start, body_end = self.build(body)
+            end = self.add_state()
+            self.epsilon[current] += [body_start, end]
+            self.epsilon[body_end].append(end)
+            current = end
+        return start, current
+
+    def closure(self, states) -> frozenset:
+        seen = set(states)
+        stack = list(states)
+        while stack:
+            for next_state in self.epsilon[stack.pop()]:
+                if next_state not in seen:
+                    seen.add(next_state)
+                    stack.append(next_state)
+        return frozenset(seen)
+
+
+class DFA:
+    """
+    Deterministic automaton over characters. Characters are grouped into
+    atoms, intervals of code points the automaton never tells apart, and
+    `transitions[state]` maps atoms to the next state.
+    """
+    initial_state = 0
+
+    def __init__(self, boundaries: List[int], transitions: List[Dict[int, int]], accepting: Set[int]):
+        # atom i covers the code points from boundaries[i] up to boundaries[i + 1]
+        self.boundaries = boundaries
+        self.transitions = transitions
+        self.accepting = accepting
+
+    @property
+    def num_states(self) -> int:
+        return len(self.transitions)
+
+    @property
+    def num_atoms(self) -> int:
+        return len(self.boundaries)
+
+    def get_atom(self, char: str) -> int:
+        return bisect_right(self.boundaries, ord(char)) - 1
+
+    def walk(self, state: int, text: str) -> Optional[int]:
+        """
+        The state after reading `text` from `state`, or None if the
+        pattern can't match any string that continues this way.
+        """
+        for char in text:
+            state = self.transitions[state].get(self.get_atom(char))
+            if state is None:
+                return None
+        return state
+
+    def is_accepting(self, state: int) -> bool:
+        return state in self.accepting
+
+
+def compile_regex(pattern: str) -> DFA:
+    """
+    Compile `pattern` to a DFA that accepts the strings it fully matches.
+    Raises ValueError for patterns that use unsupported syntax.
+    """
+    nfa = _NFA()
+    start, end = nfa.build(_Parser(pattern).parse())
+
+    boundaries = {0}
+    for edges in nfa.edges:
+        for ranges, _ in edges:
+            for lo, hi in ranges:
+                boundaries.add(lo)
+                if hi < MAX_CODEPOINT:
+                    boundaries.add(hi + 1)
+    boundaries = sorted(boundaries)
+
+    # the atoms every edge covers, as (first, last) atom index
+    atom_edges = [
+        [
+            (bisect_right(boundaries, lo) - 1, bisect_right(boundaries, hi) - 1, target)
+            for ranges, target in edges
+            for lo, hi in ranges
+        ]
+        for edges in nfa.edges
+    ]
+
+    initial = nfa.closure([start])
+    index = {initial: 0}
+    subsets = [initial]
+    transitions: List[Dict[int, int]] = []
+    closures = {}
+    while len(transitions) < len(subsets):
+        subset = subsets[len(transitions)]
+        moves = defaultdict(set)
+        for state in subset:
+            for first, last, target in atom_edges[state]:
+                for atom in range(first, last + 1):
+                    moves[atom].add(target)
+
+        state_transitions = {}
+        for atom, targets in moves.items():
+            targets = frozenset(targets)
+            if targets not in closures:
+                closures[targets] = nfa.closure(targets)
+            next_subset = closures[targets]
+            if next_subset not in index:
+                if len(subsets) >= MAX_DFA_STATES:
+                    raise ValueError("Regex is too complex for guided decoding")
+                index[next_subset] = len(subsets)
+                subsets.append(next_subset)
+            state_transitions[atom] = index[next_subset]
+        transitions.append(state_transitions)
+
+    accepting = {i for i, subset in enumerate(subsets) if end in subset}
+    return DFA(boundaries, transitions, accepting)
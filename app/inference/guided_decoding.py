@@ -0,0 +1,219 @@
+from cachetools import LRUCache
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Union
+from .fsm import DFA, compile_regex
+from .json_schema import build_regex_from_schema
+import json
+import logging
+import re
+import time
+import torch
+
+# sentencepiece marks a leading space with this
+SPIECE_UNDERLINE = "▁"
+
+
+def _token_text(tokenizer, token: str) -> str:
+    text = tokenizer.convert_tokens_to_string([token])
+    # sentencepiece tokenizers drop the leading space of a lone token
+    if (token.startswith(SPIECE_UNDERLINE) or token == "<0x20>") and not text.startswith(" "):
+        return " " + text
+    return text
+
+
+class TokenVocabulary:
+    """
+    The text of every token of a tokenizer, as a padded [vocab, chars]
+    tensor of code points, so an FSM can be walked over the whole
+    vocabulary at once.
+
+    Special tokens, tokens that are only part of a multi-byte character and
+    tokens longer than MAX_TOKEN_CHARS are never used for guided output.
+    """
+    MAX_TOKEN_CHARS = 48
+
+    def __init__(self, tokenizer, vocab_size: int, eos_token_ids: Iterable[int]):
+        self.vocab_size = vocab_size
+        self.eos_token_ids = set(eos_token_ids)
+
+        special_ids = set(tokenizer.all_special_ids)
+        num_tokens = min(len(tokenizer), vocab_size)
+        self.token_texts: List[Optional[str]] = [None] * vocab_size
+        for token_id, token in enumerate(tokenizer.convert_ids_to_tokens(list(range(num_tokens)))):
+            if token is None or token_id in special_ids:
+                continue
+            text = _token_text(tokenizer, token)
+            if text and "�" not in text and len(text) <= self.MAX_TOKEN_CHARS:
+                self.token_texts[token_id] = text
+
+        self.token_ids = torch.tensor([i for i, text in enumerate(self.token_texts) if text is not None], dtype=torch.long)
+        max_chars = max((len(text) for text in self.token_texts if text is not None), default=0)
+        self.code_points = torch.full((len(self.token_ids), max_chars), -1, dtype=torch.int32)
+        for row, token_id in enumerate(self.token_ids.tolist()):
+            text = self.token_texts[token_id]
+            self.code_points[row, :len(text)] = torch.tensor([ord(char) for char in text], dtype=torch.int32)
+
+
+class Guide:
+    """
+    A compiled guided decoding FSM over the vocabulary of one tokenizer.
+
+    The tokens allowed in an FSM state are found by walking the automaton
+    over every token at once with tensor ops. That is done the first time a
+    state is reached and the mask is kept, so a guide only gets cheaper the
+    more it is used. Only the scheduler thread of its model uses a guide.
+    """
+    # state of a sequence that sampled a token the FSM can't follow
+    DEAD_STATE = -1
+
+    def __init__(self, dfa: DFA, vocabulary: TokenVocabulary):
+        self.dfa = dfa
+        self.vocabulary = vocabulary
+        self.initial_state = dfa.initial_state
+        self._masks: Dict[int, torch.Tensor] = {}
+        self._atoms = None
+        self._table = None
+
+    def _prepare(self):
+        # the atom of every character of every token, the padding is an
+        # extra atom that leaves the state unchanged
+        dfa = self.dfa
+        boundaries = torch.tensor(dfa.boundaries, dtype=torch.int32)
+        code_points = self.vocabulary.code_points
+        atoms = torch.searchsorted(boundaries, code_points.clamp(min=0), right=True) - 1
+        self._atoms = torch.where(code_points >= 0, atoms, dfa.num_atoms).to(torch.int32)
+
+        # dense transition table with an extra dead state that never leaves
+        dead = dfa.num_states
+        table = torch.full((dfa.num_states + 1, dfa.num_atoms + 1), dead, dtype=torch.long)
+        for state, transitions in enumerate(dfa.transitions):
+            if transitions:
+                table[state, list(transitions.keys())] = torch.tensor(list(transitions.values()))
+        table[:, dfa.num_atoms] = torch.arange(dfa.num_states + 1)
+        self._table = table
+
+    def get_allowed_mask(self, state: int) -> torch.Tensor:
+        """
+        Boolean mask over the vocabulary of the tokens that keep the output
+        on the FSM from `state`. EOS is allowed once the output is complete.
+        """
+        mask = self._masks.get(state)
+        if mask is None:
+            mask = self._compute_mask(state)
+            self._masks[state] = mask
+        return mask
+
+    def _compute_mask(self, state: int) -> torch.Tensor:
+        mask = torch.zeros(self.vocabulary.vocab_size, dtype=torch.bool)
+        if state != self.DEAD_STATE:
+            if self._table is None:
+                self._prepare()
+            dead = self.dfa.num_states
+            width = self._table.shape[1]
+            flat_table = self._table.view(-1)
+
+            rows = torch.arange(len(self.vocabulary.token_ids))
+            states = torch.full((len(rows),), state, dtype=torch.long)
+            for column in range(self._atoms.shape[1]):
+                states = flat_table[states * width + self._atoms[rows, column]]
+                alive = states != dead
+                if not alive.all():
+                    # only tokens still on the FSM are walked any further
+                    rows, states = rows[alive], states[alive]
+                if len(rows) == 0:
+                    break
+            mask[self.vocabulary.token_ids[rows]] = True
+
+        if state == self.DEAD_STATE or self.dfa.is_accepting(state) or not mask.any():
+            # a finished output, or one that can't go on, can only end
+            mask[list(self.vocabulary.eos_token_ids)] = True
+        return mask
+
+    def next_state(self, state: int, token_id: int) -> int:
+        if state == self.DEAD_STATE or token_id in self.vocabulary.eos_token_ids:
+            return state
+        text = self.vocabulary.token_texts[token_id] if token_id < self.vocabulary.vocab_size else None
+        next_state = self.dfa.walk(state, text) if text is not None else None
+        return next_state if next_state is not None else self.DEAD_STATE
+
+
+def get_guide_regex(kind: str, spec) -> str:
+    """
+    The regular expression for a guided_json, guided_regex or guided_choice
+    request parameter.
+    """
+    if kind == "json":
+        return build_regex_from_schema(spec)
+    if kind == "regex":
+        return spec
+    if kind == "choice":
+        if not spec:
+            raise ValueError("guided_choice must have at least one choice")
+        return "(" + "|".join(re.escape(choice) for choice in spec) + ")"
+    raise ValueError(f"Unknown guided decoding kind: {kind}")
+
+
+class GuideCache:
+    """
+    Compiled guides, keyed by model and schema, regex or choices, with the
+    least recently used ones evicted. Compiling a guide and reaching its
+    states for the first time is the expensive part, so a repeated schema
+    costs next to nothing. The token vocabulary of each model is kept too.
+    """
+    def __init__(self):
+        self.guides = None
+        self.vocabularies = None
+        self.num_hits = 0
+        self.num_misses = 0
+        self._lock = Lock()
+
+    def init_config(self, config):
+        self.guides = LRUCache(maxsize=config.GUIDED_DECODING_CACHE_SIZE)
+        # (model, tokenizer) -> vocabulary
+        self.vocabularies = LRUCache(maxsize=8)
+
+    def get_guide(self, model_name: str, tokenizer, vocab_size: int, eos_token_ids: Iterable[int], kind: str, spec: Union[str, dict, list]) -> Guide:
+        """
+        Get the guide for a request's guided decoding parameter, compiling
+        it if needed. Raises ValueError for schemas or regexes that can't be
+        compiled. Blocking, run it on the inference executor.
+        """
+        if kind == "json" and isinstance(spec, str):
+            spec = json.loads(spec)
+        key = (model_name, kind, json.dumps(spec, sort_keys=True))
+        with self._lock:
+            guide = self.guides.get(key)
+            if guide is not None:
+                self.num_hits += 1
+                return guide
+            self.num_misses += 1
+
+        start = time.monotonic()
+        vocabulary = self._get_vocabulary(model_name, tokenizer, vocab_size, eos_token_ids)
+        guide = Guide(compile_regex(get_guide_regex(kind, spec)), vocabulary)
+        logging.debug(f"Compiled guided_{kind} for {model_name} in {time.monotonic() - start:.2f}s ({guide.dfa.num_states} states)")
+        with self._lock:
+            self.guides[key] = guide
+        return guide
+
+    def _get_vocabulary(self, model_name: str, tokenizer, vocab_size: int, eos_token_ids: Iterable[int]) -> TokenVocabulary:
+        # keyed by the tokenizer too, a reloaded model gets a fresh vocabulary
+        key = (model_name, id(tokenizer))
+        with self._lock:
+            vocabulary = self.vocabularies.get(key)
+        if vocabulary is None:
+            vocabulary = TokenVocabulary(tokenizer, vocab_size, eos_token_ids)
+            with self._lock:
+                self.vocabularies[key] = vocabulary
+        return vocabulary
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'guides': len(self.guides) if self.guides is not None else 0,
+                'hits': self.num_hits,
+                'misses': self.num_misses,
+            }
+
+# Global instance of the GuideCache
+guide_cache = GuideCache()
@@ -0,0 +1,204 @@
+from typing import List, Union
+import json
+import re
+
+# optional whitespace between JSON tokens, kept to a single space so a
+# model can't wander off into whitespace forever
+WHITESPACE = r"[ ]?"
+STRING_CHAR = r'([^"\\\x00-\x1f]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})'
+STRING = rf'"{STRING_CHAR}*"'
+INTEGER = r"-?(0|[1-9][0-9]*)"
+NUMBER = rf"{INTEGER}(\.[0-9]+)?([eE][+-]?[0-9]+)?"
+BOOLEAN = r"(true|false)"
+NULL = r"null"
+
+FORMATS = {
+    "date": r'"[0-9]{4}-(0[1-9]|1[0-2])-(0[1-9]|[12][0-9]|3[01])"',
+    "time": r'"([01][0-9]|2[0-3]):[0-5][0-9]:[0-5][0-9](\.[0-9]+)?(Z|[+-]([01][0-9]|2[0-3]):[0-5][0-9])?"',
+    "date-time": (
+        r'"[0-9]{4}-(0[1-9]|1[0-2])-(0[1-9]|[12][0-9]|3[01])T([01][0-9]|2[0-3]):[0-5][0-9]:[0-5][0-9]'
+        r'(\.[0-9]+)?(Z|[+-]([01][0-9]|2[0-3]):[0-5][0-9])?"'
+    ),
+    "uuid": r'"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}"',
+}
+
+# free-form values, e.g. of {"type": "object"}, nest at most this deep
+MAX_FREE_FORM_DEPTH = 2
+# $refs followed within each other, deeper ones are taken to be recursive
+MAX_REF_DEPTH = 16
+
+
+def _literal(value) -> str:
+    # objects and arrays allow the same whitespace as any other document
+    separator = f"{WHITESPACE},{WHITESPACE}"
+    if isinstance(value, dict):
+        members = separator.join(
+            f"{_literal(str(key))}{WHITESPACE}:{WHITESPACE}{_literal(item)}" for key, item in value.items()
+        )
+        return rf"\{{{WHITESPACE}{members}{WHITESPACE}\}}"
+    if isinstance(value, list):
+        items = separator.join(_literal(item) for item in value)
+        return rf"\[{WHITESPACE}{items}{WHITESPACE}\]"
+    return re.escape(json.dumps(value, ensure_ascii=False))
+
+def _alternatives(patterns: List[str]) -> str:
+    return "(" + "|".join(patterns) + ")"
+
+
+class _SchemaConverter:
+    """
+    Builds a regular expression that matches JSON documents valid under a
+    schema. Covers the structural keywords: type, properties, required,
+    additionalProperties, items, minItems/maxItems, enum, const, anyOf,
+    oneOf, single-schema allOf, local $refs, string length, pattern and
+    the date, time, date-time and uuid formats. Numeric bounds are not
+    enforced. Properties are generated in the order they are declared, and
+    all of them are required when the schema doesn't list `required`.
+    """
+    def __init__(self, root: dict):
+        self.root = root
+        self.ref_depth = 0
+
+    def convert(self, schema: Union[dict, bool], depth: int = 0) -> str:
+        if schema is True or schema == {}:
+            return self._free_form_value(depth)
+        if not isinstance(schema, dict):
+            raise ValueError(f"Unsupported JSON schema: {schema!r}")
+
+        if "$ref" in schema:
+            return self._convert_ref(schema["$ref"], depth)
+        if "const" in schema:
+            return _literal(schema["const"])
+        if "enum" in schema:
+            return _alternatives([_literal(value) for value in schema["enum"]])
+        for keyword in ("anyOf", "oneOf"):
+            if keyword in schema:
+                return _alternatives([self.convert(subschema, depth) for subschema in schema[keyword]])
+        if "allOf" in schema:
+            if len(schema["allOf"]) != 1:
+                raise ValueError("Only allOf with a single schema is supported")
+            return self.convert(schema["allOf"][0], depth)
+
+        schema_type = schema.get("type")
+        if schema_type is None:
+            if "properties" in schema:
+                schema_type = "object"
+            elif "items" in schema:
+                schema_type = "array"
+            else:
+                return self._free_form_value(depth)
+        if isinstance(schema_type, list):
+            return _alternatives([self.convert(dict(schema, type=t), depth) for t in schema_type])
+
+        if schema_type == "string":
+            return self._convert_string(schema)
+        if schema_type == "integer":
+            return INTEGER
+        if schema_type == "number":
+            return NUMBER
+        if schema_type == "boolean":
+            return BOOLEAN
+        if schema_type == "null":
+            return NULL
+        if schema_type == "array":
+            return self._convert_array(schema, depth)
+        if schema_type == "object":
+            return self._convert_object(schema, depth)
+        raise ValueError(f"Unsupported JSON schema type: {schema_type!r}")
+
+    def _convert_ref(self, ref: str, depth: int) -> str:
+        if not ref.startswith("#"):
+            raise ValueError(f"Only local $refs are supported, got {ref!r}")
+        schema = self.root
+        for part in ref[1:].split("/")[1:]:
+            part = part.replace("~1", "/").replace("~0", "~")
+            if not isinstance(schema, dict) or part not in schema:
+                raise ValueError(f"Can't resolve $ref {ref!r}")
+            schema = schema[part]
+        if self.ref_depth >= MAX_REF_DEPTH:
+            raise ValueError("Recursive JSON schemas are not supported")
+        self.ref_depth += 1
+        try:
+            return self.convert(schema, depth)
+        finally:
+            self.ref_depth -= 1
+
+    def _convert_string(self, schema: dict) -> str:
+        if "pattern" in schema:
+            # the pattern has to match the whole string anyway
+            pattern = schema["pattern"]
+            if pattern.startswith("^"):
+                pattern = pattern[1:]
+            if pattern.endswith("$") and not pattern.endswith("\\$"):
+                pattern = pattern[:-1]
+            return f'"{pattern}"'
+        if schema.get("format") in FORMATS:
+            return FORMATS[schema["format"]]
+        min_length = schema.get("minLength", 0)
+        max_length = schema.get("maxLength")
+        if min_length == 0 and max_length is None:
+            return STRING
+        return f'"{STRING_CHAR}{{{min_length},{max_length if max_length is not None else ""}}}"'
+
+    def _convert_array(self, schema: dict, depth: int) -> str:
+        item = self.convert(schema.get("items", {}), depth + 1)
+        min_items = schema.get("minItems", 0)
+        max_items = schema.get("maxItems")
+        if max_items == 0:
+            return rf"\[{WHITESPACE}\]"
+
+        more = f"({WHITESPACE},{WHITESPACE}{item})"
+        max_more = max_items - 1 if max_items is not None else ""
+        items = f"{item}{more}{{{max(min_items - 1, 0)},{max_more}}}"
+        if min_items == 0:
+            items = f"({items})?"
+        return rf"\[{WHITESPACE}{items}{WHITESPACE}\]"
+
+    def _convert_object(self, schema: dict, depth: int) -> str:
+        properties = schema.get("properties")
+        if not properties:
+            additional = schema.get("additionalProperties", True)
+            if additional is False:
+                return rf"\{{{WHITESPACE}\}}"
+            value = self.convert(additional, depth + 1)
+            member = f"{STRING}{WHITESPACE}:{WHITESPACE}{value}"
+            return rf"\{{{WHITESPACE}({member}({WHITESPACE},{WHITESPACE}{member})*)?{WHITESPACE}\}}"
+
+        required = set(schema.get("required", properties.keys()))
+        members = [
+            (f"{_literal(name)}{WHITESPACE}:{WHITESPACE}{self.convert(subschema, depth + 1)}", name in required)
+            for name, subschema in properties.items()
+        ]
+        separator = f"{WHITESPACE},{WHITESPACE}"
+
+        # built from the last member backwards: `after` matches the members
+        # that follow once one has been written, `first` those that may
+        # still come first
+        after = ""
+        first = ""
+        for member, is_required in reversed(members):
+            if is_required:
+                after, first = f"{separator}{member}{after}", f"{member}{after}"
+            else:
+                after, first = f"({separator}{member})?{after}", f"({member}{after}|{first})"
+        return rf"\{{{WHITESPACE}{first}{WHITESPACE}\}}"
+
+    def _free_form_value(self, depth: int) -> str:
+        values = [STRING, NUMBER, BOOLEAN, NULL]
+        if depth < MAX_FREE_FORM_DEPTH:
+            value = self._free_form_value(depth + 1)
+            member = f"{STRING}{WHITESPACE}:{WHITESPACE}{value}"
+            separator = f"{WHITESPACE},{WHITESPACE}"
+            values.append(rf"\[{WHITESPACE}({value}({separator}{value})*)?{WHITESPACE}\]")
+            values.append(rf"\{{{WHITESPACE}({member}({separator}{member})*)?{WHITESPACE}\}}")
+        return _alternatives(values)
+
+
+def build_regex_from_schema(schema: Union[dict, str]) -> str:
+    """
+    A regular expression matching the JSON documents that are valid under
+    `schema`, given as a dict or a JSON string.
+    """
+    if isinstance(schema, str):
+        schema = json.loads(schema)
+    return _SchemaConverter(schema).convert(schema)
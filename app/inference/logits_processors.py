@@ -0,0 +1,265 @@
+from typing import Dict, List, Optional
+from transformers import LogitsProcessor
+import torch
+
+# OpenAI clamps logit biases to this range
+MAX_LOGIT_BIAS = 100.0
+
+
+class BatchLogitsProcessor(LogitsProcessor):
+    """
+    A logits processor with parameters, and possibly state, per row of the
+    scheduler's decode batch. Its rows follow the batch as sequences join
+    and leave it.
+
+    A processor with a single row applies it to every row of the scores,
+    e.g. to every proposal position of a speculative step.
+    """
+    def update(self, token_ids: torch.LongTensor):
+        """
+        Called with the token just sampled for every row.
+        """
+
+    def index_select(self, index: torch.LongTensor) -> "BatchLogitsProcessor":
+        raise NotImplementedError()
+
+    def concatenate(self, other: "BatchLogitsProcessor") -> "BatchLogitsProcessor":
+        raise NotImplementedError()
+
+
+class LogitBiasLogitsProcessor(BatchLogitsProcessor):
+    """
+    Adds each row's logit bias to the logits of the biased tokens.
+
+    Biases are kept as a [rows, biased tokens] tensor of token ids and one of
+    bias values, padded with a bias of 0, so a step is a single scatter_add.
+    """
+    def __init__(self, token_ids: torch.LongTensor, biases: torch.Tensor):
+        self.token_ids = token_ids
+        self.biases = biases
+
+    @classmethod
+    def from_logit_biases(cls, logit_biases: List[Optional[Dict[int, float]]], device=None) -> "LogitBiasLogitsProcessor":
+        # a bias of 0 is the padding, so rows only hold the tokens they change
+        logit_biases = [
+            {token_id: min(MAX_LOGIT_BIAS, max(-MAX_LOGIT_BIAS, bias)) for token_id, bias in (logit_bias or {}).items() if bias != 0}
+            for logit_bias in logit_biases
+        ]
+        width = max((len(logit_bias) for logit_bias in logit_biases), default=0)
+        token_ids = torch.zeros((len(logit_biases), width), dtype=torch.long)
+        biases = torch.zeros((len(logit_biases), width), dtype=torch.float)
+        for row, logit_bias in enumerate(logit_biases):
+            for column, (token_id, bias) in enumerate(logit_bias.items()):
+                token_ids[row, column] = token_id
+                biases[row, column] = bias
+        return cls(token_ids.to(device), biases.to(device))
+
+    def __call__(self, input_ids: Optional[torch.LongTensor], scores: torch.Tensor) -> torch.Tensor:
+        if self.token_ids.shape[1] == 0:
+            return scores
+        token_ids, biases = self.token_ids, self.biases.to(scores.dtype)
+        if token_ids.shape[0] == 1:
+            token_ids = token_ids.expand(scores.shape[0], -1)
+            biases = biases.expand(scores.shape[0], -1)
+        return scores.scatter_add(1, token_ids, biases)
+
+    def index_select(self, index: torch.LongTensor) -> "LogitBiasLogitsProcessor":
+        token_ids = self.token_ids.index_select(0, index)
+        biases = self.biases.index_select(0, index)
+        # drop the padding columns no remaining row needs
+        width = int((biases != 0).sum(dim=1).max()) if len(index) else 0
+        return LogitBiasLogitsProcessor(token_ids[:, :width], biases[:, :width])
+
+    def concatenate(self, other: "LogitBiasLogitsProcessor") -> "LogitBiasLogitsProcessor":
+        width = max(self.token_ids.shape[1], other.token_ids.shape[1])
+        return LogitBiasLogitsProcessor(
+            torch.cat([_right_pad(self.token_ids, width), _right_pad(other.token_ids, width)], dim=0),
+            torch.cat([_right_pad(self.biases, width), _right_pad(other.biases, width)], dim=0),
+        )
+
+
+class PresenceFrequencyPenaltyLogitsProcessor(BatchLogitsProcessor):
+    """
+    OpenAI's presence and frequency penalties, which lower the logit of
+    every token by `frequency_penalty` for each time it was generated and
+    by `presence_penalty` once if it was generated at all.
+
+    Generated tokens are counted in a running [rows, vocab] tensor that is
+    updated after every step. It is only allocated while a row of the batch
+    has a penalty; the counts of rows without one are never used.
+    """
+    def __init__(
+        self,
+        presence_penalties: torch.Tensor,
+        frequency_penalties: torch.Tensor,
+        vocab_size: int,
+        token_counts: Optional[torch.Tensor] = None,
+    ):
+        self.presence_penalties = presence_penalties
+        self.frequency_penalties = frequency_penalties
+        self.vocab_size = vocab_size
+        self.token_counts = token_counts
+        if self.token_counts is None and self.is_active:
+            self.token_counts = torch.zeros((len(presence_penalties), vocab_size), dtype=torch.int, device=presence_penalties.device)
+
+    @classmethod
+    def from_penalties(
+        cls,
+        presence_penalties: List[float],
+        frequency_penalties: List[float],
+        output_ids: List[List[int]],
+        vocab_size: int,
+        device=None,
+    ) -> "PresenceFrequencyPenaltyLogitsProcessor":
+        processor = cls(
+            torch.tensor(presence_penalties, dtype=torch.float, device=device),
+            torch.tensor(frequency_penalties, dtype=torch.float, device=device),
+            vocab_size,
+        )
+        if processor.token_counts is not None:
+            for row, token_ids in enumerate(output_ids):
+                if token_ids:
+                    processor.token_counts[row] += torch.bincount(
+                        torch.tensor(token_ids, device=device), minlength=vocab_size
+                    ).int()
+        return processor
+
+    @property
+    def is_active(self) -> bool:
+        return bool((self.presence_penalties != 0).any() or (self.frequency_penalties != 0).any())
+
+    def __call__(self, input_ids: Optional[torch.LongTensor], scores: torch.Tensor) -> torch.Tensor:
+        if self.token_counts is None:
+            return scores
+        counts = self.token_counts.to(scores.dtype)
+        penalties = (
+            self.frequency_penalties.to(scores.dtype).unsqueeze(1) * counts
+            + self.presence_penalties.to(scores.dtype).unsqueeze(1) * (counts > 0).to(scores.dtype)
+        )
+        return scores - penalties
+
+    def update(self, token_ids: torch.LongTensor):
+        if self.token_counts is not None:
+            self.token_counts.scatter_add_(1, token_ids.view(-1, 1), torch.ones_like(self.token_counts[:, :1]))
+
+    def index_select(self, index: torch.LongTensor) -> "PresenceFrequencyPenaltyLogitsProcessor":
+        processor = PresenceFrequencyPenaltyLogitsProcessor(
+            self.presence_penalties.index_select(0, index),
+            self.frequency_penalties.index_select(0, index),
+            self.vocab_size,
+            self.token_counts.index_select(0, index) if self.token_counts is not None else None,
+        )
+        if not processor.is_active:
+            # free the counts once the last penalized row is gone
+            processor.token_counts = None
+        return processor
+
+    def concatenate(self, other: "PresenceFrequencyPenaltyLogitsProcessor") -> "PresenceFrequencyPenaltyLogitsProcessor":
+        token_counts = None
+        if self.token_counts is not None or other.token_counts is not None:
+            token_counts = torch.cat([self._get_token_counts(), other._get_token_counts()], dim=0)
+        return PresenceFrequencyPenaltyLogitsProcessor(
+            torch.cat([self.presence_penalties, other.presence_penalties], dim=0),
+            torch.cat([self.frequency_penalties, other.frequency_penalties], dim=0),
+            self.vocab_size,
+            token_counts,
+        )
+
+    def _get_token_counts(self) -> torch.Tensor:
+        if self.token_counts is not None:
+            return self.token_counts
+        # rows without a penalty, their counts don't matter
+        return torch.zeros((len(self.presence_penalties), self.vocab_size), dtype=torch.int, device=self.presence_penalties.device)
+
+
+class GuidedDecodingLogitsProcessor(BatchLogitsProcessor):
+    """
+    Masks out every token that would take a guided row off its FSM, so the
+    output matches the row's JSON schema, regex or choices. Rows without a
+    guide are left alone.
+
+    Each guided row keeps its FSM state, which advances with the sampled
+    token. The masks come from the guide, which computes each state's once.
+    """
+    def __init__(self, guides: list, states: List[Optional[int]]):
+        self.guides = guides
+        self.states = states
+
+    @classmethod
+    def from_guides(cls, guides: list, output_ids: List[List[int]]) -> "GuidedDecodingLogitsProcessor":
+        states = []
+        for guide, token_ids in zip(guides, output_ids):
+            state = None
+            if guide is not None:
+                state = guide.initial_state
+                for token_id in token_ids:
+                    state = guide.next_state(state, token_id)
+            states.append(state)
+        return cls(guides, states)
+
+    def __call__(self, input_ids: Optional[torch.LongTensor], scores: torch.Tensor) -> torch.Tensor:
+        if not any(guide is not None for guide in self.guides):
+            return scores
+        mask = torch.ones((len(self.guides), scores.shape[-1]), dtype=torch.bool)
+        for row, (guide, state) in enumerate(zip(self.guides, self.states)):
+            if guide is not None:
+                allowed = guide.get_allowed_mask(state)
+                width = min(len(allowed), scores.shape[-1])
+                mask[row, :width] = allowed[:width]
+                mask[row, width:] = False
+        mask = mask.to(scores.device)
+        if len(self.guides) == 1:
+            mask = mask.expand(scores.shape[0], -1)
+        return scores.masked_fill(~mask, float("-inf"))
+
+    def update(self, token_ids: torch.LongTensor):
+        for row, token_id in enumerate(token_ids.view(-1).tolist()):
+            if self.guides[row] is not None:
+                self.states[row] = self.guides[row].next_state(self.states[row], token_id)
+
+    def index_select(self, index: torch.LongTensor) -> "GuidedDecodingLogitsProcessor":
+        index = index.tolist()
+        return GuidedDecodingLogitsProcessor([self.guides[i] for i in index], [self.states[i] for i in index])
+
+    def concatenate(self, other: "GuidedDecodingLogitsProcessor") -> "GuidedDecodingLogitsProcessor":
+        return GuidedDecodingLogitsProcessor(self.guides + other.guides, self.states + other.states)
+
+
+def _right_pad(tensor: torch.Tensor, width: int) -> torch.Tensor:
+    if tensor.shape[1] >= width:
+        return tensor
+    return torch.cat([tensor, tensor.new_zeros((tensor.shape[0], width - tensor.shape[1]))], dim=1)
+
+
+def create_sequence_logit_bias_processor(logit_bias: Dict[int, float]):
+    """
+    A logits processor for engines that call it per sequence and step with
+    that sequence's logits alone, e.g. vLLM's `logits_processors`. The bias
+    is a LogitBiasLogitsProcessor row, so a step is a single scatter_add.
+    """
+    processor = LogitBiasLogitsProcessor.from_logit_biases([logit_bias])
+
+    def logit_bias_processor(token_ids: List[int], logits: torch.Tensor) -> torch.Tensor:
+        nonlocal processor
+        if processor.token_ids.device != logits.device:
+            processor = LogitBiasLogitsProcessor(processor.token_ids.to(logits.device), processor.biases.to(logits.device))
+        return processor(None, logits.unsqueeze(0))[0]
+
+    return logit_bias_processor
+
+
+def create_logits_processors(sequences, vocab_size: int, device=None) -> List[BatchLogitsProcessor]:
+    """
+    Build the processors for a new batch of sequences, one row per sequence.
+    """
+    return [
+        LogitBiasLogitsProcessor.from_logit_biases([seq.logit_bias for seq in sequences], device),
+        PresenceFrequencyPenaltyLogitsProcessor.from_penalties(
+            [seq.presence_penalty for seq in sequences],
+            [seq.frequency_penalty for seq in sequences],
+            [seq.output_ids for seq in sequences],
+            vocab_size,
+            device,
+        ),
+        GuidedDecodingLogitsProcessor.from_guides([seq.guide for seq in sequences], [seq.output_ids for seq in sequences]),
+    ]
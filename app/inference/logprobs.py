@@ -0,0 +1,139 @@
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+import torch
+
+# most alternatives a request can ask for per token
+MAX_LOGPROBS = 20
+# prompt positions whose logprobs are computed at once, which bounds the
+# memory of the float copy of the prefill logits
+PROMPT_CHUNK_SIZE = 512
+
+
+@dataclass
+class TokenLogprob:
+    """
+    Log probability of a token, and the most likely tokens at its position.
+    """
+    token_id: int
+    # None for the first prompt token, which nothing predicts
+    logprob: Optional[float]
+    top_logprobs: List[Tuple[int, float]] = field(default_factory=list)
+
+
+@dataclass
+class DecodedLogprob:
+    """
+    A TokenLogprob with the text of its tokens, ready to be returned.
+    """
+    token: str
+    logprob: Optional[float]
+    top_logprobs: List[Tuple[str, float]] = field(default_factory=list)
+
+
+def get_token_logprobs(logprobs: torch.Tensor, token_ids: torch.LongTensor, num_top: List[int]) -> List[TokenLogprob]:
+    """
+    Look up the log probability of one token per row of `logprobs`, along
+    with the `num_top[row]` most likely tokens of the row. A single topk
+    covers the whole batch, and only the results are copied to the host.
+    """
+    token_logprobs = logprobs.gather(1, token_ids.unsqueeze(1)).squeeze(1).tolist()
+    max_top = max(num_top, default=0)
+    top_ids, top_logprobs = [[] for _ in num_top], [[] for _ in num_top]
+    if max_top > 0:
+        top = logprobs.topk(min(max_top, logprobs.shape[-1]), dim=-1)
+        top_ids, top_logprobs = top.indices.tolist(), top.values.tolist()
+    return [
+        TokenLogprob(token_id, logprob, list(zip(ids[:k], values[:k])))
+        for token_id, logprob, ids, values, k in zip(token_ids.tolist(), token_logprobs, top_ids, top_logprobs, num_top)
+    ]
+
+def get_prompt_logprobs(logits: torch.Tensor, input_ids: torch.LongTensor, num_top: int) -> List[TokenLogprob]:
+    """
+    Logprobs of every prompt token from the prefill logits of its row,
+    `logits[i]` being the prediction for `input_ids[i + 1]`.
+    """
+    prompt_logprobs = [TokenLogprob(int(input_ids[0]), None)]
+    for start in range(0, len(input_ids) - 1, PROMPT_CHUNK_SIZE):
+        end = min(start + PROMPT_CHUNK_SIZE, len(input_ids) - 1)
+        logprobs = logits[start:end].float().log_softmax(dim=-1)
+        prompt_logprobs += get_token_logprobs(logprobs, input_ids[start + 1:end + 1], [num_top] * (end - start))
+    return prompt_logprobs
+
+
+# tokens decoded in front of a token, as context for leading spaces
+CONTEXT_TOKENS = 2
+
+def decode_logprobs(tokenizer, token_logprobs: List[TokenLogprob], context_ids: List[int] = ()) -> List[DecodedLogprob]:
+    """
+    Decode the tokens of `token_logprobs`, which follow `context_ids`. Each
+    token is decoded as the text it adds after the tokens before it, so the
+    tokens of an output add up to its text.
+    """
+    token_ids = list(context_ids[-CONTEXT_TOKENS:]) + [entry.token_id for entry in token_logprobs]
+    offset = len(token_ids) - len(token_logprobs)
+
+    decoded = []
+    for i, entry in enumerate(token_logprobs):
+        context = token_ids[max(offset + i - CONTEXT_TOKENS, 0):offset + i]
+        prefix = tokenizer.decode(context, skip_special_tokens=True)
+
+        def piece(token_id: int) -> str:
+            return tokenizer.decode(context + [token_id], skip_special_tokens=True)[len(prefix):]
+
+        decoded.append(DecodedLogprob(
+            piece(entry.token_id),
+            entry.logprob,
+            [(piece(token_id), logprob) for token_id, logprob in entry.top_logprobs],
+        ))
+    return decoded
+
+def truncate_logprobs(logprobs: List[DecodedLogprob], length: int) -> List[DecodedLogprob]:
+    """
+    Keep the tokens that start within the first `length` characters of
+    the text, e.g. of an output cut at a stop string. EOS adds no text and
+    is dropped too.
+    """
+    offset = 0
+    for i, entry in enumerate(logprobs):
+        if offset >= length:
+            return logprobs[:i]
+        offset += len(entry.token)
+    return logprobs
+
+
+def to_completion_logprobs(logprobs: List[DecodedLogprob], text_offset: int = 0) -> dict:
+    """
+    The `logprobs` of a completion choice, in the OpenAI format.
+    """
+    text_offsets = []
+    for entry in logprobs:
+        text_offsets.append(text_offset)
+        text_offset += len(entry.token)
+    return {
+        "tokens": [entry.token for entry in logprobs],
+        "token_logprobs": [entry.logprob for entry in logprobs],
+        "top_logprobs": [
+            dict(entry.top_logprobs) if entry.logprob is not None else None
+            for entry in logprobs
+        ],
+        "text_offset": text_offsets,
+    }
+
+def to_chat_logprobs(logprobs: List[DecodedLogprob]) -> dict:
+    """
+    The `logprobs` of a chat completion choice, in the OpenAI format.
+    """
+    return {
+        "content": [
+            {
+                "token": entry.token,
+                "logprob": entry.logprob,
+                "bytes": list(entry.token.encode()),
+                "top_logprobs": [
+                    {"token": token, "logprob": logprob, "bytes": list(token.encode())}
+                    for token, logprob in entry.top_logprobs
+                ],
+            }
+            for entry in logprobs
+        ]
+    }
@@ -0,0 +1,88 @@
+from typing import Dict, Optional
+from accelerate import init_empty_weights
+from transformers import AutoConfig, AutoModelForCausalLM, GenerationConfig
+import json
+import logging
+import mmap
+import os
+import struct
+import torch
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+def _mmap_safetensors(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Map a safetensors file into memory and return its tensors as views of
+    the mapping, without copying them.
+
+    The mapping is private copy-on-write, so every process that maps the
+    same file shares its physical pages through the page cache for as long
+    as the weights are only read.
+    """
+    with open(path, "rb") as file:
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    header_size = struct.unpack("<Q", buffer[:8])[0]
+    header = json.loads(buffer[8:8 + header_size])
+    data_offset = 8 + header_size
+
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        if start == end:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        tensors[name] = torch.frombuffer(
+            buffer, dtype=dtype, count=(end - start) // dtype.itemsize, offset=data_offset + start
+        ).reshape(info["shape"])
+    return tensors
+
+def load_mmap_model(model_path: str, **config_kwargs) -> Optional[torch.nn.Module]:
+    """
+    Build a model whose weights point straight into its memory-mapped
+    safetensors files. Weights keep the dtype they were saved in.
+
+    Returns None if the model has no safetensors weights or they don't
+    cover the whole model, so the caller can fall back to from_pretrained.
+    """
+    filenames = [f for f in sorted(os.listdir(model_path)) if f.endswith(".safetensors")]
+    if not filenames:
+        return None
+
+    state_dict = {}
+    for filename in filenames:
+        state_dict.update(_mmap_safetensors(os.path.join(model_path, filename)))
+    dtypes = {tensor.dtype for tensor in state_dict.values() if tensor.is_floating_point()}
+    if len(dtypes) != 1:
+        logging.debug(f"Can't memory-map {model_path}, its weights have mixed dtypes: {dtypes}")
+        return None
+
+    config = AutoConfig.from_pretrained(model_path, **config_kwargs)
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=dtypes.pop())
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if missing:
+        logging.debug(f"Can't memory-map {model_path}, missing weights: {missing[:5]}")
+        return None
+
+    if os.path.exists(os.path.join(model_path, "generation_config.json")):
+        model.generation_config = GenerationConfig.from_pretrained(model_path)
+    model.eval()
+    return model
@@ -1,7 +1,18 @@
+from dataclasses import dataclass
 from typing import Dict, List, Optional, Union
 from pydantic import BaseModel, Field, model_validator
-
-import torch
+from .logprobs import DecodedLogprob
+
+@dataclass
+class ChoiceOutput:
+    """
+    A finished choice of a non-streamed request.
+    """
+    text: str
+    # "stop" for an EOS token or stop sequence, "length" for max_tokens
+    finish_reason: Optional[str] = None
+    # per token logprobs, for requests that asked for them
+    logprobs: Optional[List[DecodedLogprob]] = None
 
 class ChatCompletionRequest(BaseModel):
     model: str
@@ -12,6 +23,7 @@ class ChatCompletionRequest(BaseModel):
     max_tokens: Optional[int] = None
     seed: Optional[int] = None
     stop: Optional[Union[str, List[str]]] = Field(default_factory=list)
+    stop_token_ids: Optional[List[int]] = None
     stream: Optional[bool] = False
     logprobs: Optional[bool] = False
     top_logprobs: Optional[int] = None
@@ -19,6 +31,21 @@ class ChatCompletionRequest(BaseModel):
     frequency_penalty: Optional[float] = 0.0
     logit_bias: Optional[Dict[str, float]] = None
     user: Optional[str] = None
+    # constrain the output to a JSON schema, a regex or one of a list of strings
+    guided_json: Optional[Union[str, dict]] = None
+    guided_regex: Optional[str] = None
+    guided_choice: Optional[List[str]] = None
+
+    def get_guided_decoding(self):
+        """
+        The kind ("json", "regex" or "choice") and spec of the request's
+        guided decoding, or None.
+        """
+        for kind in ("json", "regex", "choice"):
+            spec = getattr(self, f"guided_{kind}")
+            if spec is not None:
+                return kind, spec
+        return None
 
     def to_generate_params(self):
         # Designed to work with transformers.AutoModel.generate()
@@ -26,51 +53,28 @@ class ChatCompletionRequest(BaseModel):
             "max_new_tokens": self.max_tokens,
             "temperature": self.temperature,
             "top_p": self.top_p,
+            "seed": self.seed,
+            "presence_penalty": self.presence_penalty,
+            "frequency_penalty": self.frequency_penalty,
+            "logit_bias": self.logit_bias,
+            "stop": [self.stop] if isinstance(self.stop, str) else self.stop,
+            "stop_token_ids": self.stop_token_ids,
+            "logprobs": (self.top_logprobs or 0) if self.logprobs else None,
         }
 
     def to_sampling_params(self):
-        if self.logprobs and not self.top_logprobs:
-            raise ValueError("Top logprobs must be set when logprobs is.")
-
-        logits_processors = None
-        if self.logit_bias:
-
-            def logit_bias_logits_processor(
-                    token_ids: List[int],
-                    logits: torch.Tensor) -> torch.Tensor:
-                for token_id, bias in self.logit_bias.items():
-                    # Clamp the bias between -100 and 100 per OpenAI API spec
-                    bias = min(100, max(-100, bias))
-                    logits[int(token_id)] += bias
-                return logits
-
-            logits_processors = [logit_bias_logits_processor]
-
-        
+        # Designed to work with vLLM, see engine.py
         return {
             "n": self.n,
             "presence_penalty": self.presence_penalty,
             "frequency_penalty": self.frequency_penalty,
-            "repetition_penalty": self.repetition_penalty,
             "temperature": self.temperature,
             "top_p": self.top_p,
-            "min_p": self.min_p,
             "seed": self.seed,
-            "stop": self.stop,
+            "stop": [self.stop] if isinstance(self.stop, str) else self.stop,
             "stop_token_ids": self.stop_token_ids,
             "max_tokens": self.max_tokens,
-            "logprobs": self.top_logprobs if self.logprobs else None,
-            "prompt_logprobs": self.top_logprobs if self.echo else None,
-            "best_of": self.best_of,
-            "top_k": self.top_k,
-            "ignore_eos": self.ignore_eos,
-            "use_beam_search": self.use_beam_search,
-            "early_stopping": self.early_stopping,
-            "skip_special_tokens": self.skip_special_tokens,
-            "spaces_between_special_tokens": self.spaces_between_special_tokens,
-            "include_stop_str_in_output": self.include_stop_str_in_output,
-            "length_penalty": self.length_penalty,
-            "logits_processors": logits_processors,
+            "logprobs": (self.top_logprobs or 0) if self.logprobs else None,
         }
 
     @model_validator(mode="before")
@@ -100,12 +104,28 @@ class CompletionRequest(BaseModel):
     logprobs: Optional[int] = None
     echo: Optional[bool] = False
     stop: Optional[Union[str, List[str]]] = Field(default_factory=list)
+    stop_token_ids: Optional[List[int]] = None
     seed: Optional[int] = None
     presence_penalty: Optional[float] = 0.0
     frequency_penalty: Optional[float] = 0.0
     best_of: Optional[int] = None
     logit_bias: Optional[Dict[str, float]] = None
     user: Optional[str] = None
+    # constrain the output to a JSON schema, a regex or one of a list of strings
+    guided_json: Optional[Union[str, dict]] = None
+    guided_regex: Optional[str] = None
+    guided_choice: Optional[List[str]] = None
+
+    def get_guided_decoding(self):
+        """
+        The kind ("json", "regex" or "choice") and spec of the request's
+        guided decoding, or None.
+        """
+        for kind in ("json", "regex", "choice"):
+            spec = getattr(self, f"guided_{kind}")
+            if spec is not None:
+                return kind, spec
+        return None
 
     def to_generate_params(self):
         # Designed to work with transformers.AutoModel.generate()
@@ -114,50 +134,31 @@ class CompletionRequest(BaseModel):
             "temperature": self.temperature,
             "do_sample": self.temperature != 1.0,
             "top_p": self.top_p,
+            "seed": self.seed,
+            "presence_penalty": self.presence_penalty,
+            "frequency_penalty": self.frequency_penalty,
+            "logit_bias": self.logit_bias,
+            "stop": [self.stop] if isinstance(self.stop, str) else self.stop,
+            "stop_token_ids": self.stop_token_ids,
+            "logprobs": self.logprobs,
+            "prompt_logprobs": self.logprobs if self.echo else None,
         }
 
     def to_sampling_params(self):
-        # Designed to work with vLLM
-        echo_without_generation = self.echo and self.max_tokens == 0
-
-        logits_processors = None
-        if self.logit_bias:
-
-            def logit_bias_logits_processor(
-                    token_ids: List[int],
-                    logits: torch.Tensor) -> torch.Tensor:
-                for token_id, bias in self.logit_bias.items():
-                    # Clamp the bias between -100 and 100 per OpenAI API spec
-                    bias = min(100, max(-100, bias))
-                    logits[int(token_id)] += bias
-                return logits
-
-            logits_processors = [logit_bias_logits_processor]
-
+        # Designed to work with vLLM, see engine.py
         return {
             "n": self.n,
             "best_of": self.best_of,
             "presence_penalty": self.presence_penalty,
             "frequency_penalty": self.frequency_penalty,
-            "repetition_penalty": self.repetition_penalty,
             "temperature": self.temperature,
             "top_p": self.top_p,
-            "top_k": self.top_k,
-            "min_p": self.min_p,
             "seed": self.seed,
-            "stop": self.stop,
+            "stop": [self.stop] if isinstance(self.stop, str) else self.stop,
             "stop_token_ids": self.stop_token_ids,
-            "ignore_eos": self.ignore_eos,
-            "max_tokens": self.max_tokens if not echo_without_generation else 1,
+            "max_tokens": self.max_tokens,
             "logprobs": self.logprobs,
-            "use_beam_search": self.use_beam_search,
-            "early_stopping": self.early_stopping,
             "prompt_logprobs": self.logprobs if self.echo else None,
-            "skip_special_tokens": self.skip_special_tokens,
-            "spaces_between_special_tokens": (self.spaces_between_special_tokens),
-            "include_stop_str_in_output": self.include_stop_str_in_output,
-            "length_penalty": self.length_penalty,
-            "logits_processors": logits_processors,
         }
 
     @model_validator(mode="before")
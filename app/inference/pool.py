@@ -0,0 +1,279 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import List, Optional
+import gc
+import json
+import logging
+import math
+import os
+import struct
+import time
+import torch
+from .mmap_weights import SAFETENSORS_DTYPES
+from .prefix_cache import prefix_cache
+
+WEIGHT_FILE_EXTENSIONS = (".safetensors", ".bin", ".pt")
+
+def _read_safetensors_header(path: str) -> dict:
+    with open(path, "rb") as file:
+        header_size = struct.unpack("<Q", file.read(8))[0]
+        header = json.loads(file.read(header_size))
+    header.pop("__metadata__", None)
+    return header
+
+def _get_stored_dtype(model_path: str) -> torch.dtype:
+    # the dtype pickled weights were saved in, as the model's config records it
+    try:
+        with open(os.path.join(model_path, "config.json"), "r") as file:
+            dtype = getattr(torch, json.load(file).get("torch_dtype") or "", None)
+    except (OSError, ValueError):
+        dtype = None
+    return dtype if isinstance(dtype, torch.dtype) else torch.float32
+
+def estimate_model_dir_size(model_path: str, dtype: Optional[torch.dtype] = None) -> int:
+    """
+    Estimate how much memory a model will take once loaded with its
+    floating point weights in `dtype`, or in the dtype they are stored in
+    if None. Checkpoints are often stored in half precision and loaded in
+    float32, so their size on disk isn't enough.
+    """
+    filenames = os.listdir(model_path)
+    # from_pretrained only loads one format, preferring safetensors
+    safetensors = [filename for filename in filenames if filename.endswith(".safetensors")]
+    if safetensors:
+        size = 0
+        for filename in safetensors:
+            for info in _read_safetensors_header(os.path.join(model_path, filename)).values():
+                stored_dtype = SAFETENSORS_DTYPES[info["dtype"]]
+                loaded_dtype = dtype if dtype is not None and stored_dtype.is_floating_point else stored_dtype
+                size += math.prod(info["shape"]) * loaded_dtype.itemsize
+        return size
+    for extension in WEIGHT_FILE_EXTENSIONS:
+        size = sum(
+            os.path.getsize(os.path.join(model_path, filename))
+            for filename in filenames if filename.endswith(extension)
+        )
+        if size:
+            if dtype is None:
+                return size
+            # pickled weights have no header to count parameters from
+            return size // _get_stored_dtype(model_path).itemsize * dtype.itemsize
+    return 0
+
+def get_model_memory_size(model) -> int:
+    """
+    Number of bytes taken by the parameters and buffers of a loaded model.
+    """
+    size = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        size += tensor.nelement() * tensor.element_size()
+    # dynamically quantized layers keep their weights packed, outside of parameters()
+    for module in model.modules():
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            for tensor in (module.weight(), module.bias()):
+                if tensor is not None:
+                    size += tensor.nelement() * tensor.element_size()
+    return size
+
+def _detect_memory_budget() -> int:
+    # leave some headroom for activations and the KV cache
+    if torch.cuda.is_available():
+        return int(torch.cuda.get_device_properties(0).total_memory * 0.8)
+    return int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * 0.8)
+
+class LoadedModel:
+    def __init__(self, name: str, model, tokenizer, engine, size_bytes: int, draft: "LoadedModel" = None):
+        self.name = name
+        # the transformers model, None on other engines
+        self.model = model
+        self.tokenizer = tokenizer
+        self.engine = engine
+        self.size_bytes = size_bytes
+        # draft model used for speculative decoding, referenced for as long
+        # as this model is resident
+        self.draft = draft
+        self.ref_count = 0
+        self.last_used = time.monotonic()
+
+class ModelNotLoaded(Exception):
+    pass
+
+class ModelPool:
+    """
+    Keeps as many models resident as the memory budget allows.
+
+    Models are evicted least-recently-used first. Every in-flight request
+    holds a reference on the model it runs on, and a model is never evicted
+    while it has references.
+
+    A model that has to make room for a new one is evicted before the new
+    one loads, so the two never take more than the budget together: it
+    takes no more requests and is unloaded straight away if it is idle, or
+    else when its last request finishes. Until then it still counts toward
+    the memory budget.
+    """
+    def __init__(self):
+        self.memory_budget_bytes = None
+        self.max_batch_size = None
+        self.max_best_of = None
+        self.prefill_chunk_size = None
+        self.speculative_decoding = {}
+        self.compiled_models = {}
+        self.load_precision = {}
+        self.mmap_weights = False
+        self.engines = {}
+
+        self._models: "OrderedDict[str, LoadedModel]" = OrderedDict()
+        # models replaced by a newer one, unloaded once their requests finish
+        self._draining: List[LoadedModel] = []
+        self._lock = Lock()
+
+    def init_config(self, config):
+        self.memory_budget_bytes = config.MODEL_MEMORY_BUDGET_BYTES
+        if self.memory_budget_bytes is None:
+            self.memory_budget_bytes = _detect_memory_budget()
+        self.max_batch_size = config.INFERENCE_MAX_BATCH_SIZE
+        self.max_best_of = min(config.INFERENCE_MAX_BEST_OF, self.max_batch_size)
+        self.prefill_chunk_size = config.INFERENCE_PREFILL_CHUNK_SIZE
+        self.speculative_decoding = config.SPECULATIVE_DECODING or {}
+        self.compiled_models = config.COMPILED_MODELS or {}
+        self.load_precision = config.MODEL_LOAD_PRECISION or {}
+        self.mmap_weights = config.MMAP_MODEL_WEIGHTS
+        self.engines = config.INFERENCE_ENGINES or {}
+
+    def is_loaded(self, model_name: str) -> bool:
+        return model_name in self._models
+
+    def get_loaded_models(self) -> List[str]:
+        return list(self._models.keys())
+
+    def get_used_memory(self, excluding: List[str] = ()) -> int:
+        resident = sum(loaded.size_bytes for name, loaded in self._models.items() if name not in excluding)
+        return resident + sum(loaded.size_bytes for loaded in self._draining if loaded.name not in excluding)
+
+    def get_load_precision(self, model_name: str) -> str:
+        return self.load_precision.get(model_name, self.load_precision.get('default', 'auto'))
+
+    def get_engine_config(self, model_name: str) -> dict:
+        """
+        The engine a model is served by, under 'engine', and its options.
+        """
+        engine_config = dict(self.engines.get(model_name, self.engines.get('default', {})))
+        engine_config.setdefault('engine', 'transformers')
+        return engine_config
+
+    def get_speculative_decoding_stats(self) -> dict:
+        """
+        Draft/accept counts of every resident model that decodes speculatively.
+        """
+        with self._lock:
+            return {
+                name: loaded.engine.speculative_decoder.get_stats()
+                for name, loaded in self._models.items()
+                if loaded.engine.speculative_decoder is not None
+            }
+
+    def make_room(self, required_bytes: int, replaced: List[str] = (), keep: List[str] = ()) -> List[str]:
+        """
+        Pick the models to replace, least recently used first, until
+        `required_bytes` fit in the memory budget, and evict them. They are
+        returned, on top of those already `replaced`, to be passed to `add`.
+        Models in `keep` and draft models of other resident models stay.
+        """
+        with self._lock:
+            replaced = list(replaced)
+            for name in list(self._models.keys()):
+                if self.get_used_memory(replaced) + required_bytes <= self.memory_budget_bytes:
+                    break
+                if name in replaced or name in keep or self._is_draft_in_use(name, replaced):
+                    continue
+                replaced.append(name)
+
+            if self.get_used_memory(replaced) + required_bytes > self.memory_budget_bytes:
+                logging.warning(f"Model needs {required_bytes} bytes, more than the memory budget of {self.memory_budget_bytes} bytes allows. Loading it anyway.")
+            # before the load, the replaced models and the new one don't fit side by side
+            for name in replaced:
+                if name in self._models:
+                    self._evict(name)
+            return replaced
+
+    def _is_draft_in_use(self, model_name: str, replaced: List[str]) -> bool:
+        return any(
+            loaded.draft is not None and loaded.draft.name == model_name
+            for name, loaded in self._models.items() if name not in replaced
+        )
+
+    def add(self, loaded: LoadedModel, replaced: List[str] = ()):
+        """
+        Make `loaded` available to new requests, in place of the `replaced`
+        models returned by `make_room`.
+        """
+        with self._lock:
+            self._models[loaded.name] = loaded
+            for name in replaced:
+                if name == loaded.name or name not in self._models:
+                    continue
+                logging.debug(f"Model pool: {name} replaced by {loaded.name}")
+                self._evict(name)
+            logging.debug(f"Model pool: {loaded.name} added ({loaded.size_bytes} bytes, {self.get_used_memory()}/{self.memory_budget_bytes} bytes used)")
+
+    def acquire(self, model_name: str) -> LoadedModel:
+        """
+        Take a reference on a resident model. Must be paired with `release`.
+        """
+        with self._lock:
+            loaded = self._models.get(model_name)
+            if loaded is None:
+                raise ModelNotLoaded(f"Model {model_name} is not loaded")
+            loaded.ref_count += 1
+            loaded.last_used = time.monotonic()
+            self._models.move_to_end(model_name)
+            return loaded
+
+    def retain(self, loaded: LoadedModel):
+        """
+        Take an extra reference on a model the caller already holds.
+        """
+        with self._lock:
+            loaded.ref_count += 1
+
+    def release(self, loaded: LoadedModel):
+        with self._lock:
+            loaded.ref_count -= 1
+            loaded.last_used = time.monotonic()
+            self._unload_if_drained(loaded)
+
+    def _evict(self, model_name: str):
+        # no new requests, unloaded once the running ones finish
+        old = self._models.pop(model_name)
+        logging.debug(f"Model pool: unloading {model_name} once its {old.ref_count} requests finish")
+        self._draining.append(old)
+        self._unload_if_drained(old)
+
+    def _unload_if_drained(self, loaded: LoadedModel):
+        if loaded.ref_count > 0 or not any(loaded is draining for draining in self._draining):
+            return
+        self._draining = [draining for draining in self._draining if draining is not loaded]
+        self._unload(loaded)
+
+    def _unload(self, loaded: LoadedModel):
+        logging.debug(f"Model pool: evicting {loaded.name} ({loaded.size_bytes} bytes)")
+        loaded.model = None
+        loaded.tokenizer = None
+        loaded.engine = None
+        draft = loaded.draft
+        loaded.draft = None
+        if loaded.name not in self._models:
+            # a newer copy of the model may be resident already, and own its prefix cache
+            prefix_cache.clear_model(loaded.name)
+        del loaded
+        if draft is not None:
+            # the lock is already held, so release the draft model directly
+            draft.ref_count -= 1
+            self._unload_if_drained(draft)
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+# Global instance of the ModelPool
+model_pool = ModelPool()
@@ -0,0 +1,139 @@
+from cachetools import LRUCache
+from threading import Lock
+from typing import List, Optional, Tuple
+import hashlib
+import logging
+
+
+def _hash_tokens(token_ids: List[int]) -> str:
+    return hashlib.sha256(",".join(map(str, token_ids)).encode()).hexdigest()
+
+
+def _past_size(past_key_values) -> int:
+    return sum(
+        k.nelement() * k.element_size() + v.nelement() * v.element_size()
+        for k, v in past_key_values
+    )
+
+
+class PrefixCacheEntry:
+    def __init__(self, token_ids: List[int], past_key_values):
+        self.token_ids = token_ids
+        self.past_key_values = past_key_values
+        self.size_bytes = _past_size(past_key_values)
+
+
+class _EvictingLRUCache(LRUCache):
+    """
+    LRUCache that calls `on_evict(key)` for every entry it evicts to make
+    room, so indexes of its keys can follow.
+    """
+    def __init__(self, maxsize, getsizeof, on_evict):
+        super().__init__(maxsize, getsizeof=getsizeof)
+        self.on_evict = on_evict
+
+    def popitem(self):
+        key, entry = super().popitem()
+        self.on_evict(key)
+        return key, entry
+
+
+class PrefixCache:
+    """
+    Holds the KV cache of the last chat turn of each session, so a follow-up
+    turn that extends the same conversation only has to prefill its new
+    tokens.
+
+    Entries are keyed by (model, session_id, token-prefix hash) and evicted
+    least-recently-used once the cached tensors exceed the byte budget.
+    """
+    def __init__(self):
+        self.cache = None
+        # (model, session_id) -> key of that session's latest entry
+        self._session_keys = {}
+        self._lock = Lock()
+
+    def init_config(self, config):
+        self.cache = None
+        if config.PREFIX_CACHE_MAX_BYTES:
+            self.cache = _EvictingLRUCache(
+                maxsize=config.PREFIX_CACHE_MAX_BYTES,
+                getsizeof=lambda entry: entry.size_bytes,
+                on_evict=self._on_evict,
+            )
+
+    def _on_evict(self, key: tuple):
+        # called by the cache, with the lock already held
+        model_name, session_id, _ = key
+        if self._session_keys.get((model_name, session_id)) == key:
+            del self._session_keys[(model_name, session_id)]
+
+    def get(self, model_name: str, session_id, token_ids: List[int]) -> Tuple[int, Optional[tuple]]:
+        """
+        Find the cached KV for the longest prefix of `token_ids` seen in this
+        session. Returns the number of cached tokens and their
+        past_key_values, or (0, None) on a miss.
+        """
+        if self.cache is None or session_id is None:
+            return 0, None
+
+        with self._lock:
+            key = self._session_keys.get((model_name, session_id))
+            entry = self.cache.get(key) if key is not None else None
+            if entry is None:
+                # the entry may have been evicted to make room for others
+                self._session_keys.pop((model_name, session_id), None)
+                return 0, None
+
+        # chat templates don't always re-render the previous answer with the
+        # exact tokens that were generated, so match the longest common prefix
+        prefix_length = 0
+        for cached_id, token_id in zip(entry.token_ids, token_ids):
+            if cached_id != token_id:
+                break
+            prefix_length += 1
+        # at least one token has to be prefilled to get the next token's logits
+        prefix_length = min(prefix_length, len(token_ids) - 1)
+        if prefix_length <= 0:
+            return 0, None
+
+        past_key_values = tuple(
+            (k[:, :, :prefix_length], v[:, :, :prefix_length])
+            for k, v in entry.past_key_values
+        )
+        logging.debug(f"Prefix cache hit: session_id={session_id}, cached_tokens={prefix_length}/{len(token_ids)}")
+        return prefix_length, past_key_values
+
+    def put(self, model_name: str, session_id, token_ids: List[int], past_key_values):
+        """
+        Store the KV cache of a finished turn, replacing the session's
+        previous entry.
+        """
+        if self.cache is None or session_id is None:
+            return
+
+        entry = PrefixCacheEntry(list(token_ids), past_key_values)
+        key = (model_name, session_id, _hash_tokens(entry.token_ids))
+        with self._lock:
+            previous_key = self._session_keys.pop((model_name, session_id), None)
+            if previous_key is not None:
+                self.cache.pop(previous_key, None)
+            try:
+                self.cache[key] = entry
+            except ValueError:
+                # larger than the whole cache
+                return
+            self._session_keys[(model_name, session_id)] = key
+
+    def clear_model(self, model_name: str):
+        """
+        Drop every entry of a model, e.g. once it has been unloaded.
+        """
+        if self.cache is None:
+            return
+        with self._lock:
+            for session_key in [k for k in self._session_keys if k[0] == model_name]:
+                self.cache.pop(self._session_keys.pop(session_key), None)
+
+# Global instance of the PrefixCache
+prefix_cache = PrefixCache()
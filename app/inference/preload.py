@@ -0,0 +1,84 @@
+from typing import Dict, List
+from .services import is_model_loaded, setup_model_if_not_running, warm_up_model
+import asyncio
+import logging
+
+PENDING = "pending"
+LOADING = "loading"
+WARMING_UP = "warming_up"
+READY = "ready"
+FAILED = "failed"
+# ready once, but evicted or replaced by another model since
+UNLOADED = "unloaded"
+
+
+class ModelPreloader:
+    """
+    Loads the configured models in the background when the server starts,
+    and warms each of them up with a short generation, so the first real
+    requests don't pay for loading or for cold kernels.
+
+    Tracks the state of every preloaded model for the readiness check; the
+    node is ready while all of them are ready and still loaded, which is
+    checked when asked, as the model pool may have unloaded them since.
+    """
+    def __init__(self):
+        self.models: List[str] = []
+        self._states: Dict[str, str] = {}
+        self._errors: Dict[str, str] = {}
+        self._task = None
+
+    def init_config(self, config):
+        self.models = [model_name.lower() for model_name in config.PRELOAD_MODELS or []]
+        self._states = {model_name: PENDING for model_name in self.models}
+        self._errors = {}
+
+    def start(self):
+        """
+        Start preloading, without waiting for it. Must be called from the
+        event loop.
+        """
+        if self.models and self._task is None:
+            self._task = asyncio.ensure_future(self._preload())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _preload(self):
+        # one at a time, models loading together would compete for memory
+        for model_name in self.models:
+            try:
+                self._states[model_name] = LOADING
+                await setup_model_if_not_running(model_name)
+                self._states[model_name] = WARMING_UP
+                await warm_up_model(model_name)
+            except Exception as e:
+                logging.error(f"Failed to preload {model_name}: {e}", exc_info=True)
+                self._states[model_name] = FAILED
+                self._errors[model_name] = str(e)
+                continue
+            self._states[model_name] = READY
+            logging.info(f"Preloaded {model_name}")
+
+    async def is_ready(self) -> bool:
+        states = await self.get_states()
+        return all(state['state'] == READY for state in states.values())
+
+    async def get_states(self) -> Dict[str, dict]:
+        states = {}
+        for model_name, state in self._states.items():
+            if state == READY and not await is_model_loaded(model_name):
+                # the next request for it pays for a cold load
+                state = UNLOADED
+            states[model_name] = {'state': state, 'error': self._errors.get(model_name)}
+        return states
+
+# Global instance of the ModelPreloader
+model_preloader = ModelPreloader()
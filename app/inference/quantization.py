@@ -0,0 +1,73 @@
+from typing import Optional
+import logging
+import os
+import torch
+
+LOAD_PRECISIONS = ("auto", "bf16", "int8")
+
+def cpu_supports_bf16() -> bool:
+    """
+    Whether the CPU has native bfloat16 instructions. Without them bf16
+    matmuls are emulated and slower than float32.
+    """
+    try:
+        with open("/proc/cpuinfo", "r") as file:
+            lines = file.readlines()
+    except OSError:
+        return False
+    flags = set()
+    for line in lines:
+        # "flags" on x86, "Features" on arm
+        if line.startswith("flags") or line.startswith("Features"):
+            flags.update(line.split(":", 1)[-1].split())
+    return bool(flags & {"avx512_bf16", "amx_bf16", "bf16"})
+
+def resolve_load_precision(precision: str, device: torch.device) -> str:
+    """
+    Fall back to 'auto' when the requested precision can't be used on
+    this device.
+    """
+    if precision not in LOAD_PRECISIONS:
+        logging.warning(f"Unknown model load precision {precision}, using auto")
+        return "auto"
+    if precision == "bf16":
+        supported = torch.cuda.is_bf16_supported() if device.type == "cuda" else cpu_supports_bf16()
+        if not supported:
+            logging.warning(f"bf16 is not supported on this {device.type}, loading in full precision")
+            return "auto"
+    if precision == "int8" and device.type != "cpu":
+        logging.warning("int8 dynamic quantization only runs on cpu, loading in full precision")
+        return "auto"
+    return precision
+
+def quantize_int8(model):
+    """
+    Dynamically quantize every linear layer to int8. Weights are stored
+    quantized and activations are quantized on the fly.
+    """
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+def load_quantized_model(path: str) -> Optional[torch.nn.Module]:
+    """
+    Load a model cached by `save_quantized_model`, or None if there is no
+    usable cache at `path`.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        cached = torch.load(path, weights_only=False)
+    except Exception as e:
+        logging.warning(f"Failed to load quantized model from {path}: {e}")
+        return None
+    # quantized modules are pickled, which is only safe within one torch version
+    if cached.get("torch_version") != torch.__version__:
+        logging.debug(f"Quantized model at {path} was saved with torch {cached.get('torch_version')}, quantizing again")
+        return None
+    return cached["model"]
+
+def save_quantized_model(model, path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary file first, so an interrupted save is never loaded
+    tmp_path = f"{path}.tmp"
+    torch.save({"torch_version": torch.__version__, "model": model}, tmp_path)
+    os.replace(tmp_path, path)
@@ -0,0 +1,126 @@
+from cachetools import TTLCache
+from typing import Awaitable, Callable, Optional
+import asyncio
+import hashlib
+import json
+import logging
+
+# rough per-entry bookkeeping overhead, on top of the response texts
+ENTRY_OVERHEAD_BYTES = 256
+# rough size of the logprobs of one token, with a few alternatives
+LOGPROB_ENTRY_BYTES = 512
+
+# handed to waiters of a generation whose result can't be shared
+_NOT_SHARED = object()
+
+
+def make_cache_key(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _result_size(result: tuple) -> int:
+    choices = result[0]
+    size = ENTRY_OVERHEAD_BYTES + sum(len(choice.text.encode()) for choice in choices)
+    # logprobs are a few small objects per token
+    size += sum(LOGPROB_ENTRY_BYTES * len(choice.logprobs) for choice in choices if choice.logprobs)
+    return size
+
+
+class ResponseCache:
+    """
+    Caches the results of deterministic, non-streamed generations.
+
+    Entries expire after a TTL and are evicted least-recently-used once the
+    cached texts exceed the byte budget. Identical requests that arrive
+    while the first one is still generating wait for its result instead of
+    generating it again.
+    """
+    def __init__(self):
+        self.cache = None
+        # key -> future of the generation currently producing that key
+        self._in_flight = {}
+        self.num_hits = 0
+        self.num_coalesced = 0
+        self.num_misses = 0
+
+    def init_config(self, config):
+        self.cache = None
+        if config.RESPONSE_CACHE_MAX_BYTES:
+            self.cache = TTLCache(
+                maxsize=config.RESPONSE_CACHE_MAX_BYTES,
+                ttl=config.RESPONSE_CACHE_TTL,
+                getsizeof=_result_size,
+            )
+
+    def is_enabled(self) -> bool:
+        return self.cache is not None
+
+    async def get_or_create(
+        self, key: str, create: Callable[[], Awaitable[tuple]],
+        is_cacheable: Optional[Callable[[tuple], bool]] = None
+    ) -> tuple:
+        """
+        Return the cached result for `key`, or run `create()` to produce it.
+        A result that `is_cacheable` rejects is neither cached nor shared
+        with identical requests waiting for it, which then run their own
+        `create()`. Must be called from the event loop.
+        """
+        result = self.cache.get(key)
+        if result is not None:
+            self.num_hits += 1
+            logging.debug(f"Response cache hit: {key[:16]}")
+            return result
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.num_coalesced += 1
+            logging.debug(f"Response cache: waiting for identical in-flight request {key[:16]}")
+            # shielded, so a cancelled waiter doesn't cancel the shared generation
+            try:
+                result = await asyncio.shield(in_flight)
+            except asyncio.CancelledError:
+                if not in_flight.cancelled():
+                    raise
+                # the request generating it was cancelled, not this one
+                result = _NOT_SHARED
+            if result is not _NOT_SHARED:
+                return result
+            return await create()
+
+        self.num_misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            result = await create()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # mark it retrieved, nobody may be waiting for it
+            future.exception()
+            raise
+        else:
+            if is_cacheable is not None and not is_cacheable(result):
+                future.set_result(_NOT_SHARED)
+                return result
+            future.set_result(result)
+            try:
+                self.cache[key] = result
+            except ValueError:
+                # larger than the whole cache
+                pass
+            return result
+        finally:
+            self._in_flight.pop(key, None)
+
+    def get_stats(self) -> dict:
+        return {
+            'hits': self.num_hits,
+            'coalesced': self.num_coalesced,
+            'misses': self.num_misses,
+            'size_bytes': self.cache.currsize if self.cache is not None else 0,
+        }
+
+# Global instance of the ResponseCache
+response_cache = ResponseCache()
@@ -1,5 +1,6 @@
 from fastapi import APIRouter, Request, Response
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from .models import CompletionRequest, ChatCompletionRequest
 from .services import (
     setup_model_if_not_running,
@@ -9,15 +10,25 @@ from .services import (
     is_model_loaded,
     get_supported_models
 )
+from .workers import WorkerError
+from .engine import FAILED_FINISH_REASONS, GenerationFailed
+from .admission import AdmissionRejected, DeadlineExceeded, admission_controller
+from .logprobs import to_chat_logprobs, to_completion_logprobs
+from .budget import TokenBudget, session_budgets
 from app.management.utils import increment_session_tokens_used, get_session_tokens_used
 from app.chain.utils import get_session_details
 from app.cost import cost_calculator
 import json
+import logging
 import time
 import uuid
 
 inference_router = APIRouter()
 
+# last line of a stream whose generation failed after the response started,
+# in place of the final chunk; the rest of it is cancelled, see _StreamBilling
+_STREAM_FAILED = json.dumps({"error": "generation failed"}) + "\n"
+
 def _is_valid_session(session_id, request_max_tokens=None) -> str:
     session = get_session_details(session_id)
     if session is None:
@@ -43,6 +54,119 @@ def _is_valid_session(session_id, request_max_tokens=None) -> str:
 
     return None
 
+def _get_session_token_budget(session_id) -> int:
+    """
+    Tokens the session can still pay for, from its cost limit and the tokens
+    billed to it so far. None if that can't be determined.
+    """
+    session = get_session_details(session_id)
+    if session is None:
+        return None
+    max_tokens = cost_calculator.calculate_max_tokens(session.compute_cost_limit, currency="ETH_WEI")
+    if max_tokens is None:
+        return None
+    tokens_used = get_session_tokens_used(session_id) or 0
+    return max_tokens - tokens_used
+
+def _get_deadline(raw_request: Request) -> float:
+    """
+    The request's deadline, from the X-Request-Timeout header (seconds the
+    client waits for a response) and MAX_GENERATION_SECONDS. None for none.
+    """
+    timeout = raw_request.headers.get('X-Request-Timeout')
+    if timeout is not None:
+        try:
+            timeout = float(timeout)
+        except ValueError:
+            timeout = 0
+        if not timeout > 0:
+            raise ValueError("X-Request-Timeout must be a positive number of seconds")
+    return admission_controller.get_deadline(timeout)
+
+class _StreamBilling:
+    """
+    Counts the output tokens of a streamed response and bills them once the
+    stream is over.
+
+    A client that disconnects stops reading the stream half way; generation
+    is then cancelled, and the tokens produced until it stopped are still
+    billed.
+    """
+    def __init__(self, stream_group, session_id: int, num_input_tokens: int):
+        self.stream_group = stream_group
+        self.session_id = session_id
+        self.num_input_tokens = num_input_tokens
+        self.num_output_tokens = 0
+
+    def count(self, delta):
+        self.num_output_tokens += len(delta.token_ids)
+
+    async def finish(self):
+        if not self.stream_group.is_finished:
+            self.stream_group.cancel()
+            try:
+                async for delta in self.stream_group:
+                    self.count(delta)
+            except Exception as e:
+                logging.warning(f"Failed to read the rest of a cancelled stream: {e}")
+        increment_session_tokens_used(self.session_id, self.num_input_tokens + self.num_output_tokens)
+
+async def _run_then_release(background: BackgroundTask, release):
+    try:
+        if background is not None:
+            await background()
+    finally:
+        release()
+
+async def _run_admitted(handler, *args) -> Response:
+    """
+    Run `handler` once the admission controller grants a slot. The slot is
+    held until the response, streamed or not, has been sent, and for a
+    stream the client left, until its generation has been cancelled.
+    """
+    try:
+        ticket = await admission_controller.admit()
+    except AdmissionRejected as e:
+        return Response(
+            status_code=429,
+            content=f'{{"error": "{e}"}}',
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+    try:
+        response = await handler(*args)
+    except BaseException:
+        ticket.release()
+        raise
+    if isinstance(response, StreamingResponse):
+        # the background task runs even if the client disconnects, and only
+        # returns once the generation it left behind has been cancelled and
+        # drained, see _StreamBilling.finish
+        response.background = BackgroundTask(_run_then_release, response.background, ticket.release)
+    else:
+        ticket.release()
+    return response
+
+async def _run_budgeted(handler, request, model: str, session_id: int, deadline: float = None) -> Response:
+    """
+    Run `handler` with the session's token budget, which generation stops
+    at. Concurrent requests of the session share the budget; it is held
+    until the response has been sent and its tokens billed.
+    """
+    budget = session_budgets.acquire(session_id, lambda: _get_session_token_budget(session_id))
+    try:
+        response = await handler(request, model, session_id, budget, deadline)
+    except BaseException:
+        session_budgets.release(session_id, budget)
+        raise
+    release = lambda: session_budgets.release(session_id, budget)
+    if isinstance(response, StreamingResponse):
+        # the background task bills the streamed tokens
+        response.background = BackgroundTask(_run_then_release, response.background, release)
+    else:
+        release()
+    return response
+
 @inference_router.post('/v1/completions')
 async def completions(request: CompletionRequest, raw_request: Request):
     session_id = raw_request.query_params.get('session_id')
@@ -63,13 +187,30 @@ async def completions(request: CompletionRequest, raw_request: Request):
     session_err_msg = _is_valid_session(session_id, request.max_tokens)
     if session_err_msg is not None:
         return Response(status_code=400, content=f'{{"error": "{session_err_msg}"}}')
-    
+
+    try:
+        deadline = _get_deadline(raw_request)
+    except ValueError as e:
+        return Response(status_code=400, content=f'{{"error": "{e}"}}')
+
+    return await _run_admitted(_run_budgeted, _run_completion, request, model, session_id, deadline)
+
+async def _run_completion(request: CompletionRequest, model: str, session_id: int, budget: TokenBudget, deadline: float = None):
     try:
         await setup_model_if_not_running(model)
     except Exception as e:
         return Response(status_code=500, content=f'{{"error": "Failed to setup model: {e}"}}')
 
-    result, tokenizer, num_input_tokens, num_output_tokens = create_completion(request)
+    try:
+        result, tokenizer, num_input_tokens, num_output_tokens = await create_completion(request, budget, deadline)
+    except ValueError as e:
+        return Response(status_code=400, content=f'{{"error": "{e}"}}')
+    except DeadlineExceeded as e:
+        return Response(status_code=504, content=f'{{"error": "{e}"}}')
+    except GenerationFailed as e:
+        return Response(status_code=500, content=f'{{"error": "{e}"}}')
+    except WorkerError as e:
+        return Response(status_code=503, content=f'{{"error": "{e}"}}')
 
     id = f"cmpl-{uuid.uuid4()}"
     created_time = int(time.time())
@@ -82,7 +223,7 @@ async def completions(request: CompletionRequest, raw_request: Request):
     }
 
     if not request.stream:
-        if not isinstance(result, str):
+        if not isinstance(result, list):
             return Response(status_code=500, content='{"error": "Internal server error"}')
         
         increment_session_tokens_used(session_id, num_input_tokens + num_output_tokens)
@@ -92,11 +233,12 @@ async def completions(request: CompletionRequest, raw_request: Request):
             "object": "text_completion",
             "choices": [
                 {
-                    "finish_reason": "stop",
-                    "index": 0,
-                    "logprobs": None,
-                    "text": result
+                    "finish_reason": choice.finish_reason,
+                    "index": index,
+                    "logprobs": to_completion_logprobs(choice.logprobs) if choice.logprobs is not None else None,
+                    "text": choice.text
                 }
+                for index, choice in enumerate(result)
             ],
             "usage": {
                 "prompt_tokens": num_input_tokens,
@@ -106,56 +248,66 @@ async def completions(request: CompletionRequest, raw_request: Request):
         }
         return Response(content=json.dumps(response), media_type="application/json")
     
-    streamer = result
-
-    def stream_response():
-        num_output_tokens = 0
-
-        for new_text in streamer:
-            new_tokens = tokenizer.encode(new_text, add_special_tokens=False)
-            num_output_tokens += len(new_tokens)
-
+    stream_group = result
+
+    billing = _StreamBilling(stream_group, session_id, num_input_tokens)
+
+    async def stream_response():
+        finish_reasons = {}
+        # offset of each choice's next delta in its text, for logprobs
+        text_offsets = {}
+
+        async for delta in stream_group:
+            if delta.finish_reason in FAILED_FINISH_REASONS:
+                yield _STREAM_FAILED
+                return
+            billing.count(delta)
+            if delta.finish_reason is not None:
+                finish_reasons[delta.index] = delta.finish_reason
+            if not delta.text and not delta.logprobs:
+                continue
+
+            text_offset = text_offsets.get(delta.index, 0)
+            text_offsets[delta.index] = text_offset + len(delta.text)
             response = {
                 **response_template,
                 "object": "text_completion.chunk",
                 "choices": [
                     {
                         "finish_reason": None,
-                        "index": 0,
-                        "logprobs": None,
-                        "text": new_text
+                        "index": delta.index,
+                        "logprobs": to_completion_logprobs(delta.logprobs, text_offset) if delta.logprobs else None,
+                        "text": delta.text
                     }
                 ]
             }
             yield json.dumps(response) + "\n"
 
-        if request.echo:
-            # if echoing, it outputs both input and output tokens,
-            # so we need to subtract the input tokens from the total
-            num_output_tokens -= num_input_tokens
-        increment_session_tokens_used(session_id, num_input_tokens + num_output_tokens)
-
         final_response = {
             **response_template,
             "object": "text_completion.chunk",
             "choices": [
                 {
-                    "finish_reason": "stop",
-                    "index": 0,
+                    "finish_reason": finish_reasons.get(index, "stop"),
+                    "index": index,
                     "logprobs": None,
                     "text": ""
                 }
+                for index in range(stream_group.num_streams)
             ],
             "usage": {
                 "prompt_tokens": num_input_tokens,
-                "completion_tokens": num_output_tokens,
-                "total_tokens": num_input_tokens + num_output_tokens if num_output_tokens is not None else None
+                "completion_tokens": billing.num_output_tokens,
+                "total_tokens": num_input_tokens + billing.num_output_tokens
             }
         }
         yield json.dumps(final_response) + "\n"
         yield "[DONE]\n"
 
-    return StreamingResponse(stream_response(), media_type="text/plain", headers={"Transfer-Encoding": "chunked"})
+    return StreamingResponse(
+        stream_response(), media_type="text/plain", headers={"Transfer-Encoding": "chunked"},
+        background=BackgroundTask(billing.finish),
+    )
 
 @inference_router.post('/v1/chat/completions')
 async def completions_chat(request: ChatCompletionRequest, raw_request: Request):
@@ -177,13 +329,30 @@ async def completions_chat(request: ChatCompletionRequest, raw_request: Request)
     session_err_msg = _is_valid_session(session_id, request.max_tokens)
     if session_err_msg is not None:
         return Response(status_code=400, content=f'{{"error": "{session_err_msg}"}}')
-    
+
+    try:
+        deadline = _get_deadline(raw_request)
+    except ValueError as e:
+        return Response(status_code=400, content=f'{{"error": "{e}"}}')
+
+    return await _run_admitted(_run_budgeted, _run_chat_completion, request, model, session_id, deadline)
+
+async def _run_chat_completion(request: ChatCompletionRequest, model: str, session_id: int, budget: TokenBudget, deadline: float = None):
     try:
         await setup_model_if_not_running(model)
     except Exception as e:
         return Response(status_code=500, content=f'{{"error": "Failed to setup model: {e}"}}')
     
-    result, tokenizer, num_input_tokens, num_output_tokens = create_chat_completion(request)
+    try:
+        result, tokenizer, num_input_tokens, num_output_tokens = await create_chat_completion(request, session_id, budget, deadline)
+    except ValueError as e:
+        return Response(status_code=400, content=f'{{"error": "{e}"}}')
+    except DeadlineExceeded as e:
+        return Response(status_code=504, content=f'{{"error": "{e}"}}')
+    except GenerationFailed as e:
+        return Response(status_code=500, content=f'{{"error": "{e}"}}')
+    except WorkerError as e:
+        return Response(status_code=503, content=f'{{"error": "{e}"}}')
 
     id = f"chatcmpl-{uuid.uuid4()}"
     created_time = int(time.time())
@@ -196,7 +365,7 @@ async def completions_chat(request: ChatCompletionRequest, raw_request: Request)
     }
 
     if not request.stream:
-        if not isinstance(result, str):
+        if not isinstance(result, list):
             return Response(status_code=500, content='{"error": "Internal server error"}')
         
         increment_session_tokens_used(session_id, num_input_tokens + num_output_tokens)
@@ -208,12 +377,13 @@ async def completions_chat(request: ChatCompletionRequest, raw_request: Request)
                 {
                     "message": {
                         "role": "assistant",
-                        "content": result
+                        "content": choice.text
                     },
-                    "logprobs": None,
-                    "finish_reason": "stop",
-                    "index": 0
+                    "logprobs": to_chat_logprobs(choice.logprobs) if choice.logprobs is not None else None,
+                    "finish_reason": choice.finish_reason,
+                    "index": index
                 }
+                for index, choice in enumerate(result)
             ],
             "usage": {
                 "prompt_tokens": num_input_tokens,
@@ -224,14 +394,22 @@ async def completions_chat(request: ChatCompletionRequest, raw_request: Request)
         return Response(content=json.dumps(response), media_type="application/json")
     
     # otherwise, we are streaming
-    streamer = result
+    stream_group = result
+
+    billing = _StreamBilling(stream_group, session_id, num_input_tokens)
 
-    def stream_response():
-        num_output_tokens = 0
+    async def stream_response():
+        finish_reasons = {}
 
-        for new_text in streamer:
-            new_tokens = tokenizer.encode(new_text, add_special_tokens=False)
-            num_output_tokens += len(new_tokens)
+        async for delta in stream_group:
+            if delta.finish_reason in FAILED_FINISH_REASONS:
+                yield _STREAM_FAILED
+                return
+            billing.count(delta)
+            if delta.finish_reason is not None:
+                finish_reasons[delta.index] = delta.finish_reason
+            if not delta.text and not delta.logprobs:
+                continue
 
             response = {
                 **response_template,
@@ -239,31 +417,33 @@ async def completions_chat(request: ChatCompletionRequest, raw_request: Request)
                 "choices": [
                     {
                         "delta": {
-                            "content": new_text
+                            "content": delta.text
                         },
                         "finish_reason": None,
-                        "index": 0,
-                        "logprobs": None
+                        "index": delta.index,
+                        "logprobs": to_chat_logprobs(delta.logprobs) if delta.logprobs else None
                     }
                 ]
             }
             yield json.dumps(response) + "\n"
 
-        increment_session_tokens_used(session_id, num_input_tokens + num_output_tokens)
-
         final_response = {
             **response_template,
             "object": "chat.completion.chunk",
             "choices": [
                 {
                     "delta": {},
-                    "finish_reason": "stop",
-                    "index": 0,
+                    "finish_reason": finish_reasons.get(index, "stop"),
+                    "index": index,
                     "logprobs": None
                 }
+                for index in range(stream_group.num_streams)
             ]
         }
         yield json.dumps(final_response) + "\n"
         yield "[DONE]\n"
 
-    return StreamingResponse(stream_response(), media_type="text/plain", headers={"Transfer-Encoding": "chunked"})
+    return StreamingResponse(
+        stream_response(), media_type="text/plain", headers={"Transfer-Encoding": "chunked"},
+        background=BackgroundTask(billing.finish),
+    )
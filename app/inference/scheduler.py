@@ -0,0 +1,872 @@
+from collections import deque
+from threading import Event, Lock
+from typing import Dict, List, Optional
+from .engine import Engine, get_eos_token_ids
+from .logits_processors import BatchLogitsProcessor, create_logits_processors
+from .logprobs import TokenLogprob, get_prompt_logprobs, get_token_logprobs
+from .stopping import StopStringChecker
+import logging
+import time
+import torch
+
+
+class Sequence:
+    """
+    A single prompt being generated by the scheduler.
+
+    Generated token ids are appended to `output_ids` as they are sampled and,
+    if a streamer is attached, pushed to it one token at a time.
+
+    `cached_past` can hold the KV cache of the first `num_cached_tokens`
+    input tokens, in which case only the remaining tokens are prefilled.
+    `cache_callback(token_ids, past_key_values)` is called with the
+    sequence's own KV cache when it finishes, so it can be reused by a later
+    request.
+
+    Sequences created with the same `prefill_group` must have the same
+    prompt. They are admitted together and their prompt is prefilled only
+    once, after which the KV cache is forked into one row per sequence.
+
+    `logit_bias` maps token ids to a bias added to their logits, and
+    `presence_penalty` and `frequency_penalty` penalize tokens the sequence
+    has already generated, as in the OpenAI API.
+
+    Generation stops early once the output contains one of the `stop`
+    strings or a token in `stop_token_ids` is sampled.
+
+    A sequence with a `guide` only samples tokens that keep its output on
+    the guide's FSM, see guided_decoding.py.
+
+    With `logprobs`, the log probability of every sampled token and of the
+    `logprobs` most likely tokens at its position are kept in
+    `output_logprobs`, and with `prompt_logprobs` the same for the prompt
+    in `prompt_logprobs`.
+
+    A sequence with a `budget` (a TokenBudget) stops with finish_reason
+    "length" once the budget is used up, and so does one with a `deadline`
+    (in time.monotonic()) once it has passed. One that can't be prefilled
+    before its deadline is dropped without output, see `is_expired`.
+
+    `sampling_params` are the request's `to_sampling_params`, for engines
+    that take them whole rather than the arguments above, see engine.py.
+    """
+    def __init__(
+        self,
+        input_ids: List[int],
+        max_new_tokens: Optional[int] = None,
+        temperature: Optional[float] = 1.0,
+        top_p: Optional[float] = 1.0,
+        do_sample: bool = False,
+        streamer=None,
+        cached_past=None,
+        num_cached_tokens: int = 0,
+        cache_callback=None,
+        prefill_group=None,
+        seed: Optional[int] = None,
+        presence_penalty: Optional[float] = 0.0,
+        frequency_penalty: Optional[float] = 0.0,
+        logit_bias: Optional[Dict[int, float]] = None,
+        stop: Optional[List[str]] = None,
+        stop_token_ids: Optional[List[int]] = None,
+        guide=None,
+        logprobs: Optional[int] = None,
+        prompt_logprobs: Optional[int] = None,
+        budget=None,
+        sampling_params: Optional[dict] = None,
+        deadline: Optional[float] = None,
+    ):
+        self.input_ids = list(input_ids)
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature if temperature is not None else 1.0
+        self.top_p = top_p if top_p is not None else 1.0
+        # a temperature of 0 means greedy decoding
+        self.do_sample = bool(do_sample) and self.temperature > 0
+        self.streamer = streamer
+        self.cached_past = cached_past
+        self.num_cached_tokens = num_cached_tokens if cached_past is not None else 0
+        self.cache_callback = cache_callback
+        self.prefill_group = prefill_group
+        self.seed = seed
+        # random generator of a seeded sequence, created on the model's device
+        self.generator: Optional[torch.Generator] = None
+        self.presence_penalty = presence_penalty or 0.0
+        self.frequency_penalty = frequency_penalty or 0.0
+        self.logit_bias = logit_bias or None
+        # an empty stop string would match straight away
+        self.stop = [s for s in (stop or []) if s]
+        self.stop_token_ids = set(stop_token_ids or [])
+        self.stop_checker = StopStringChecker(self.stop, self.input_ids) if self.stop else None
+        self.guide = guide
+        self.num_logprobs = logprobs
+        self.num_prompt_logprobs = prompt_logprobs
+        self.output_logprobs: List[TokenLogprob] = []
+        self.prompt_logprobs: Optional[List[TokenLogprob]] = None
+        self.budget = budget
+        self.sampling_params = sampling_params
+        self.deadline = deadline
+
+        self.output_ids: List[int] = []
+        # log probability of the sampled tokens under the sampling distribution
+        self.cumulative_logprob = 0.0
+        self.finish_reason: Optional[str] = None
+        self._cancelled = False
+        self._expired = False
+        self._started = False
+        self._start_callbacks = []
+        self._done = Event()
+        self._done_callbacks = []
+        self._callbacks_lock = Lock()
+
+    @property
+    def is_finished(self) -> bool:
+        return self.finish_reason is not None
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._cancelled
+
+    @property
+    def is_expired(self) -> bool:
+        """
+        Whether the sequence was dropped before its prefill, as it couldn't
+        have been prefilled before its deadline.
+        """
+        return self._expired
+
+    def cancel(self):
+        """
+        Stop generating, e.g. because the client went away. The scheduler
+        finishes the sequence with reason "cancelled" at the next token
+        boundary; tokens generated until then are kept.
+        """
+        self._cancelled = True
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Block until the sequence has finished generating.
+        """
+        return self._done.wait(timeout)
+
+    def add_done_callback(self, fn):
+        """
+        Call `fn(sequence)` once the sequence has finished. Callbacks run on
+        the scheduler thread, or straight away if the sequence is already done.
+        """
+        with self._callbacks_lock:
+            if not self.is_finished:
+                self._done_callbacks.append(fn)
+                return
+        fn(self)
+
+    def add_start_callback(self, fn):
+        """
+        Call `fn(sequence)` once the sequence's prompt has been prefilled,
+        or once it finished without that, e.g. because it expired. Callbacks
+        run on the scheduler thread, or straight away if that happened
+        already.
+        """
+        with self._callbacks_lock:
+            if not self._started:
+                self._start_callbacks.append(fn)
+                return
+        fn(self)
+
+    def _run_start_callbacks(self):
+        with self._callbacks_lock:
+            self._started = True
+            callbacks, self._start_callbacks = self._start_callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                logging.error(f"Sequence start callback failed: {e}", exc_info=True)
+
+    def _expire(self):
+        self._expired = True
+        self._finish("length")
+
+    def _start(self):
+        if self.streamer is not None:
+            if self.prompt_logprobs is not None:
+                self.streamer.add_logprobs(self.prompt_logprobs)
+            # the streamer skips this first put if it was created with skip_prompt
+            self.streamer.put(torch.tensor(self.input_ids))
+        self._run_start_callbacks()
+
+    def _append(self, token_id: int, logprob: float, token_logprob: Optional[TokenLogprob] = None):
+        self.output_ids.append(token_id)
+        self.cumulative_logprob += logprob
+        if token_logprob is not None:
+            self.output_logprobs.append(token_logprob)
+        if self.streamer is not None:
+            if token_logprob is not None:
+                self.streamer.add_logprobs([token_logprob])
+            self.streamer.put(torch.tensor([token_id]))
+
+    def _finish(self, reason: str):
+        with self._callbacks_lock:
+            self.finish_reason = reason
+        if self.streamer is not None:
+            self.streamer.end(reason)
+        self._done.set()
+        self._run_start_callbacks()
+        for fn in self._done_callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                logging.error(f"Sequence done callback failed: {e}", exc_info=True)
+
+
+class _Batch:
+    """
+    The running decode batch.
+
+    Rows are left-padded so every sequence ends at the last column of the
+    KV cache; `attention_mask` covers the cached positions and
+    `next_input_ids` holds the last sampled token of each row, which has not
+    been fed through the model yet. `logits_processors` hold the per-row
+    sampling state and follow the rows of the batch.
+    """
+    def __init__(self, sequences: List[Sequence], next_input_ids, attention_mask, past_key_values, logits_processors=None):
+        self.sequences = sequences
+        self.next_input_ids = next_input_ids
+        self.attention_mask = attention_mask
+        self.past_key_values = past_key_values
+        self.logits_processors: List[BatchLogitsProcessor] = logits_processors or []
+
+    def __len__(self):
+        return len(self.sequences)
+
+    @property
+    def cache_length(self) -> int:
+        return self.attention_mask.shape[1]
+
+    def get_row_past(self, row: int) -> tuple:
+        """
+        Copy the KV cache of a single row, without its padding.
+        """
+        length = int(self.attention_mask[row].sum())
+        return tuple(
+            (k[row:row + 1, :, -length:].clone(), v[row:row + 1, :, -length:].clone())
+            for k, v in self.past_key_values
+        )
+
+    def select_rows(self, sequences: List[Sequence], rows: List[int]) -> "_Batch":
+        """
+        Build a batch for `sequences` where each sequence takes a copy of
+        the given row of this batch.
+        """
+        index = torch.tensor(rows, device=self.attention_mask.device)
+        return _Batch(
+            sequences,
+            None,
+            self.attention_mask.index_select(0, index),
+            tuple((k.index_select(0, index), v.index_select(0, index)) for k, v in self.past_key_values),
+            [processor.index_select(index) for processor in self.logits_processors],
+        )
+
+    def truncate(self, length: int):
+        """
+        Drop every cache column past `length`, e.g. those of rejected
+        speculative tokens.
+        """
+        self.attention_mask = self.attention_mask[:, :length]
+        self.past_key_values = tuple(
+            (k[:, :, :length], v[:, :, :length]) for k, v in self.past_key_values
+        )
+
+    def filter(self, keep: List[int]) -> "_Batch":
+        """
+        Drop every row that is not in `keep`, and trim padding columns no
+        remaining row needs anymore.
+        """
+        index = torch.tensor(keep, device=self.attention_mask.device)
+        attention_mask = self.attention_mask.index_select(0, index)
+
+        # rows are left-padded, so columns that are empty for all remaining
+        # rows are always at the start of the cache
+        offset = int(attention_mask.any(dim=0).int().argmax())
+        attention_mask = attention_mask[:, offset:]
+        past_key_values = tuple(
+            (k.index_select(0, index)[:, :, offset:], v.index_select(0, index)[:, :, offset:])
+            for k, v in self.past_key_values
+        )
+
+        return _Batch(
+            [self.sequences[i] for i in keep],
+            self.next_input_ids.index_select(0, index),
+            attention_mask,
+            past_key_values,
+            [processor.index_select(index) for processor in self.logits_processors],
+        )
+
+    def concatenate(self, other: "_Batch") -> "_Batch":
+        """
+        Merge another batch into this one, left-padding the shorter cache.
+        """
+        length = max(self.cache_length, other.cache_length)
+        attention_mask = torch.cat([
+            _left_pad(self.attention_mask, length, dim=1),
+            _left_pad(other.attention_mask, length, dim=1),
+        ], dim=0)
+        past_key_values = tuple(
+            (
+                torch.cat([_left_pad(k1, length, dim=2), _left_pad(k2, length, dim=2)], dim=0),
+                torch.cat([_left_pad(v1, length, dim=2), _left_pad(v2, length, dim=2)], dim=0),
+            )
+            for (k1, v1), (k2, v2) in zip(self.past_key_values, other.past_key_values)
+        )
+
+        return _Batch(
+            self.sequences + other.sequences,
+            torch.cat([self.next_input_ids, other.next_input_ids], dim=0),
+            attention_mask,
+            past_key_values,
+            [first.concatenate(second) for first, second in zip(self.logits_processors, other.logits_processors)],
+        )
+
+
+def _left_pad(tensor: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    pad_length = length - tensor.shape[dim]
+    if pad_length <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = pad_length
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+def _top_p_filter(logits: torch.Tensor, top_p: torch.Tensor) -> torch.Tensor:
+    # same approach as transformers' TopPLogitsWarper, but with a top_p per row
+    sorted_logits, sorted_indices = torch.sort(logits, descending=False, dim=-1)
+    cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+    sorted_indices_to_remove = cumulative_probs <= (1 - top_p)
+    # always keep at least the most likely token
+    sorted_indices_to_remove[..., -1:] = False
+    indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
+    return logits.masked_fill(indices_to_remove, -float("inf"))
+
+
+def _sample_next_tokens(logits: torch.Tensor, sequences: List[Sequence], logits_processors: List[BatchLogitsProcessor] = ()):
+    """
+    Pick the next token for every row, honouring each sequence's own
+    sampling parameters. Returns the tokens, their log probabilities under
+    the distribution they were drawn from, and the log probabilities of the
+    whole vocabulary under the processed logits, before temperature and
+    top_p.
+    """
+    logits = logits.float()
+    for processor in logits_processors:
+        logits = processor(None, logits)
+    next_tokens = logits.argmax(dim=-1)
+    logprobs = logits.log_softmax(dim=-1)
+
+    sample_rows = [i for i, seq in enumerate(sequences) if seq.do_sample]
+    if not sample_rows:
+        return next_tokens, logprobs.gather(1, next_tokens.unsqueeze(1)).squeeze(1), logprobs
+
+    rows = torch.tensor(sample_rows, device=logits.device)
+    temperatures = torch.tensor([sequences[i].temperature for i in sample_rows], device=logits.device)
+    top_ps = torch.tensor([sequences[i].top_p for i in sample_rows], device=logits.device)
+
+    sample_logits = logits.index_select(0, rows) / temperatures.unsqueeze(1)
+    if (top_ps < 1.0).any():
+        sample_logits = _top_p_filter(sample_logits, top_ps.unsqueeze(1))
+    sample_logprobs = sample_logits.log_softmax(dim=-1)
+
+    probs = sample_logprobs.exp()
+    generators = [sequences[i].generator for i in sample_rows]
+    if any(generator is not None for generator in generators):
+        # seeded rows draw from their own generator, so their output does
+        # not depend on what else is in the batch
+        next_tokens[rows] = torch.cat([
+            torch.multinomial(probs[j:j + 1], num_samples=1, generator=generator)
+            for j, generator in enumerate(generators)
+        ]).squeeze(1)
+    else:
+        next_tokens[rows] = torch.multinomial(probs, num_samples=1).squeeze(1)
+    token_logprobs = logprobs.gather(1, next_tokens.unsqueeze(1)).squeeze(1)
+    token_logprobs[rows] = sample_logprobs.gather(1, next_tokens[rows].unsqueeze(1)).squeeze(1)
+    return next_tokens, token_logprobs, logprobs
+
+
+class Scheduler(Engine):
+    """
+    Iteration-level batching scheduler for a single loaded model, the
+    engine of models served through transformers (see engine.py).
+
+    Submitted sequences wait until the next token boundary, are prefilled
+    together and then merged into the running decode batch. Every decode
+    step advances all running sequences by one token, and sequences that
+    finish are removed from the batch straight away so their slot can be
+    reused by the next waiting request.
+
+    The decode loop runs on a thread of its own while there is work, and
+    the thread exits as soon as the scheduler is idle.
+
+    With a `speculative_decoder`, steps where only one sequence is running
+    are speculated instead, which can yield several tokens per step.
+
+    Prompts longer than `prefill_chunk_size` uncached tokens are prefilled
+    one chunk per step, between decode steps of the running batch, so a long
+    prompt doesn't stall the sequences that are already streaming.
+
+    With a `compiled_decoder`, regular decode steps run through its compiled
+    graph on a static KV cache, see compiled_decoding.py.
+    """
+    supports_prefix_cache = True
+    supports_guided_decoding = True
+
+    def __init__(
+        self, model, tokenizer, max_batch_size: int = 16, speculative_decoder=None,
+        prefill_chunk_size: Optional[int] = None, compiled_decoder=None
+    ):
+        super().__init__(
+            tokenizer, max_batch_size,
+            eos_token_ids=get_eos_token_ids(tokenizer, model.generation_config),
+            max_context=getattr(model.config, "max_position_embeddings", None),
+        )
+        self.model = model
+        self.prefill_chunk_size = prefill_chunk_size
+        self.compiled_decoder = compiled_decoder
+        self.speculative_decoder = speculative_decoder
+        self.device = model.device
+
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+
+        self._batch: Optional[_Batch] = None
+        # prefill groups whose prompt is being prefilled in chunks, oldest
+        # first; the leader's cached_past holds the chunks done so far
+        self._prefilling: "deque[List[Sequence]]" = deque()
+
+    @property
+    def vocab_size(self) -> int:
+        return self.model.config.vocab_size
+
+    @property
+    def num_running(self) -> int:
+        batch = self._batch
+        return len(batch) if batch is not None else 0
+
+    @property
+    def num_prefilling(self) -> int:
+        return sum(len(group) for group in self._prefilling)
+
+    def to_sequence_params(self, request) -> dict:
+        params = request.to_generate_params()
+        if "do_sample" not in params:
+            # fall back to the model's own default, same as model.generate() would
+            params["do_sample"] = self.model.generation_config.do_sample
+        return self._check_sequence_params(params)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._batch is None and not self._waiting and not self._prefilling:
+                    # nothing left to do, the loop is restarted on the next submit
+                    self._running = False
+                    return
+                new_sequences = []
+                cancelled = []
+                expired = []
+                while self._waiting and self.num_running + self.num_prefilling + len(new_sequences) < self.max_batch_size:
+                    admitted = [self._waiting.popleft()]
+                    # a prefill group is always admitted as a whole
+                    group = admitted[0].prefill_group
+                    while group is not None and self._waiting and self._waiting[0].prefill_group is group:
+                        admitted.append(self._waiting.popleft())
+                    # sequences cancelled while waiting, or that would miss
+                    # their deadline anyway, are never prefilled
+                    is_expired = self._cannot_finish_in_time(admitted[0])
+                    for seq in admitted:
+                        if seq.is_cancelled:
+                            cancelled.append(seq)
+                        elif is_expired:
+                            expired.append(seq)
+                        else:
+                            new_sequences.append(seq)
+                # those left waiting behind a full batch are told as soon as
+                # their deadline passes, not when they would be admitted
+                expired += self._pop_expired_waiting()
+
+            for seq in cancelled:
+                seq._finish("cancelled")
+            for seq in expired:
+                seq._expire()
+
+            # a prompt that fails its prefill only fails its own sequences,
+            # the running batch is untouched until then
+            if new_sequences:
+                try:
+                    self._prefill(new_sequences)
+                except Exception as e:
+                    logging.error(f"Scheduler prefill failed: {e}", exc_info=True)
+                    self._fail_prefill(new_sequences)
+            if self._prefilling:
+                group = self._prefilling[0]
+                try:
+                    self._prefill_chunk()
+                except Exception as e:
+                    logging.error(f"Scheduler chunked prefill failed: {e}", exc_info=True)
+                    if self._prefilling and self._prefilling[0] is group:
+                        self._prefilling.popleft()
+                    self._fail_prefill(group)
+            try:
+                if self._batch is not None:
+                    self._decode_step()
+            except Exception as e:
+                logging.error(f"Scheduler step failed: {e}", exc_info=True)
+                self._abort()
+
+    def _pop_expired_waiting(self) -> List[Sequence]:
+        now = time.monotonic()
+        if not any(seq.deadline is not None and now >= seq.deadline for seq in self._waiting):
+            return []
+        # sequences of a prefill group share their deadline, so groups stay whole
+        expired = [seq for seq in self._waiting if seq.deadline is not None and now >= seq.deadline]
+        self._waiting = deque(seq for seq in self._waiting if seq.deadline is None or now < seq.deadline)
+        return expired
+
+    def _fail_prefill(self, sequences: List[Sequence]):
+        """
+        Finish the `sequences` whose prefill raised with reason "error",
+        except those that made it into the running batch or are still
+        queued for a chunked prefill before it did.
+        """
+        started = set(self._batch.sequences) if self._batch is not None else set()
+        started.update(seq for group in self._prefilling for seq in group)
+        for seq in sequences:
+            if not seq.is_finished and seq not in started:
+                seq._finish("error")
+
+    def _abort(self):
+        sequences = []
+        while self._prefilling:
+            sequences += self._prefilling.popleft()
+        if self._batch is not None:
+            sequences += self._batch.sequences
+            self._batch = None
+        for seq in sequences:
+            if not seq.is_finished:
+                seq._finish("error")
+
+    @torch.inference_mode()
+    def _prefill(self, sequences: List[Sequence]):
+        start = time.monotonic()
+        # sequences of a prefill group share the prompt of their first member
+        leaders = []
+        leader_rows = []
+        group_leaders = {}
+        for seq in sequences:
+            if seq.prefill_group is None or seq.prefill_group not in group_leaders:
+                if seq.prefill_group is not None:
+                    group_leaders[seq.prefill_group] = len(leaders)
+                leader_rows.append(len(leaders))
+                leaders.append(seq)
+            else:
+                leader_rows.append(group_leaders[seq.prefill_group])
+
+        chunked = [i for i, seq in enumerate(leaders) if self._is_chunked(seq)]
+        for i in chunked:
+            # long prompts are prefilled a chunk per step, see _prefill_chunk
+            self._prefilling.append([seq for seq, leader in zip(sequences, leader_rows) if leader == i])
+
+        uncached = [i for i, seq in enumerate(leaders) if seq.cached_past is None and i not in chunked]
+        if uncached:
+            batch, logits = self._forward_prompts([leaders[i] for i in uncached])
+            self._add_forked_rows(batch, logits, sequences, leader_rows, uncached)
+        # cached prefixes have different lengths, so those are prefilled one by one
+        num_tokens = sum(len(leaders[i].input_ids) for i in uncached)
+        for i, seq in enumerate(leaders):
+            if seq.cached_past is not None and i not in chunked:
+                num_tokens += len(seq.input_ids) - seq.num_cached_tokens
+                batch, logits = self._forward_cached_prompt(seq)
+                self._add_forked_rows(batch, logits, sequences, leader_rows, [i])
+        self._record_prefill_time(num_tokens, time.monotonic() - start)
+
+    def _is_chunked(self, seq: Sequence) -> bool:
+        if self.prefill_chunk_size is None:
+            return False
+        return len(seq.input_ids) - seq.num_cached_tokens > self.prefill_chunk_size
+
+    @torch.inference_mode()
+    def _prefill_chunk(self):
+        """
+        Prefill the next chunk of the oldest chunked prompt. With its last
+        chunk, its prefill group joins the running batch.
+        """
+        group = self._prefilling[0]
+        if all(seq.is_cancelled for seq in group):
+            self._prefilling.popleft()
+            for seq in group:
+                seq._finish("cancelled")
+            return
+
+        leader = group[0]
+        if self._cannot_finish_in_time(leader):
+            self._prefilling.popleft()
+            for seq in group:
+                seq._expire()
+            return
+        if not self._is_chunked(leader):
+            self._prefilling.popleft()
+            batch, logits = self._forward_cached_prompt(leader)
+            self._add_forked_rows(batch, logits, group, [0] * len(group), [0])
+            return
+        start = time.monotonic()
+        self._forward_prompt_chunk(leader, leader.num_cached_tokens + self.prefill_chunk_size)
+        self._record_prefill_time(self.prefill_chunk_size, time.monotonic() - start)
+
+    def _add_forked_rows(
+        self, batch: _Batch, logits: torch.Tensor,
+        sequences: List[Sequence], leader_rows: List[int], leaders: List[int]
+    ):
+        # every sequence whose leader was prefilled in `batch` gets its own copy of that row
+        members = [seq for seq, leader in zip(sequences, leader_rows) if leader in leaders]
+        rows = [leaders.index(leader) for leader in leader_rows if leader in leaders]
+        for seq, row in zip(members, rows):
+            seq.prompt_logprobs = batch.sequences[row].prompt_logprobs
+        if len(rows) != len(batch):
+            batch = batch.select_rows(members, rows)
+            logits = logits.index_select(0, torch.tensor(rows, device=logits.device))
+        self._add_to_batch(batch, logits)
+
+    def _forward_prompts(self, sequences: List[Sequence]):
+        max_length = max(len(seq.input_ids) for seq in sequences)
+        input_ids = torch.full((len(sequences), max_length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(sequences), max_length), dtype=torch.long)
+        for i, seq in enumerate(sequences):
+            input_ids[i, max_length - len(seq.input_ids):] = torch.tensor(seq.input_ids)
+            attention_mask[i, max_length - len(seq.input_ids):] = 1
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True,
+        )
+        # prompt logprobs come straight from the prefill logits
+        for i, seq in enumerate(sequences):
+            if seq.num_prompt_logprobs is not None:
+                start = max_length - len(seq.input_ids)
+                seq.prompt_logprobs = get_prompt_logprobs(
+                    outputs.logits[i, start:-1], input_ids[i, start:], seq.num_prompt_logprobs
+                )
+        batch = _Batch(sequences, None, attention_mask, outputs.past_key_values)
+        return batch, outputs.logits[:, -1, :]
+
+    def _forward_prompt_chunk(self, seq: Sequence, end: int):
+        """
+        Extend the KV cache in `seq.cached_past` with the prompt tokens up
+        to `end`.
+        """
+        num_cached = seq.num_cached_tokens
+        input_ids = torch.tensor([seq.input_ids[num_cached:end]], dtype=torch.long, device=self.device)
+        attention_mask = torch.ones((1, end), dtype=torch.long, device=self.device)
+        position_ids = torch.arange(num_cached, end, device=self.device).unsqueeze(0)
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=seq.cached_past,
+            use_cache=True,
+        )
+        # prompt logprobs of a prefix that came from a cache are unknown,
+        # those of a chunked prompt are collected chunk by chunk
+        if seq.num_prompt_logprobs is not None and (num_cached == 0 or seq.prompt_logprobs is not None):
+            # the last logits of a chunk are for the first token of the next one
+            token_ids = torch.tensor(seq.input_ids[num_cached:end + 1], device=self.device)
+            prompt_logprobs = get_prompt_logprobs(outputs.logits[0], token_ids, seq.num_prompt_logprobs)
+            seq.prompt_logprobs = prompt_logprobs if num_cached == 0 else seq.prompt_logprobs + prompt_logprobs[1:]
+        seq.cached_past = outputs.past_key_values
+        seq.num_cached_tokens = end
+        return outputs
+
+    def _forward_cached_prompt(self, seq: Sequence):
+        outputs = self._forward_prompt_chunk(seq, len(seq.input_ids))
+        seq.cached_past = None
+        attention_mask = torch.ones((1, len(seq.input_ids)), dtype=torch.long, device=self.device)
+        batch = _Batch([seq], None, attention_mask, outputs.past_key_values)
+        return batch, outputs.logits[:, -1, :]
+
+    def _add_to_batch(self, batch: _Batch, logits: torch.Tensor):
+        for seq in batch.sequences:
+            if seq.seed is not None:
+                seq.generator = torch.Generator(device=self.device).manual_seed(seq.seed)
+            seq._start()
+
+        # sequences that may not generate anything, e.g. to score an echoed
+        # prompt, are done once it is prefilled and never sample a token
+        keep = []
+        for i, seq in enumerate(batch.sequences):
+            if seq.max_new_tokens != 0:
+                keep.append(i)
+                continue
+            if seq.cache_callback is not None:
+                self._save_row_cache(batch, i, num_uncached=0)
+            seq._finish("length")
+        if not keep:
+            return
+        if len(keep) != len(batch):
+            batch = batch.select_rows([batch.sequences[i] for i in keep], keep)
+            logits = logits.index_select(0, torch.tensor(keep, device=logits.device))
+
+        batch.logits_processors = create_logits_processors(batch.sequences, logits.shape[-1], self.device)
+        next_tokens, logprobs, token_logprobs = self._sample(batch, logits)
+        batch.next_input_ids = next_tokens.unsqueeze(1)
+        batch = self._retire_finished(batch, next_tokens, logprobs, token_logprobs)
+        if batch is None:
+            return
+        self._batch = batch if self._batch is None else self._batch.concatenate(batch)
+
+    @torch.inference_mode()
+    def _decode_step(self):
+        batch = self._batch
+        if self.speculative_decoder is not None and len(batch) == 1:
+            num_tokens = self._get_num_speculative_tokens(batch.sequences[0])
+            if num_tokens > 0:
+                self._speculative_decode_step(num_tokens)
+                return
+
+        attention_mask = torch.cat([
+            batch.attention_mask,
+            batch.attention_mask.new_ones((len(batch), 1)),
+        ], dim=1)
+        position_ids = attention_mask.sum(dim=1, keepdim=True) - 1
+
+        if self.compiled_decoder is not None and self.compiled_decoder.can_decode(batch):
+            logits = self.compiled_decoder.decode(batch, attention_mask, position_ids)
+        else:
+            outputs = self.model(
+                input_ids=batch.next_input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=batch.past_key_values,
+                use_cache=True,
+            )
+            batch.past_key_values = outputs.past_key_values
+            logits = outputs.logits[:, -1, :]
+        batch.attention_mask = attention_mask
+
+        next_tokens, logprobs, token_logprobs = self._sample(batch, logits)
+        batch.next_input_ids = next_tokens.unsqueeze(1)
+        self._batch = self._retire_finished(batch, next_tokens, logprobs, token_logprobs)
+
+    def _sample(self, batch: _Batch, logits: torch.Tensor):
+        next_tokens, logprobs, vocab_logprobs = _sample_next_tokens(logits, batch.sequences, batch.logits_processors)
+        for processor in batch.logits_processors:
+            processor.update(next_tokens)
+
+        # logprobs for the response, of the rows that asked for them
+        token_logprobs = None
+        rows = [i for i, seq in enumerate(batch.sequences) if seq.num_logprobs is not None]
+        if rows:
+            index = torch.tensor(rows, device=vocab_logprobs.device)
+            token_logprobs = [None] * len(batch)
+            entries = get_token_logprobs(
+                vocab_logprobs.index_select(0, index),
+                next_tokens.index_select(0, index),
+                [batch.sequences[i].num_logprobs for i in rows],
+            )
+            for row, entry in zip(rows, entries):
+                token_logprobs[row] = entry
+        return next_tokens, logprobs, token_logprobs
+
+    def _get_num_speculative_tokens(self, seq: Sequence) -> int:
+        if seq.presence_penalty or seq.frequency_penalty:
+            # penalties change with every proposed token, which speculation doesn't model
+            return 0
+        if seq.guide is not None:
+            # neither does the FSM state of a guided sequence
+            return 0
+        if seq.num_logprobs is not None:
+            # verification doesn't keep the top logprobs of accepted tokens
+            return 0
+        # never propose tokens the sequence isn't allowed to generate
+        num_tokens = self.speculative_decoder.num_speculative_tokens
+        if seq.max_new_tokens is not None:
+            num_tokens = min(num_tokens, seq.max_new_tokens - len(seq.output_ids) - 1)
+        if self.max_context is not None:
+            num_tokens = min(num_tokens, self.max_context - len(seq.input_ids) - len(seq.output_ids) - 1)
+        if seq.budget is not None:
+            num_tokens = min(num_tokens, seq.budget.num_tokens - 1)
+        return num_tokens
+
+    @torch.inference_mode()
+    def _speculative_decode_step(self, num_tokens: int):
+        batch = self._batch
+        cache_length = batch.cache_length
+        token_ids, logprobs = self.speculative_decoder.step(self.model, batch, num_tokens)
+
+        # hand the tokens out one at a time, as regular decode steps would,
+        # until one of them finishes the sequence
+        seq = batch.sequences[0]
+        for i, (token_id, logprob) in enumerate(zip(token_ids, logprobs)):
+            if seq.budget is not None and not seq.budget.consume():
+                # the session can't pay for this token, it is dropped too
+                finish_reason, num_kept = "length", i
+            else:
+                seq._append(token_id, logprob)
+                for processor in batch.logits_processors:
+                    processor.update(torch.tensor([token_id], device=self.device))
+                finish_reason = self._get_finish_reason(seq, token_id)
+                if finish_reason is None:
+                    continue
+                num_kept = i + 1
+
+            # the cache must not hold the tokens that are dropped
+            batch.truncate(cache_length + num_kept)
+            if seq.cache_callback is not None:
+                self._save_row_cache(batch, 0)
+            seq._finish(finish_reason)
+
+            self.speculative_decoder.reset()
+            stats = self.speculative_decoder.get_stats()
+            logging.debug(f"Speculative decoding: {stats['num_accepted_tokens']}/{stats['num_draft_tokens']} draft tokens accepted ({stats['acceptance_rate']:.0%})")
+            self._batch = None
+            return
+
+        batch.next_input_ids = torch.tensor([[token_ids[-1]]], device=self.device)
+
+    def _retire_finished(
+        self, batch: _Batch, next_tokens: torch.Tensor, logprobs: torch.Tensor,
+        token_logprobs: Optional[List[Optional[TokenLogprob]]] = None
+    ) -> Optional[_Batch]:
+        keep = []
+        for i, (seq, token_id, logprob) in enumerate(zip(batch.sequences, next_tokens.tolist(), logprobs.tolist())):
+            if seq.budget is not None and not seq.budget.consume():
+                # the session can't pay for this token, so it is dropped;
+                # the last token the sequence kept is in the KV cache already
+                if seq.cache_callback is not None:
+                    self._save_row_cache(batch, i, num_uncached=0)
+                seq._finish("length")
+                continue
+
+            seq._append(token_id, logprob, token_logprobs[i] if token_logprobs is not None else None)
+            finish_reason = self._get_finish_reason(seq, token_id)
+            if finish_reason is None:
+                keep.append(i)
+                continue
+
+            if seq.cache_callback is not None:
+                self._save_row_cache(batch, i)
+            seq._finish(finish_reason)
+
+        if not keep:
+            return None
+        if len(keep) == len(batch):
+            return batch
+        return batch.filter(keep)
+
+    def _save_row_cache(self, batch: _Batch, row: int, num_uncached: int = 1):
+        seq = batch.sequences[row]
+        # the last sampled token has usually not been through the model
+        # yet, so it is not part of the KV cache
+        token_ids = seq.input_ids + seq.output_ids[:len(seq.output_ids) - num_uncached]
+        try:
+            seq.cache_callback(token_ids, batch.get_row_past(row))
+        except Exception as e:
+            logging.error(f"Failed to save KV cache of sequence: {e}", exc_info=True)
@@ -1,76 +1,286 @@
-from typing import Tuple, Union
+from typing import Dict, List, Tuple, Union
 from transformers import (
-    AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer,
+    AutoModelForCausalLM, AutoTokenizer,
     PreTrainedTokenizer, PreTrainedTokenizerFast
 )
-from .models import CompletionRequest, ChatCompletionRequest
-from threading import Thread
+from .models import CompletionRequest, ChatCompletionRequest, ChoiceOutput
+from .scheduler import Scheduler, Sequence
+from .engine import FAILED_FINISH_REASONS, GenerationFailed, load_engine
+from .pool import LoadedModel, ModelNotLoaded, model_pool, estimate_model_dir_size, get_model_memory_size
+from .executor import inference_executor
+from .streaming import AsyncStreamGroup, TeeStreamer
+from .prefix_cache import prefix_cache
+from .speculative import SpeculativeDecoder, create_vocab_translation
+from .compiled_decoding import (
+    CompiledDecoder, SUPPORTED_TRANSFORMERS_VERSIONS, is_compilable, is_transformers_supported, get_static_cache_size
+)
+from .quantization import resolve_load_precision, quantize_int8, load_quantized_model, save_quantized_model
+from .mmap_weights import load_mmap_model
+from .workers import worker_pool
+from .response_cache import response_cache, make_cache_key
+from .stopping import truncate_at_stop
+from .guided_decoding import Guide, guide_cache
+from .logprobs import decode_logprobs, truncate_logprobs
+from .budget import TokenBudget
+from .admission import DeadlineExceeded
+import asyncio
 import logging
+import os
+import time
 from app.models.storage import model_storage
 import torch
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-current_model_name = None
-tokenizer = None
-model = None
+# serialises model loads, requests for resident models never wait on it
+_load_lock = asyncio.Lock()
+# model name -> background task loading it, shared by the requests waiting for it
+_loads: Dict[str, asyncio.Task] = {}
+
+# synthetic request run by warm_up_model
+WARM_UP_PROMPT = "Hello"
+WARM_UP_MAX_TOKENS = 8
 
 def get_supported_models():
     return model_storage.get_supported_models()
 
 async def is_model_loaded(model_name: str) -> bool:
-    return model_name == current_model_name
+    if worker_pool.is_enabled():
+        return model_name in worker_pool.get_loaded_models()
+    return model_pool.is_loaded(model_name)
 
 async def is_model_downloaded(model_name: str) -> bool:
     return await model_storage.is_model_downloaded(model_name)
 
+def _get_load_dtype(precision: str, mmap_weights: bool = False) -> Union[torch.dtype, None]:
+    """
+    The dtype _load_model loads a model's weights in, None for the dtype
+    they are stored in.
+    """
+    if precision == "bf16":
+        return torch.bfloat16
+    if precision == "auto" and mmap_weights:
+        return None
+    # from_pretrained loads float32 when not told otherwise, int8 models are quantized from it
+    return torch.float32
+
+def _load_model(model_path: str, precision: str = "auto", quantized_path: str = None, mmap_weights: bool = False):
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = None
+    if precision == "int8":
+        model = load_quantized_model(quantized_path)
+    is_cached = model is not None
+    if model is None and precision == "auto" and mmap_weights:
+        model = load_mmap_model(model_path, pad_token_id=0)
+    if model is None:
+        model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            device_map="auto",
+            pad_token_id=0,
+            torch_dtype=torch.bfloat16 if precision == "bf16" else None,
+        )
+    if tokenizer.pad_token is None:
+        if tokenizer.eos_token:
+            tokenizer.pad_token = tokenizer.eos_token
+        else:
+            tokenizer.add_special_tokens({'pad_token': '[PAD]'})
+            # Make sure to resize model embeddings if you're adding a new token,
+            # a cached quantized model was already resized before it was saved
+            if not is_cached:
+                model.resize_token_embeddings(len(tokenizer))
+    if precision == "int8" and not is_cached:
+        model = quantize_int8(model)
+        try:
+            save_quantized_model(model, quantized_path)
+        except Exception as e:
+            logging.warning(f"Failed to cache quantized model at {quantized_path}: {e}")
+    model.to(device)
+    return tokenizer, model
+
+def _acquire_draft_model(model_name: str) -> Union[LoadedModel, None]:
+    speculative_config = model_pool.speculative_decoding.get(model_name)
+    if speculative_config is None:
+        return None
+    try:
+        draft = model_pool.acquire(speculative_config['draft_model'].lower())
+    except Exception as e:
+        logging.warning(f"Speculative decoding disabled for {model_name}: {e}")
+        return None
+    if draft.model is None:
+        logging.warning(f"Speculative decoding disabled for {model_name}: {draft.name} is not served by transformers")
+        model_pool.release(draft)
+        return None
+    return draft
+
+def _create_speculative_decoder(model_name: str, model, tokenizer, draft: LoadedModel) -> Union[SpeculativeDecoder, None]:
+    try:
+        translation = create_vocab_translation(model, tokenizer, draft.model, draft.tokenizer)
+    except ValueError as e:
+        logging.warning(f"Speculative decoding disabled for {model_name}: {e}")
+        return None
+    if translation is not None:
+        logging.warning(
+            f"Speculative decoding for {model_name}: {draft.name} has another vocabulary and only proposes "
+            f"the {translation.num_shared_tokens} tokens both share, fewer of its proposals will be accepted"
+        )
+    num_speculative_tokens = model_pool.speculative_decoding[model_name].get('num_speculative_tokens', 4)
+    logging.debug(f"Speculative decoding enabled for {model_name}: draft_model={draft.name}, num_speculative_tokens={num_speculative_tokens}")
+    return SpeculativeDecoder(draft.name, draft.model, num_speculative_tokens, translation)
+
+def _create_compiled_decoder(
+    model_name: str, model, replaced: List[str], keep: List[str]
+) -> Tuple[Union[CompiledDecoder, None], List[str]]:
+    """
+    Returns the decoder, and the models to replace to make room for it as
+    well, see ModelPool.make_room.
+    """
+    compiled_config = model_pool.compiled_models.get(model_name)
+    if compiled_config is None:
+        return None, replaced
+    if not is_transformers_supported():
+        logging.warning(
+            f"Compiled serving disabled for {model_name}: it needs transformers "
+            f">={SUPPORTED_TRANSFORMERS_VERSIONS[0]},<{SUPPORTED_TRANSFORMERS_VERSIONS[1]}"
+        )
+        return None, replaced
+    if not is_compilable(model):
+        logging.warning(f"Compiled serving disabled for {model_name}: the model doesn't support a static KV cache")
+        return None, replaced
+    max_context = compiled_config.get('max_context', 2048)
+    try:
+        # the model isn't in the pool yet, so room is made for both
+        cache_size = get_static_cache_size(model, model_pool.max_batch_size, max_context)
+        replaced = model_pool.make_room(get_model_memory_size(model) + cache_size, replaced, keep)
+        compiled_decoder = CompiledDecoder(model, model_pool.max_batch_size, max_context)
+        compiled_decoder.warm_up()
+    except Exception as e:
+        logging.warning(f"Compiled serving disabled for {model_name}: {e}", exc_info=True)
+        return None, replaced
+    logging.debug(f"Compiled serving enabled for {model_name}: max_context={compiled_decoder.max_context}")
+    return compiled_decoder, replaced
+
 async def setup_model_if_not_running(model_name: str):
-    global tokenizer, model, current_model_name
+    if worker_pool.is_enabled():
+        # workers load models themselves, the model only has to be on disk
+        await model_storage.get_model_dir(model_name)
+        return
 
-    model_path = await model_storage.get_model_dir(model_name)
+    if model_pool.is_loaded(model_name):
+        logging.debug(f"Model already loaded: {model_name}")
+        return
+
+    # the model loads in the background while the resident models keep
+    # serving, and a request that goes away doesn't cancel the load
+    task = _loads.get(model_name)
+    if task is None:
+        task = asyncio.ensure_future(_load(model_name))
+        _loads[model_name] = task
+        task.add_done_callback(lambda _: _on_load_done(model_name, task))
+    await asyncio.shield(task)
 
+async def warm_up_model(model_name: str):
+    """
+    Run a short synthetic generation on a model that is set up, so its
+    weights are paged in and its kernels are ready before the first request.
+    """
+    request = CompletionRequest(model=model_name, prompt=WARM_UP_PROMPT, max_tokens=WARM_UP_MAX_TOKENS)
+    if worker_pool.is_enabled():
+        await worker_pool.warm_up(request)
+        return
+    # straight to generation, the response cache has no use for it
+    await _create_completion(request)
+
+async def _acquire_model(model_name: str) -> LoadedModel:
     try:
-        if model is None:
-            logging.debug(f"No model loaded, loading {model_name} from {model_path}...")
-            tokenizer = AutoTokenizer.from_pretrained(model_path)
-            if tokenizer.pad_token is None:
-                if tokenizer.eos_token:
-                    tokenizer.pad_token = tokenizer.eos_token
-                else:
-                    tokenizer.add_special_tokens({'pad_token': '[PAD]'})
-                    # Make sure to resize model embeddings if you're adding a new token
-                    model.resize_token_embeddings(len(tokenizer))
-            model = AutoModelForCausalLM.from_pretrained(
-                model_path,
-                device_map="auto",
-                pad_token_id=0
+        return model_pool.acquire(model_name)
+    except ModelNotLoaded:
+        # replaced by another model since it was set up, load it again
+        await setup_model_if_not_running(model_name)
+        return model_pool.acquire(model_name)
+
+def _on_load_done(model_name: str, task: asyncio.Task):
+    _loads.pop(model_name, None)
+    if not task.cancelled():
+        # retrieved even if every waiting request went away, _load logged it
+        task.exception()
+
+async def _load(model_name: str):
+    engine_config = model_pool.get_engine_config(model_name)
+    engine_name = engine_config.pop('engine')
+    if engine_name != 'transformers':
+        await _load_on_engine(model_name, engine_name, engine_config)
+        return
+
+    speculative_config = model_pool.speculative_decoding.get(model_name)
+    if speculative_config is not None and speculative_config['draft_model'].lower() != model_name:
+        # the draft model is loaded like any other model, and shared with
+        # requests that run on it directly
+        await setup_model_if_not_running(speculative_config['draft_model'].lower())
+
+    model_path = await model_storage.get_model_dir(model_name)
+    precision = resolve_load_precision(model_pool.get_load_precision(model_name), device)
+    quantized_path = None
+    if precision == "int8":
+        quantized_path = model_storage.get_quantized_model_path(model_name, precision)
+
+    async with _load_lock:
+        # hold the draft model before making room, so it is not evicted
+        draft = _acquire_draft_model(model_name)
+        keep = [draft.name] if draft is not None else []
+        try:
+            # models that have to go are evicted first, their running requests still finish
+            if quantized_path is not None and os.path.exists(quantized_path):
+                replaced = model_pool.make_room(os.path.getsize(quantized_path), keep=keep)
+            else:
+                load_dtype = _get_load_dtype(precision, model_pool.mmap_weights)
+                replaced = model_pool.make_room(estimate_model_dir_size(model_path, load_dtype), keep=keep)
+
+            logging.debug(f"Loading {model_name} from {model_path} ({precision})...")
+            tokenizer, model = await inference_executor.run(
+                _load_model, model_path, precision, quantized_path, model_pool.mmap_weights
+            )
+            speculative_decoder = None
+            if draft is not None:
+                speculative_decoder = _create_speculative_decoder(model_name, model, tokenizer, draft)
+                if speculative_decoder is None:
+                    model_pool.release(draft)
+                    draft = None
+            # compiled before the model is added, so requests never wait for it
+            compiled_decoder, replaced = await inference_executor.run(_create_compiled_decoder, model_name, model, replaced, keep)
+            scheduler = Scheduler(
+                model, tokenizer,
+                max_batch_size=model_pool.max_batch_size,
+                prefill_chunk_size=model_pool.prefill_chunk_size,
+                speculative_decoder=speculative_decoder,
+                compiled_decoder=compiled_decoder,
             )
-            current_model_name = model_name
-            model.to(device)
+            size_bytes = get_model_memory_size(model)
+            if compiled_decoder is not None:
+                size_bytes += compiled_decoder.size_bytes
+            model_pool.add(LoadedModel(model_name, model, tokenizer, scheduler, size_bytes, draft), replaced)
             logging.debug(f"Model loaded: {model_name}")
-        elif model_name != current_model_name:
-            logging.debug(f"Model changed, loading {model_name} from {model_path}...")
-            tokenizer = AutoTokenizer.from_pretrained(model_path)
-            if tokenizer.pad_token is None:
-                if tokenizer.eos_token:
-                    tokenizer.pad_token = tokenizer.eos_token
-                else:
-                    tokenizer.add_special_tokens({'pad_token': '[PAD]'})
-                    # Make sure to resize model embeddings if you're adding a new token
-                    model.resize_token_embeddings(len(tokenizer))
-            model = AutoModelForCausalLM.from_pretrained(
-                model_path,
-                device_map="auto",
-                pad_token_id=0
+        except Exception as e:
+            if draft is not None:
+                model_pool.release(draft)
+            logging.error(f"Failed to load model: {e}", exc_info=True)
+            raise e
+
+async def _load_on_engine(model_name: str, engine_name: str, options: dict):
+    model_path = await model_storage.get_model_dir(model_name)
+    async with _load_lock:
+        try:
+            # the stub engine loads no weights
+            required_bytes = estimate_model_dir_size(model_path) if engine_name != 'stub' else 0
+            replaced = model_pool.make_room(required_bytes)
+            logging.debug(f"Loading {model_name} from {model_path} on the {engine_name} engine...")
+            engine = await inference_executor.run(
+                load_engine, engine_name, model_path, model_pool.max_batch_size, **options
             )
-            current_model_name = model_name
-            model.to(device)
+            model_pool.add(LoadedModel(model_name, None, engine.tokenizer, engine, engine.size_bytes), replaced)
             logging.debug(f"Model loaded: {model_name}")
-        else:
-            logging.debug(f"Model already loaded: {model_name}")
-    except Exception as e:
-        logging.error(f"Failed to load model: {e}", exc_info=True)
-        raise e
+        except Exception as e:
+            logging.error(f"Failed to load model: {e}", exc_info=True)
+            raise e
 
 def parse_prompt_format(prompt) -> Tuple[bool, list]:
     # get the prompt, openai supports the following
@@ -86,7 +296,7 @@ def parse_prompt_format(prompt) -> Tuple[bool, list]:
         elif isinstance(prompt[0], int):
             prompt_is_tokens = True
             prompts = [prompt]  # case 3: array of tokens
-        elif isinstance(prompt[0], list) and isinstance(prompt[0][0], int):
+        elif isinstance(prompt[0], list) and (not prompt[0] or isinstance(prompt[0][0], int)):
             prompt_is_tokens = True
             prompts = prompt  # case 4: array of token arrays
         else:
@@ -94,63 +304,372 @@ def parse_prompt_format(prompt) -> Tuple[bool, list]:
                              "array of tokens, or array of token arrays")
     return prompt_is_tokens, prompts
 
-def create_completion(request: CompletionRequest) -> (
-        Union[str, TextIteratorStreamer],
+def _get_guide(loaded: LoadedModel, request: Union[CompletionRequest, ChatCompletionRequest]) -> Union[Guide, None]:
+    # compiling a guide is CPU heavy, run it on the inference executor
+    guided_decoding = request.get_guided_decoding()
+    if guided_decoding is None:
+        return None
+    if not loaded.engine.supports_guided_decoding:
+        raise ValueError(f"guided decoding is not supported on {loaded.name}")
+    kind, spec = guided_decoding
+    return guide_cache.get_guide(
+        loaded.name, loaded.tokenizer, loaded.engine.vocab_size, loaded.engine.eos_token_ids, kind, spec
+    )
+
+def _consume_tokens(budget: Union[TokenBudget, None], num_tokens: int):
+    # the prompt is billed too, a session that can't pay for it gets nothing generated
+    if budget is not None and not budget.consume(num_tokens):
+        raise ValueError("request would exceed session cost limit")
+
+def _is_budget_intact(budget: Union[TokenBudget, None]) -> bool:
+    # output cut short by the session's budget must not be served to others
+    return budget is None or not budget.is_exhausted
+
+def _is_before_deadline(deadline: Union[float, None]) -> bool:
+    # nor must output that may have been cut short by the request's deadline
+    return deadline is None or time.monotonic() < deadline
+
+def _check_expired(sequences: List[Sequence]):
+    if any(sequence.is_expired for sequence in sequences):
+        raise DeadlineExceeded("the request can't be served before its deadline")
+
+def _check_failed(sequences: List[Sequence]):
+    # "error" and "cancelled" aren't finish reasons of the API, a request
+    # that ended with them gets an error instead of its partial choices
+    if any(sequence.finish_reason in FAILED_FINISH_REASONS for sequence in sequences):
+        raise GenerationFailed("generation failed")
+
+def _is_deterministic(request: Union[CompletionRequest, ChatCompletionRequest]) -> bool:
+    """
+    Whether a request always produces the same output, so its response
+    can be cached: every sequence the engine generates for it is decoded
+    greedily or sampled from a fixed seed. Requests that leave sampling up
+    to the model's default are treated as not deterministic.
+    """
+    if request.temperature == 0 or request.seed is not None:
+        return True
+    if max(request.n or 1, getattr(request, "best_of", None) or 1) > 1:
+        # the sequences of a prompt are always sampled, see _fork_sequences
+        return False
+    if model_pool.get_engine_config(request.model.lower())['engine'] != 'transformers':
+        # other engines sample at any other temperature
+        return False
+    return request.to_generate_params().get("do_sample") is False
+
+def _cache_params(request: Union[CompletionRequest, ChatCompletionRequest]) -> dict:
+    # everything that can change the output, the prompt is keyed separately
+    return request.model_dump(exclude={"model", "prompt", "messages", "stream", "user"})
+
+async def _get_or_create_cached(key: str, create, budget: Union[TokenBudget, None], deadline: Union[float, None]):
+    """
+    The response cache's result for `key`, or `create()`'s. A result this
+    request didn't generate is billed like one it did, so it is only served
+    to a session that can pay for all of its tokens.
+    """
+    if budget is not None and budget.is_exhausted:
+        raise ValueError("request would exceed session cost limit")
+    created = False
+
+    async def create_here():
+        nonlocal created
+        created = True
+        return await create()
+
+    result = await response_cache.get_or_create(
+        key, create_here,
+        is_cacheable=lambda _: _is_budget_intact(budget) and _is_before_deadline(deadline)
+    )
+    if not created:
+        _, _, num_input_tokens, num_output_tokens = result
+        _consume_tokens(budget, num_input_tokens + num_output_tokens)
+    return result
+
+def _get_num_choices(n: int, best_of: int = None, stream: bool = False) -> Tuple[int, int]:
+    """
+    Validate `n` and `best_of`, returning how many choices to return per
+    prompt and how many sequences to generate for them.
+    """
+    n = n if n is not None else 1
+    best_of = best_of if best_of is not None else n
+    if n < 1:
+        raise ValueError("n must be at least 1")
+    if best_of < n:
+        raise ValueError("best_of must be greater than or equal to n")
+    if stream and best_of > n:
+        raise ValueError("best_of can not be larger than n when streaming")
+    # every sequence takes a batch slot and a copy of the prompt's KV cache
+    if model_pool.max_best_of is not None and best_of > model_pool.max_best_of:
+        raise ValueError(f"n and best_of must be at most {model_pool.max_best_of}")
+    return n, best_of
+
+def _fork_sequences(input_ids: List[int], num_sequences: int, streamers: list = None, **sequence_params) -> List[Sequence]:
+    """
+    Create `num_sequences` sequences for the same prompt. They share one
+    prefill, only their continuations are sampled separately.
+
+    At a temperature of 0 they would all decode the same tokens, so a
+    single sequence is created instead, streaming to all `streamers`; see
+    _best_sequences for their choices.
+    """
+    if num_sequences > 1 and sequence_params.get("temperature") == 0:
+        streamer = TeeStreamer(streamers) if streamers is not None else None
+        return [Sequence(input_ids, streamer=streamer, **sequence_params)]
+    prefill_group = object() if num_sequences > 1 else None
+    if num_sequences > 1:
+        # greedy decoding would give every fork the same continuation
+        sequence_params["do_sample"] = True
+    sequences = []
+    for i in range(num_sequences):
+        params = dict(sequence_params)
+        if params.get("seed") is not None:
+            # every fork draws its own sample
+            params["seed"] += i
+        if i > 0:
+            # only the first sequence prefills the prompt and saves the KV cache
+            params.update(cached_past=None, num_cached_tokens=0, cache_callback=None)
+        sequences.append(Sequence(
+            input_ids,
+            streamer=streamers[i] if streamers is not None else None,
+            prefill_group=prefill_group,
+            **params
+        ))
+    return sequences
+
+def _best_sequences(sequences: List[Sequence], n: int) -> List[Sequence]:
+    """
+    Keep the `n` sequences with the highest cumulative logprob. The single
+    sequence of a greedy request stands for all `n` of its choices.
+    """
+    if len(sequences) == 1:
+        return sequences * n
+    return sorted(sequences, key=lambda seq: seq.cumulative_logprob, reverse=True)[:n]
+
+def _submit(loaded: LoadedModel, sequences: List[Sequence]) -> List[Sequence]:
+    """
+    Hand sequences to the model's engine. Takes over the caller's
+    reference on the model, which is held until every sequence is done.
+    """
+    for i, sequence in enumerate(sequences):
+        if i > 0:
+            model_pool.retain(loaded)
+        sequence.add_done_callback(lambda _: model_pool.release(loaded))
+    loaded.engine.submit_all(sequences)
+    return sequences
+
+async def _wait_for(sequence: Sequence, started: bool = False) -> Sequence:
+    """
+    Wait for a sequence to finish, or with `started` only until its prompt
+    has been prefilled, without blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def set_result(seq):
+        if not future.done():
+            future.set_result(seq)
+
+    add_callback = sequence.add_start_callback if started else sequence.add_done_callback
+    add_callback(lambda seq: loop.call_soon_threadsafe(set_result, seq))
+    return await future
+
+async def _wait_for_all(sequences: List[Sequence], started: bool = False):
+    """
+    Wait for every sequence as _wait_for does. Raises DeadlineExceeded if
+    one of them was dropped for its deadline, or GenerationFailed if one
+    failed. The sequences are cancelled if this raises, or is cancelled
+    itself, e.g. by a worker process whose client went away.
+    """
+    try:
+        await asyncio.gather(*[_wait_for(sequence, started) for sequence in sequences])
+        _check_expired(sequences)
+        _check_failed(sequences)
+    except BaseException:
+        for sequence in sequences:
+            sequence.cancel()
+        raise
+
+def _to_choice_output(tokenizer, sequence: Sequence, echo: bool = False) -> ChoiceOutput:
+    """
+    Decode a finished sequence, without its stop string and anything the
+    token that completed it generated after it.
+    """
+    if not echo:
+        text = tokenizer.decode(sequence.output_ids, skip_special_tokens=True)
+        text = truncate_at_stop(text, sequence.stop)
+    else:
+        # the prompt may contain a stop string too, only the output is cut
+        prompt_text = tokenizer.decode(sequence.input_ids, skip_special_tokens=True)
+        text = tokenizer.decode(sequence.input_ids + sequence.output_ids, skip_special_tokens=True)
+        text = truncate_at_stop(text, sequence.stop, len(prompt_text))
+
+    logprobs = None
+    if sequence.num_logprobs is not None:
+        logprobs = decode_logprobs(tokenizer, sequence.output_logprobs, sequence.input_ids)
+        if echo and sequence.prompt_logprobs is not None:
+            logprobs = decode_logprobs(tokenizer, sequence.prompt_logprobs) + logprobs
+        logprobs = truncate_logprobs(logprobs, len(text))
+    return ChoiceOutput(text, sequence.finish_reason, logprobs)
+
+def _to_choice_outputs(tokenizer, sequences: List[Sequence], echo: bool = False) -> List[ChoiceOutput]:
+    # decoding logprobs takes a few decodes per token, so this runs on the executor
+    return [_to_choice_output(tokenizer, sequence, echo) for sequence in sequences]
+
+def _tokenize_prompts(tokenizer, prompt, vocab_size: int) -> List[List[int]]:
+    prompt_is_tokens, prompts = parse_prompt_format(prompt)
+    if not prompt_is_tokens:
+        prompts = tokenizer(prompts, truncation=True).input_ids
+    # prompts are prefilled in one batch, a bad one must not fail the others
+    for input_ids in prompts:
+        if not input_ids:
+            raise ValueError("prompts must not be empty")
+        if prompt_is_tokens and not all(0 <= token_id < vocab_size for token_id in input_ids):
+            raise ValueError(f"prompt token ids must be between 0 and {vocab_size - 1}")
+    return prompts
+
+async def create_completion(request: CompletionRequest, budget: TokenBudget = None, deadline: float = None) -> (
+        Union[List[ChoiceOutput], AsyncStreamGroup],
         Union[PreTrainedTokenizer, PreTrainedTokenizerFast, None],
         int, Union[int, None]
     ):
-    generate_params = request.to_generate_params()
-    _, prompts = parse_prompt_format(request.prompt)
+    """
+    Run a completion request. Every prompt becomes `best_of` sequences
+    sharing one prefill, and all of them are batched by the engine. The
+    result holds `n` choices per prompt, in order, or a stream of deltas
+    tagged with their choice index.
 
-    inputs = tokenizer(prompts, return_tensors="pt", padding=True, truncation=True).to(device)
-    num_input_tokens = inputs.input_ids.shape[1]
+    Generation stops once the session's `budget` runs out, or at the
+    `deadline` (in time.monotonic()). Raises DeadlineExceeded if a prompt
+    couldn't even be prefilled before the deadline, streamed or not; a
+    stream is only returned once all of its prompts are prefilled. Raises
+    GenerationFailed if the engine failed the request's sequences.
+    """
+    if not request.stream and response_cache.is_enabled() and _is_deterministic(request):
+        _, prompts = parse_prompt_format(request.prompt)
+        key = make_cache_key("completion", request.model.lower(), prompts, _cache_params(request))
+        return await _get_or_create_cached(key, lambda: _create_completion(request, budget, deadline), budget, deadline)
+    return await _create_completion(request, budget, deadline)
 
-    if request.stream:
-        streamer = TextIteratorStreamer(
-            tokenizer,
-            skip_prompt=(not request.echo),
+async def _create_completion(request: CompletionRequest, budget: TokenBudget = None, deadline: float = None):
+    if worker_pool.is_enabled():
+        return await worker_pool.create_completion(request, budget, deadline)
+
+    n, best_of = _get_num_choices(request.n, request.best_of, request.stream)
+    loaded = await _acquire_model(request.model.lower())
+    tokenizer = loaded.tokenizer
+    try:
+        sequence_params = loaded.engine.to_sequence_params(request)
+        sequence_params["guide"] = await inference_executor.run(_get_guide, loaded, request)
+        prompts_input_ids = await inference_executor.run(
+            _tokenize_prompts, tokenizer, request.prompt, loaded.engine.vocab_size
         )
+        num_input_tokens = sum(len(input_ids) for input_ids in prompts_input_ids)
+        _consume_tokens(budget, num_input_tokens)
+    except BaseException:
+        model_pool.release(loaded)
+        raise
+    sequence_params.update(budget=budget, deadline=deadline)
+
+    if request.stream:
+        stream_group = AsyncStreamGroup()
+        sequences = []
+        for input_ids in prompts_input_ids:
+            streamers = [
+                stream_group.add_streamer(tokenizer, skip_prompt=(not request.echo), stop=sequence_params["stop"])
+                for _ in range(n)
+            ]
+            sequences.extend(_fork_sequences(input_ids, n, streamers, **sequence_params))
+        for sequence in sequences:
+            stream_group.add_cancel_callback(sequence.cancel)
+        _submit(loaded, sequences)
+        # a stream can't report an error once its response has started
+        await _wait_for_all(sequences, started=True)
+
+        return stream_group, tokenizer, num_input_tokens, None
 
-        generation_kwargs = dict(inputs, streamer=streamer, **generate_params)
-        thread = Thread(target=model.generate, kwargs=generation_kwargs)
-        thread.start()
+    prompts_sequences = [
+        _fork_sequences(input_ids, best_of, **sequence_params)
+        for input_ids in prompts_input_ids
+    ]
+    sequences = _submit(loaded, [sequence for group in prompts_sequences for sequence in group])
+    await _wait_for_all(sequences)
 
-        return streamer, tokenizer, num_input_tokens, None
-    
-    outputs = model.generate(**inputs, **generate_params)
-    num_output_tokens = outputs.shape[1] - num_input_tokens
-    outputs_to_decode = outputs[0]
-    if not request.echo:
-        outputs_to_decode = outputs[0, num_input_tokens:]
-    response_text = tokenizer.decode(outputs_to_decode, skip_special_tokens=True)
+    # every generated token is billed, including those of discarded best_of candidates
+    num_output_tokens = sum(len(sequence.output_ids) for sequence in sequences)
+    choices = await inference_executor.run(
+        _to_choice_outputs, tokenizer,
+        [sequence for group in prompts_sequences for sequence in _best_sequences(group, n)],
+        request.echo,
+    )
 
-    return response_text, tokenizer, num_input_tokens, num_output_tokens
+    return choices, tokenizer, num_input_tokens, num_output_tokens
 
-def create_chat_completion(request: ChatCompletionRequest) -> (
-        Union[str, TextIteratorStreamer],
+async def create_chat_completion(
+        request: ChatCompletionRequest, session_id: int = None, budget: TokenBudget = None, deadline: float = None
+    ) -> (
+        Union[List[ChoiceOutput], AsyncStreamGroup],
         Union[PreTrainedTokenizer, PreTrainedTokenizerFast, None],
         int, Union[int, None]
     ):
-    generate_params = request.to_generate_params()
-    
-    tokenized_chat = tokenizer.apply_chat_template(request.messages, tokenize=True, add_generation_prompt=True, return_tensors="pt").to(device)
-    num_input_tokens = tokenized_chat.shape[1]
+    """
+    Run a chat completion request, generating `n` choices that share one
+    prefill of the conversation. Generation stops once the session's
+    `budget` runs out, or at the `deadline`, as in create_completion.
+    """
+    if not request.stream and response_cache.is_enabled() and _is_deterministic(request):
+        key = make_cache_key("chat_completion", request.model.lower(), request.messages, _cache_params(request))
+        return await _get_or_create_cached(
+            key, lambda: _create_chat_completion(request, session_id, budget, deadline), budget, deadline
+        )
+    return await _create_chat_completion(request, session_id, budget, deadline)
 
-    if request.stream:
-        streamer = TextIteratorStreamer(
-            tokenizer,
-            skip_prompt=True
+async def _create_chat_completion(
+    request: ChatCompletionRequest, session_id: int = None, budget: TokenBudget = None, deadline: float = None
+):
+    if worker_pool.is_enabled():
+        return await worker_pool.create_chat_completion(request, session_id, budget, deadline)
+
+    n, _ = _get_num_choices(request.n)
+    loaded = await _acquire_model(request.model.lower())
+    tokenizer = loaded.tokenizer
+    try:
+        sequence_params = loaded.engine.to_sequence_params(request)
+        sequence_params["guide"] = await inference_executor.run(_get_guide, loaded, request)
+        input_ids = await inference_executor.run(
+            tokenizer.apply_chat_template,
+            request.messages, tokenize=True, add_generation_prompt=True
         )
+        num_input_tokens = len(input_ids)
+        _consume_tokens(budget, num_input_tokens)
+    except BaseException:
+        model_pool.release(loaded)
+        raise
+    sequence_params.update(budget=budget, deadline=deadline)
+
+    if loaded.engine.supports_prefix_cache:
+        # reuse the KV cache of the session's previous turn, and keep this one
+        # around for the next turn
+        num_cached_tokens, cached_past = prefix_cache.get(loaded.name, session_id, input_ids)
+        sequence_params.update(
+            cached_past=cached_past,
+            num_cached_tokens=num_cached_tokens,
+            cache_callback=lambda token_ids, past: prefix_cache.put(loaded.name, session_id, token_ids, past),
+        )
+
+    if request.stream:
+        stream_group = AsyncStreamGroup()
+        streamers = [stream_group.add_streamer(tokenizer, skip_prompt=True, stop=sequence_params["stop"]) for _ in range(n)]
+        sequences = _fork_sequences(input_ids, n, streamers, **sequence_params)
+        for sequence in sequences:
+            stream_group.add_cancel_callback(sequence.cancel)
+        _submit(loaded, sequences)
+        # a stream can't report an error once its response has started
+        await _wait_for_all(sequences, started=True)
 
-        generation_kwargs = dict(streamer=streamer, **generate_params)
-        thread = Thread(target=model.generate, args=(tokenized_chat,), kwargs=generation_kwargs)
-        thread.start()
+        return stream_group, tokenizer, num_input_tokens, None
 
-        return streamer, tokenizer, num_input_tokens, None
-    
-    outputs = model.generate(tokenized_chat, **generate_params)
-    num_output_tokens = outputs.shape[1] - num_input_tokens
-    outputs_to_decode = outputs[0, num_input_tokens:]
-    response_text = tokenizer.decode(outputs_to_decode, skip_special_tokens=True)
+    sequences = _submit(loaded, _fork_sequences(input_ids, n, **sequence_params))
+    await _wait_for_all(sequences)
+    num_output_tokens = sum(len(sequence.output_ids) for sequence in sequences)
+    choices = await inference_executor.run(_to_choice_outputs, tokenizer, _best_sequences(sequences, n))
 
-    return response_text, tokenizer, num_input_tokens, num_output_tokens
+    return choices, tokenizer, num_input_tokens, num_output_tokens
@@ -0,0 +1,249 @@
+from threading import Lock
+from typing import List, Optional, Tuple
+import torch
+from .logits_processors import BatchLogitsProcessor
+from .scheduler import Sequence, _Batch, _top_p_filter
+
+# share of the target's vocabulary a draft model with another vocabulary
+# must have too, with less too few of its proposals would be accepted
+MIN_SHARED_VOCAB_FRACTION = 0.5
+
+
+def _next_token_distribution(
+    logits: torch.Tensor, seq: Sequence, logits_processors: List[BatchLogitsProcessor] = ()
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    The distribution the scheduler samples the next token of `seq` from, for
+    every row of `logits`, together with the logprobs it reports for it.
+    Greedy sequences get a one-hot distribution on the argmax.
+    """
+    logits = logits.float()
+    for processor in logits_processors:
+        logits = processor(None, logits)
+    if not seq.do_sample:
+        probs = torch.zeros_like(logits)
+        probs.scatter_(1, logits.argmax(dim=-1, keepdim=True), 1.0)
+        return probs, logits.log_softmax(dim=-1)
+
+    logits = logits / seq.temperature
+    if seq.top_p < 1.0:
+        top_p = torch.full((logits.shape[0], 1), seq.top_p, device=logits.device)
+        logits = _top_p_filter(logits, top_p)
+    logprobs = logits.log_softmax(dim=-1)
+    return logprobs.exp(), logprobs
+
+
+class VocabTranslation:
+    """
+    Maps between the vocabulary of a target model and the other vocabulary
+    of its draft model, through the tokens whose strings are in both.
+
+    The draft model reads the context with every token it doesn't have
+    replaced by its unknown token, and its logits are moved to the target's
+    vocabulary, where it can only propose the shared tokens. Rejection
+    sampling is exact for any proposal distribution, so the output still
+    follows the target model, only fewer proposals are accepted.
+    """
+    def __init__(self, tokenizer, draft_tokenizer, vocab_size: int, draft_vocab_size: int):
+        draft_vocab = draft_tokenizer.get_vocab()
+        shared = [
+            (token_id, draft_vocab[token]) for token, token_id in tokenizer.get_vocab().items()
+            if token in draft_vocab and token_id < vocab_size and draft_vocab[token] < draft_vocab_size
+        ]
+        self.vocab_size = vocab_size
+        self.num_shared_tokens = len(shared)
+
+        unk_token_id = draft_tokenizer.unk_token_id if draft_tokenizer.unk_token_id is not None else 0
+        self._to_draft = [unk_token_id] * vocab_size
+        for token_id, draft_id in shared:
+            self._to_draft[token_id] = draft_id
+        self._token_ids = torch.tensor([token_id for token_id, _ in shared])
+        self._draft_ids = torch.tensor([draft_id for _, draft_id in shared])
+
+    def to_draft_ids(self, token_ids: List[int]) -> List[int]:
+        return [self._to_draft[token_id] for token_id in token_ids]
+
+    def to_target_logits(self, draft_logits: torch.Tensor) -> torch.Tensor:
+        device = draft_logits.device
+        logits = draft_logits.new_full((draft_logits.shape[0], self.vocab_size), float("-inf"))
+        logits[:, self._token_ids.to(device)] = draft_logits[:, self._draft_ids.to(device)]
+        return logits
+
+
+class SpeculativeDecoder:
+    """
+    Speculative decoding with a smaller draft model. A draft model with
+    another vocabulary than the target's speculates through a
+    `translation`, see VocabTranslation.
+
+    The draft model proposes up to `num_speculative_tokens` tokens, one at a
+    time, and the target model scores all of them in a single forward pass.
+    Proposals are accepted by rejection sampling against the target
+    distribution, so the output is distributed exactly as if the target
+    model had generated it alone. Every step yields at least one token.
+
+    Only a single running sequence is speculated at a time; the draft KV
+    cache of that sequence is kept between steps.
+    """
+    def __init__(
+        self, draft_name: str, draft_model, num_speculative_tokens: int = 4,
+        translation: Optional[VocabTranslation] = None
+    ):
+        self.draft_name = draft_name
+        self.draft_model = draft_model
+        self.num_speculative_tokens = num_speculative_tokens
+        self.translation = translation
+
+        self.num_draft_tokens = 0
+        self.num_accepted_tokens = 0
+        self._stats_lock = Lock()
+
+        self._sequence = None
+        self._draft_past = None
+        self._draft_length = 0
+
+    @property
+    def acceptance_rate(self) -> float:
+        if self.num_draft_tokens == 0:
+            return 0.0
+        return self.num_accepted_tokens / self.num_draft_tokens
+
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                'draft_model': self.draft_name,
+                'num_speculative_tokens': self.num_speculative_tokens,
+                'num_draft_tokens': self.num_draft_tokens,
+                'num_accepted_tokens': self.num_accepted_tokens,
+                'acceptance_rate': self.acceptance_rate,
+            }
+
+    def reset(self):
+        """
+        Drop the draft KV cache, e.g. once its sequence has finished.
+        """
+        self._sequence = None
+        self._draft_past = None
+        self._draft_length = 0
+
+    @torch.inference_mode()
+    def step(self, model, batch: _Batch, num_tokens: int) -> Tuple[List[int], List[float]]:
+        """
+        Generate up to `num_tokens + 1` tokens for the only sequence of
+        `batch`. Returns the tokens with their logprobs; the batch's KV cache
+        then holds every token but the last one returned.
+        """
+        seq = batch.sequences[0]
+        context = seq.input_ids + seq.output_ids
+        draft_ids, draft_probs = self._draft(seq, context, num_tokens, batch.logits_processors)
+
+        # the last sampled token and all proposals go through the target at once
+        num_columns = batch.cache_length
+        cache_length = int(batch.attention_mask.sum())
+        input_ids = torch.tensor([context[-1:] + draft_ids], device=model.device)
+        attention_mask = torch.cat([
+            batch.attention_mask,
+            batch.attention_mask.new_ones((1, input_ids.shape[1])),
+        ], dim=1)
+        position_ids = torch.arange(cache_length, cache_length + input_ids.shape[1], device=model.device).unsqueeze(0)
+
+        outputs = model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=batch.past_key_values,
+            use_cache=True,
+        )
+        target_probs, target_logprobs = _next_token_distribution(outputs.logits[0], seq, batch.logits_processors)
+        draft_probs = draft_probs.to(target_probs.device)
+
+        token_ids = []
+        for i, draft_id in enumerate(draft_ids):
+            # accept with probability min(1, p / q)
+            if torch.rand((), generator=seq.generator, device=target_probs.device) < target_probs[i, draft_id] / draft_probs[i, draft_id]:
+                token_ids.append(draft_id)
+                continue
+            # on rejection, resample from the part of p that q does not cover
+            residual = (target_probs[i] - draft_probs[i]).clamp(min=0)
+            token_ids.append(int(torch.multinomial(residual / residual.sum(), num_samples=1, generator=seq.generator)))
+            break
+        else:
+            # every proposal was accepted, the target gives one more token for free
+            token_ids.append(int(torch.multinomial(target_probs[len(draft_ids)], num_samples=1, generator=seq.generator)))
+        num_accepted = len(token_ids) - 1
+
+        # drop the cache entries of rejected proposals
+        length = num_columns + len(token_ids)
+        batch.attention_mask = attention_mask[:, :length]
+        batch.past_key_values = tuple(
+            (k[:, :, :length], v[:, :, :length]) for k, v in outputs.past_key_values
+        )
+        draft_length = min(self._draft_length, len(context) + num_accepted)
+        self._draft_past = tuple(
+            (k[:, :, :draft_length], v[:, :, :draft_length]) for k, v in self._draft_past
+        )
+        self._draft_length = draft_length
+
+        with self._stats_lock:
+            self.num_draft_tokens += len(draft_ids)
+            self.num_accepted_tokens += num_accepted
+
+        logprobs = [float(target_logprobs[i, token_id]) for i, token_id in enumerate(token_ids)]
+        return token_ids, logprobs
+
+    def _draft(
+        self, seq: Sequence, context: List[int], num_tokens: int, logits_processors: List[BatchLogitsProcessor]
+    ) -> Tuple[List[int], torch.Tensor]:
+        if self._sequence is not seq:
+            self.reset()
+            self._sequence = seq
+
+        # catch the draft model up on every token it has not seen yet, which
+        # is the whole prompt the first time a sequence is speculated
+        input_ids = self._to_draft_ids(context[self._draft_length:])
+        draft_ids = []
+        draft_probs = []
+        for _ in range(num_tokens):
+            outputs = self.draft_model(
+                input_ids=torch.tensor([input_ids], device=self.draft_model.device),
+                position_ids=torch.arange(
+                    self._draft_length, self._draft_length + len(input_ids), device=self.draft_model.device
+                ).unsqueeze(0),
+                past_key_values=self._draft_past,
+                use_cache=True,
+            )
+            self._draft_past = outputs.past_key_values
+            self._draft_length += len(input_ids)
+
+            logits = outputs.logits[0, -1:]
+            if self.translation is not None:
+                logits = self.translation.to_target_logits(logits)
+            # the draft proposes from the same processed distribution, so
+            # biased tokens are accepted as often as they would be sampled
+            probs, _ = _next_token_distribution(logits, seq, logits_processors)
+            draft_id = int(torch.multinomial(probs[0], num_samples=1, generator=seq.generator))
+            draft_ids.append(draft_id)
+            draft_probs.append(probs[0])
+            input_ids = self._to_draft_ids([draft_id])
+
+        return draft_ids, torch.stack(draft_probs)
+
+    def _to_draft_ids(self, token_ids: List[int]) -> List[int]:
+        if self.translation is None:
+            return token_ids
+        return self.translation.to_draft_ids(token_ids)
+
+
+def create_vocab_translation(model, tokenizer, draft_model, draft_tokenizer) -> Optional[VocabTranslation]:
+    """
+    The translation the draft model speculates for the target model
+    through, None if both have the same vocabulary. Raises ValueError if
+    they share too little of it for speculation to pay off.
+    """
+    vocab = tokenizer.get_vocab()
+    if vocab == draft_tokenizer.get_vocab() and model.config.vocab_size == draft_model.config.vocab_size:
+        return None
+    translation = VocabTranslation(tokenizer, draft_tokenizer, model.config.vocab_size, draft_model.config.vocab_size)
+    if translation.num_shared_tokens < MIN_SHARED_VOCAB_FRACTION * len(vocab):
+        raise ValueError(f"only {translation.num_shared_tokens} of its {len(vocab)} tokens are in the draft's vocabulary")
+    return translation
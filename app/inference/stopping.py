@@ -0,0 +1,66 @@
+from typing import List
+from .detokenizer import IncrementalDetokenizer
+
+
+def find_stop(text: str, stop: List[str], start: int = 0) -> int:
+    """
+    Index of the first stop string in `text[start:]`, or -1 if there is none.
+    """
+    indices = [index for index in (text.find(s, start) for s in stop) if index >= 0]
+    return min(indices) if indices else -1
+
+def truncate_at_stop(text: str, stop: List[str], start: int = 0) -> str:
+    """
+    Cut `text` at the first stop string after `start`. The stop string
+    itself is not part of the output, as in the OpenAI API.
+    """
+    index = find_stop(text, stop, start)
+    return text[:index] if index >= 0 else text
+
+def get_partial_stop_length(text: str, stop: List[str]) -> int:
+    """
+    Length of the longest end of `text` that is the start of a stop
+    string, i.e. text that can't be streamed yet because it may still turn
+    into a stop string.
+    """
+    for length in range(min(len(text), max(len(s) for s in stop) - 1), 0, -1):
+        suffix = text[-length:]
+        if any(s.startswith(suffix) for s in stop):
+            return length
+    return 0
+
+
+class StopStringChecker:
+    """
+    Detects when a sequence has generated one of its stop strings.
+
+    It is checked after every token, so a stop string always ends in the
+    text of the last one. The output is detokenized incrementally, as it is
+    for streaming: a character split across several tokens only counts
+    once it is complete, and tokens that decode to nothing add nothing.
+    Only a tail of the text as long as the longest stop string is kept, so
+    a check costs the same however long the output gets.
+    """
+    def __init__(self, stop: List[str], prompt_ids: List[int] = None):
+        self.stop = stop
+        self.max_length = max(len(s) for s in stop)
+        # the end of the prompt, as context for the first token's leading space
+        self.prompt_ids = list(prompt_ids or [])[-IncrementalDetokenizer.PROMPT_CONTEXT_TOKENS:]
+        self.detokenizer = None
+        # output ids the detokenizer has seen
+        self.num_ids = 0
+        self.text = ""
+
+    def is_stopped(self, tokenizer, output_ids: List[int]) -> bool:
+        if self.detokenizer is None:
+            self.detokenizer = IncrementalDetokenizer(tokenizer, self.prompt_ids)
+        text = self.detokenizer.add(output_ids[self.num_ids:])
+        self.num_ids = len(output_ids)
+        if not text:
+            return False
+        self.text += text
+        if find_stop(self.text, self.stop) >= 0:
+            return True
+        # a stop string the next tokens may complete starts in the last few characters
+        self.text = self.text[max(len(self.text) - (self.max_length - 1), 0):]
+        return False
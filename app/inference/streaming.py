@@ -0,0 +1,218 @@
+from dataclasses import dataclass, field
+from typing import List, Optional
+from transformers.generation.streamers import BaseStreamer
+from .detokenizer import IncrementalDetokenizer
+from .stopping import find_stop, get_partial_stop_length
+from .logprobs import DecodedLogprob, TokenLogprob, decode_logprobs
+import asyncio
+
+
+@dataclass
+class StreamDelta:
+    text: str
+    # generated token ids this text was decoded from, prompt tokens excluded
+    token_ids: List[int] = field(default_factory=list)
+    # index of the choice the text belongs to
+    index: int = 0
+    # set on the last delta of a choice
+    finish_reason: Optional[str] = None
+    # logprobs of the tokens, for requests that asked for them
+    logprobs: Optional[List[DecodedLogprob]] = None
+
+
+class AsyncTextStreamer(BaseStreamer):
+    """
+    Streamer that hands decoded text from the scheduler thread to an
+    asyncio consumer.
+
+    Must be created on the event loop that will iterate it. The first `put`
+    is the prompt, every following one the newly generated tokens, which
+    are detokenized incrementally and emitted as soon as they are printable.
+    Each item is a StreamDelta carrying the text together with the generated
+    token ids it covers, so usage can be counted without re-tokenizing the
+    text. Items are pushed onto an asyncio.Queue with `call_soon_threadsafe`,
+    so the consumer can `async for` over it without blocking the loop.
+
+    Generated text that may be the start of one of the `stop` strings is
+    held back until it is clear that it isn't, and a stop string and
+    everything after it are never emitted.
+
+    Logprobs added with `add_logprobs` before a `put` belong to its tokens
+    and come out, decoded, with the text of those tokens.
+    """
+    def __init__(
+        self, tokenizer, skip_prompt: bool = False, skip_special_tokens: bool = True,
+        index: int = 0, text_queue: asyncio.Queue = None, stop: List[str] = None
+    ):
+        self.tokenizer = tokenizer
+        self.skip_prompt = skip_prompt
+        self.skip_special_tokens = skip_special_tokens
+        self.index = index
+        self.loop = asyncio.get_running_loop()
+        self.text_queue = text_queue if text_queue is not None else asyncio.Queue()
+        self.stop_signal = None
+
+        self.stop = [s for s in (stop or []) if s]
+
+        # whether deltas carry their token ids, which usage is counted from
+        self.reports_token_ids = True
+
+        self.detokenizer = None
+        self._pending_token_ids = []
+        self._pending_logprobs: List[TokenLogprob] = []
+        self._held_text = ""
+        self._stopped = False
+
+    def _emit(self, text: str, finish_reason: Optional[str] = None):
+        # token ids are held back until the text that contains them is emitted
+        logprobs = None
+        if self._pending_logprobs:
+            # the pending tokens are the last ones the detokenizer has seen
+            context_ids = self.detokenizer.token_ids[:len(self.detokenizer.token_ids) - len(self._pending_logprobs)]
+            logprobs = decode_logprobs(self.tokenizer, self._pending_logprobs, context_ids)
+            self._pending_logprobs = []
+        token_ids = self._pending_token_ids if self.reports_token_ids else []
+        delta = StreamDelta(text, token_ids, self.index, finish_reason, logprobs)
+        self._pending_token_ids = []
+        self.loop.call_soon_threadsafe(self.text_queue.put_nowait, delta)
+
+    def _push(self, text: str):
+        if not self.stop:
+            self._emit(text)
+            return
+        if self._stopped:
+            return
+
+        text = self._held_text + text
+        index = find_stop(text, self.stop)
+        if index >= 0:
+            self._stopped = True
+            self._held_text = ""
+            self._emit(text[:index])
+            return
+        num_held = get_partial_stop_length(text, self.stop)
+        self._held_text = text[len(text) - num_held:] if num_held else ""
+        if len(text) > num_held:
+            self._emit(text[:len(text) - num_held])
+
+    def add_logprobs(self, token_logprobs: List[TokenLogprob]):
+        self._pending_logprobs.extend(token_logprobs)
+
+    def put(self, value):
+        token_ids = value.reshape(-1).tolist()
+
+        if self.detokenizer is None:
+            self.detokenizer = IncrementalDetokenizer(self.tokenizer, token_ids, self.skip_special_tokens)
+            if not self.skip_prompt:
+                self._emit(self.tokenizer.decode(token_ids, skip_special_tokens=self.skip_special_tokens))
+            # the logprobs of a skipped prompt are dropped with it
+            self._pending_logprobs = []
+            return
+
+        self._pending_token_ids.extend(token_ids)
+        text = self.detokenizer.add(token_ids)
+        if text:
+            self._push(text)
+
+    def end(self, finish_reason: Optional[str] = None):
+        if self.detokenizer is not None:
+            text = self.detokenizer.flush()
+            if text:
+                self._push(text)
+        # text held back for a stop string that never completed is output after all
+        text = "" if self._stopped else self._held_text
+        self._held_text = ""
+        self._emit(text, finish_reason)
+        self.loop.call_soon_threadsafe(self.text_queue.put_nowait, self.stop_signal)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> StreamDelta:
+        value = await self.text_queue.get()
+        if value is self.stop_signal:
+            raise StopAsyncIteration()
+        return value
+
+
+class TeeStreamer(BaseStreamer):
+    """
+    Hands the tokens of one sequence to several streamers, e.g. to stream
+    the identical choices of a greedy request with n > 1 from a single
+    generation. Only the first one reports the token ids, which are
+    generated, and billed, once.
+    """
+    def __init__(self, streamers: List[AsyncTextStreamer]):
+        self.streamers = streamers
+        for streamer in streamers[1:]:
+            streamer.reports_token_ids = False
+
+    def add_logprobs(self, token_logprobs: List[TokenLogprob]):
+        for streamer in self.streamers:
+            streamer.add_logprobs(token_logprobs)
+
+    def put(self, value):
+        for streamer in self.streamers:
+            streamer.put(value)
+
+    def end(self, finish_reason: Optional[str] = None):
+        for streamer in self.streamers:
+            streamer.end(finish_reason)
+
+
+class AsyncStreamGroup:
+    """
+    Merges the output of several streamers, e.g. one per prompt of a
+    batched completion request, into a single async iterator. Deltas come
+    out in the order they are produced, tagged with their streamer's index.
+    """
+    def __init__(self):
+        self.text_queue = asyncio.Queue()
+        self.streamers: List[AsyncTextStreamer] = []
+        self._num_ended = 0
+        self._cancel_callbacks = []
+
+    @property
+    def num_streams(self) -> int:
+        return len(self.streamers)
+
+    @property
+    def is_finished(self) -> bool:
+        """
+        Whether every stream has been read to its end.
+        """
+        return self._num_ended == len(self.streamers)
+
+    def add_cancel_callback(self, fn):
+        self._cancel_callbacks.append(fn)
+
+    def cancel(self):
+        """
+        Stop generating the streams, e.g. because nobody is reading them
+        anymore. Deltas produced until generation stops still come out.
+        """
+        for fn in self._cancel_callbacks:
+            fn()
+
+    def add_streamer(
+        self, tokenizer, skip_prompt: bool = False, skip_special_tokens: bool = True, stop: List[str] = None
+    ) -> AsyncTextStreamer:
+        streamer = AsyncTextStreamer(
+            tokenizer, skip_prompt, skip_special_tokens,
+            index=len(self.streamers), text_queue=self.text_queue, stop=stop,
+        )
+        self.streamers.append(streamer)
+        return streamer
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> StreamDelta:
+        while self._num_ended < len(self.streamers):
+            value = await self.text_queue.get()
+            if value is None:
+                # one of the streamers has ended
+                self._num_ended += 1
+                continue
+            return value
+        raise StopAsyncIteration()
@@ -0,0 +1,106 @@
+from typing import List, Optional
+from transformers import AutoTokenizer
+from .engine import Engine, get_eos_token_ids
+from .logprobs import TokenLogprob
+import logging
+import time
+
+
+class StubEngine(Engine):
+    """
+    Engine without a model, for benchmarking the node's HTTP, admission,
+    streaming and accounting paths without weights or a GPU. Only the
+    tokenizer is loaded, so prompts are billed as they would be.
+
+    Every step appends one token to each running sequence, repeating its
+    prompt from the start, so the output of a request is always the same.
+    With `tokens_per_second`, steps are paced to that rate, as if decoding
+    on a real model; otherwise they run as fast as the node can take them.
+    Logprobs are all 0.
+    """
+    def __init__(
+        self, tokenizer, max_batch_size: int = 16,
+        tokens_per_second: Optional[float] = None, max_context: Optional[int] = 2048
+    ):
+        super().__init__(tokenizer, max_batch_size, get_eos_token_ids(tokenizer), max_context)
+        self.step_seconds = 1 / tokens_per_second if tokens_per_second else 0
+        self._sequences = []
+
+    @classmethod
+    def load(
+        cls, model_path: str, max_batch_size: int = 16,
+        tokens_per_second: Optional[float] = None, max_context: Optional[int] = 2048
+    ) -> "StubEngine":
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        return cls(tokenizer, max_batch_size, tokens_per_second, max_context)
+
+    @property
+    def num_running(self) -> int:
+        return len(self._sequences)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._sequences and not self._waiting:
+                    self._running = False
+                    return
+                new_sequences = []
+                while self._waiting and len(self._sequences) + len(new_sequences) < self.max_batch_size:
+                    new_sequences.append(self._waiting.popleft())
+
+            start = time.monotonic()
+            try:
+                for seq in new_sequences:
+                    self._start(seq)
+                self._sequences = [seq for seq in self._sequences if self._step(seq)]
+            except Exception as e:
+                logging.error(f"Stub engine step failed: {e}", exc_info=True)
+                for seq in new_sequences + self._sequences:
+                    if not seq.is_finished:
+                        seq._finish("error")
+                self._sequences = []
+            time.sleep(max(0, self.step_seconds - (time.monotonic() - start)))
+
+    def _start(self, seq):
+        if seq.is_cancelled:
+            seq._finish("cancelled")
+            return
+        if self._cannot_finish_in_time(seq):
+            seq._expire()
+            return
+        if not seq.input_ids:
+            # nothing to repeat
+            seq._finish("stop")
+            return
+        if seq.num_prompt_logprobs is not None:
+            seq.prompt_logprobs = [TokenLogprob(seq.input_ids[0], None)] + [
+                self._get_token_logprob(token_id, seq.num_prompt_logprobs) for token_id in seq.input_ids[1:]
+            ]
+        seq._start()
+        if seq.max_new_tokens == 0:
+            seq._finish("length")
+            return
+        self._sequences.append(seq)
+
+    def _step(self, seq) -> bool:
+        """
+        Append the next token of `seq`, returns whether it is still running.
+        """
+        if seq.is_cancelled:
+            seq._finish("cancelled")
+            return False
+        if seq.budget is not None and not seq.budget.consume():
+            seq._finish("length")
+            return False
+        token_id = seq.input_ids[len(seq.output_ids) % len(seq.input_ids)]
+        token_logprob = self._get_token_logprob(token_id, seq.num_logprobs) if seq.num_logprobs is not None else None
+        seq._append(token_id, 0.0, token_logprob)
+        finish_reason = self._get_finish_reason(seq, token_id)
+        if finish_reason is not None:
+            seq._finish(finish_reason)
+            return False
+        return True
+
+    def _get_token_logprob(self, token_id: int, num_top: int) -> TokenLogprob:
+        top_logprobs: List = [(token_id, 0.0)] if num_top > 0 else []
+        return TokenLogprob(token_id, 0.0, top_logprobs)
@@ -0,0 +1,161 @@
+from typing import Dict, Optional
+from transformers import AutoTokenizer
+from vllm import EngineArgs, LLMEngine, SamplingParams
+from .engine import Engine, get_eos_token_ids
+from .logits_processors import create_sequence_logit_bias_processor
+from .logprobs import TokenLogprob
+from .pool import estimate_model_dir_size
+import itertools
+import logging
+
+# vLLM's finish reasons that aren't ours
+_FINISH_REASONS = {"abort": "cancelled"}
+
+
+class VLLMEngine(Engine):
+    """
+    Serves a model through vLLM, which batches, schedules and pages the KV
+    cache itself, with faster kernels than transformers; built for CPU, it
+    is the engine for higher throughput on machines without a GPU.
+
+    Every sequence is a vLLM request with the SamplingParams of its
+    request's `to_sampling_params`. vLLM's engine is stepped on a thread of
+    its own while it has requests, like the scheduler's decode loop, and
+    the tokens of every step are handed to their sequences. Stopping on the
+    session's budget, its deadline or a cancel aborts the request in vLLM.
+
+    Written against the LLMEngine API of vLLM 0.4, installed with the
+    `vllm` extra. vLLM keeps its own
+    prefix cache (`enable_prefix_caching`), and guided decoding isn't
+    supported on it.
+    """
+    def __init__(self, engine: LLMEngine, tokenizer, max_batch_size: int = 16):
+        super().__init__(
+            tokenizer, max_batch_size, get_eos_token_ids(tokenizer),
+            max_context=engine.model_config.max_model_len,
+        )
+        self.engine = engine
+        self._request_ids = itertools.count()
+        # request id -> sequence, of the requests vLLM has
+        self._sequences: Dict[str, object] = {}
+
+    @classmethod
+    def load(cls, model_path: str, max_batch_size: int = 16, **options) -> "VLLMEngine":
+        """
+        Load a model, `options` are vLLM EngineArgs, e.g. `dtype` or `device`.
+        """
+        engine = LLMEngine.from_engine_args(EngineArgs(model=model_path, max_num_seqs=max_batch_size, **options))
+        vllm_engine = cls(engine, AutoTokenizer.from_pretrained(model_path), max_batch_size)
+        vllm_engine.size_bytes = estimate_model_dir_size(model_path)
+        return vllm_engine
+
+    @property
+    def num_running(self) -> int:
+        return len(self._sequences)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._sequences and not self._waiting:
+                    self._running = False
+                    return
+                new_sequences = list(self._waiting)
+                self._waiting.clear()
+
+            try:
+                for seq in new_sequences:
+                    self._add(seq)
+                for request_id, seq in list(self._sequences.items()):
+                    if seq.is_cancelled:
+                        self._abort(request_id, "cancelled")
+                    elif self._cannot_finish_in_time(seq):
+                        # e.g. still queued in vLLM
+                        self._abort(request_id, "length")
+                if self._sequences:
+                    for output in self.engine.step():
+                        self._update(output)
+            except Exception as e:
+                logging.error(f"vLLM engine step failed: {e}", exc_info=True)
+                for seq in new_sequences:
+                    if not seq.is_finished:
+                        seq._finish("error")
+                for request_id in list(self._sequences.keys()):
+                    self._abort(request_id, "error")
+
+    def _get_sampling_params(self, seq) -> SamplingParams:
+        params = dict(seq.sampling_params)
+        # choices of a request are separate sequences, each with its own seed;
+        # the sampled token's logprob is always wanted, to rank best_of
+        params.update(
+            n=1,
+            best_of=1,
+            seed=seq.seed,
+            temperature=seq.temperature if seq.do_sample else 0.0,
+            logprobs=seq.num_logprobs or 0,
+            prompt_logprobs=seq.num_prompt_logprobs,
+            # a request has to generate at least one token, see _update
+            max_tokens=max(seq.max_new_tokens, 1) if seq.max_new_tokens is not None else None,
+        )
+        if seq.logit_bias:
+            # vLLM 0.4 has no logit_bias of its own
+            params["logits_processors"] = [create_sequence_logit_bias_processor(seq.logit_bias)]
+        return SamplingParams(**params)
+
+    def _add(self, seq):
+        if seq.is_cancelled:
+            seq._finish("cancelled")
+            return
+        if self._cannot_finish_in_time(seq):
+            seq._expire()
+            return
+        request_id = str(next(self._request_ids))
+        self.engine.add_request(request_id, None, self._get_sampling_params(seq), prompt_token_ids=seq.input_ids)
+        self._sequences[request_id] = seq
+
+    def _abort(self, request_id: str, reason: str):
+        self.engine.abort_request(request_id)
+        seq = self._sequences.pop(request_id)
+        if not seq.is_finished:
+            seq._finish(reason)
+
+    def _update(self, output):
+        seq = self._sequences.get(output.request_id)
+        if seq is None:
+            return
+        completion = output.outputs[0]
+        num_seen = len(seq.output_ids)
+        if num_seen == 0:
+            # prompt logprobs come with the first output, and are streamed before it
+            if seq.num_prompt_logprobs is not None and output.prompt_logprobs is not None:
+                seq.prompt_logprobs = [TokenLogprob(seq.input_ids[0], None)] + [
+                    _to_token_logprob(token_id, logprobs, seq.num_prompt_logprobs)
+                    for token_id, logprobs in zip(seq.input_ids[1:], output.prompt_logprobs[1:])
+                ]
+            seq._start()
+
+        for i in range(num_seen, len(completion.token_ids)):
+            if seq.max_new_tokens is not None and len(seq.output_ids) >= seq.max_new_tokens:
+                self._abort(output.request_id, "length")
+                return
+            if seq.budget is not None and not seq.budget.consume():
+                self._abort(output.request_id, "length")
+                return
+            token_id = completion.token_ids[i]
+            token_logprob = _to_token_logprob(token_id, completion.logprobs[i], seq.num_logprobs or 0)
+            seq._append(token_id, token_logprob.logprob or 0.0, token_logprob if seq.num_logprobs is not None else None)
+            finish_reason = self._get_finish_reason(seq, token_id)
+            if finish_reason is not None:
+                self._abort(output.request_id, finish_reason)
+                return
+
+        if output.finished:
+            del self._sequences[output.request_id]
+            finish_reason = completion.finish_reason or "stop"
+            seq._finish(_FINISH_REASONS.get(finish_reason, finish_reason))
+
+
+def _to_token_logprob(token_id: int, logprobs: Optional[dict], num_top: int) -> TokenLogprob:
+    # vLLM returns the sampled token and the most likely ones, by id
+    values = {top_id: logprob.logprob for top_id, logprob in (logprobs or {}).items()}
+    top_logprobs = sorted(values.items(), key=lambda item: item[1], reverse=True)[:num_top]
+    return TokenLogprob(token_id, values.get(token_id), top_logprobs)
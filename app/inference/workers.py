@@ -0,0 +1,377 @@
+from threading import Lock, Thread
+from typing import Dict, List
+from .models import CompletionRequest, ChatCompletionRequest
+from .streaming import StreamDelta
+from .budget import TokenBudget
+from .admission import DeadlineExceeded
+from .engine import GenerationFailed
+import asyncio
+import atexit
+import itertools
+import logging
+import multiprocessing
+import time
+
+# seconds to wait before restarting a worker that died
+WORKER_RESTART_DELAY = 1.0
+
+
+class WorkerError(Exception):
+    """
+    Raised for requests that failed inside, or together with, a worker process.
+    """
+
+
+class _RemoteStreamGroup:
+    """
+    Stream of deltas produced by a worker process, iterated like an
+    AsyncStreamGroup.
+    """
+    def __init__(self, queue: asyncio.Queue, num_streams: int, worker: "_Worker", request_id: int, budget: TokenBudget = None):
+        self.queue = queue
+        self.num_streams = num_streams
+        self.worker = worker
+        self.request_id = request_id
+        self.budget = budget
+        self.is_finished = False
+
+    def cancel(self):
+        self.worker.cancel(self.request_id)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> StreamDelta:
+        if self.is_finished:
+            raise StopAsyncIteration()
+        message = await self.queue.get()
+        if message[0] == "delta":
+            _, _, text, token_ids, index, finish_reason, logprobs = message
+            if self.budget is not None:
+                self.budget.charge(len(token_ids))
+            return StreamDelta(text, token_ids, index, finish_reason, logprobs)
+        self.is_finished = True
+        if message[0] == "end":
+            raise StopAsyncIteration()
+        raise WorkerError(message[3])
+
+
+class _Worker:
+    """
+    One inference process and the thread that reads its replies.
+    """
+    def __init__(self, index: int, config):
+        self.index = index
+        self.config = config
+        self.process = None
+        self.conn = None
+        self.loaded_models: List[str] = []
+        self.speculative_decoding_stats: Dict[str, dict] = {}
+        self.closing = False
+
+        # request_id -> (loop, queue) of the request waiting for replies
+        self._pending = {}
+        self._lock = Lock()
+        self._send_lock = Lock()
+
+    @property
+    def num_pending(self) -> int:
+        return len(self._pending)
+
+    def start(self):
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, self.config),
+            name=f"inference-worker-{self.index}", daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        Thread(target=self._read, args=(self.conn, self.process), daemon=True).start()
+        logging.info(f"Inference worker {self.index} started (pid {self.process.pid})")
+
+    def send(self, request_id: int, loop, queue: asyncio.Queue, message: tuple):
+        with self._lock:
+            self._pending[request_id] = (loop, queue)
+        try:
+            with self._send_lock:
+                self.conn.send(message)
+        except (OSError, ValueError) as e:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise WorkerError(f"Inference worker {self.index} is unavailable: {e}")
+
+    def cancel(self, request_id: int):
+        try:
+            with self._send_lock:
+                self.conn.send(("cancel", request_id))
+        except (OSError, ValueError):
+            # a dead worker has nothing left to cancel
+            pass
+
+    def _read(self, conn, process):
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+
+            if message[0] == "status":
+                _, self.loaded_models, self.speculative_decoding_stats = message
+                continue
+            request_id = message[1]
+            with self._lock:
+                pending = self._pending.get(request_id)
+                if message[0] in ("result", "end", "error"):
+                    self._pending.pop(request_id, None)
+            if pending is not None:
+                loop, queue = pending
+                loop.call_soon_threadsafe(queue.put_nowait, message)
+
+        # the worker is gone, fail whatever it was working on and replace it
+        process.join(timeout=5)
+        if self.closing:
+            return
+        logging.error(f"Inference worker {self.index} exited with code {process.exitcode}, restarting it")
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for request_id, (loop, queue) in pending.items():
+            loop.call_soon_threadsafe(queue.put_nowait, ("error", request_id, "crash", "Inference worker crashed"))
+        self.loaded_models = []
+        self.speculative_decoding_stats = {}
+
+        time.sleep(WORKER_RESTART_DELAY)
+        self.start()
+
+
+class WorkerPool:
+    """
+    Optionally runs inference in separate worker processes instead of the
+    HTTP server process.
+
+    Every worker loads models on its own, memory-mapping their safetensors
+    weights so the workers share the same physical pages. Requests are
+    dispatched over a pipe; chat requests of a session always go to the same
+    worker so its prefix cache can be reused, other requests go to the least
+    busy worker. A worker that crashes fails its in-flight requests and is
+    restarted, without taking the server down with it.
+    """
+    def __init__(self):
+        self.num_workers = 0
+        self._workers: List[_Worker] = []
+        self._request_ids = itertools.count()
+
+    def init_config(self, config):
+        self.num_workers = config.INFERENCE_WORKER_PROCESSES or 0
+        if self.num_workers <= 0:
+            return
+        self._workers = [_Worker(i, config) for i in range(self.num_workers)]
+        for worker in self._workers:
+            worker.start()
+        atexit.register(self.shutdown)
+
+    def shutdown(self):
+        for worker in self._workers:
+            worker.closing = True
+            worker.process.terminate()
+
+    def is_enabled(self) -> bool:
+        return self.num_workers > 0
+
+    def get_loaded_models(self) -> List[str]:
+        models = []
+        for worker in self._workers:
+            models += [model for model in worker.loaded_models if model not in models]
+        return models
+
+    def get_speculative_decoding_stats(self) -> dict:
+        stats = {}
+        for worker in self._workers:
+            for model_name, worker_stats in worker.speculative_decoding_stats.items():
+                model_stats = stats.setdefault(model_name, dict(worker_stats, num_draft_tokens=0, num_accepted_tokens=0))
+                model_stats['num_draft_tokens'] += worker_stats['num_draft_tokens']
+                model_stats['num_accepted_tokens'] += worker_stats['num_accepted_tokens']
+        for model_stats in stats.values():
+            num_draft_tokens = model_stats['num_draft_tokens']
+            model_stats['acceptance_rate'] = model_stats['num_accepted_tokens'] / num_draft_tokens if num_draft_tokens else 0.0
+        return stats
+
+    def _pick_worker(self, session_id: int = None) -> _Worker:
+        if session_id is not None:
+            return self._workers[session_id % len(self._workers)]
+        return min(self._workers, key=lambda worker: worker.num_pending)
+
+    async def _dispatch(
+        self, kind: str, request, session_id: int = None, budget: TokenBudget = None,
+        deadline: float = None, worker: _Worker = None
+    ):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        request_id = next(self._request_ids)
+        if worker is None:
+            worker = self._pick_worker(session_id)
+        # the worker gets what is left of the budget now, and the tokens it
+        # spends are charged here as they come back
+        num_budget_tokens = budget.num_tokens if budget is not None else None
+        # the time left, the worker's clock may not be ours
+        timeout = deadline - time.monotonic() if deadline is not None else None
+        worker.send(request_id, loop, queue, (kind, request_id, request.model_dump(), session_id, num_budget_tokens, timeout))
+
+        try:
+            message = await queue.get()
+        except asyncio.CancelledError:
+            # nobody waits for the result anymore, the worker stops generating it
+            worker.cancel(request_id)
+            raise
+        if message[0] == "error":
+            _, _, error_kind, error = message
+            if error_kind == "value":
+                raise ValueError(error)
+            if error_kind == "deadline":
+                raise DeadlineExceeded(error)
+            if error_kind == "failed":
+                raise GenerationFailed(error)
+            raise WorkerError(error)
+        if message[0] == "start":
+            _, _, num_input_tokens, num_streams = message
+            if budget is not None:
+                budget.charge(num_input_tokens)
+            return _RemoteStreamGroup(queue, num_streams, worker, request_id, budget), None, num_input_tokens, None
+        _, _, result, num_input_tokens, num_output_tokens = message
+        if budget is not None:
+            budget.charge(num_input_tokens + num_output_tokens)
+        return result, None, num_input_tokens, num_output_tokens
+
+    async def create_completion(self, request: CompletionRequest, budget: TokenBudget = None, deadline: float = None):
+        return await self._dispatch("completion", request, budget=budget, deadline=deadline)
+
+    async def create_chat_completion(
+        self, request: ChatCompletionRequest, session_id: int = None, budget: TokenBudget = None, deadline: float = None
+    ):
+        return await self._dispatch("chat_completion", request, session_id, budget, deadline)
+
+    async def warm_up(self, request: CompletionRequest):
+        """
+        Run `request` on every worker, so each of them loads and warms up
+        the model before real requests arrive.
+        """
+        await asyncio.gather(*[
+            self._dispatch("completion", request, worker=worker) for worker in self._workers
+        ])
+
+
+def _worker_main(conn, config):
+    import logging.config
+    from app.models.storage import model_storage
+    from .pool import model_pool
+    from .executor import inference_executor
+    from .prefix_cache import prefix_cache
+    from .guided_decoding import guide_cache
+
+    logging.config.dictConfig(config.LOGGING_CONFIG)
+    if config.DEFAULT_LOGGING_LEVEL:
+        logging.getLogger().setLevel(config.DEFAULT_LOGGING_LEVEL)
+
+    # mapped weights are what makes several workers affordable
+    config.set('MMAP_MODEL_WEIGHTS', True, do_save=False)
+
+    # models are only read from disk here, downloads happen in the server process
+    model_storage.init(config, None)
+    model_pool.init_config(config)
+    inference_executor.init_config(config)
+    prefix_cache.init_config(config)
+    guide_cache.init_config(config)
+
+    asyncio.run(_serve(conn))
+
+
+async def _serve(conn):
+    from . import services
+    from .pool import model_pool
+
+    loop = asyncio.get_running_loop()
+    # only the event loop thread writes to the pipe
+    send = conn.send
+    # request_id -> task handling each request in progress
+    tasks = {}
+    # request_id -> task creating the result of the requests not streaming yet
+    creating = {}
+    # request_id -> stream group of the streamed requests in progress
+    streams = {}
+    # ids of the requests in progress that were cancelled before they streamed
+    cancelled = set()
+
+    async def create(kind: str, request, session_id: int, budget: TokenBudget, deadline: float):
+        await services.setup_model_if_not_running(request.model.lower())
+        if kind == "completion":
+            return await services.create_completion(request, budget, deadline)
+        return await services.create_chat_completion(request, session_id, budget, deadline)
+
+    async def handle(kind: str, request_id: int, data: dict, session_id: int, num_budget_tokens: int, timeout: float):
+        budget = TokenBudget(num_budget_tokens) if num_budget_tokens is not None else None
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        try:
+            request = CompletionRequest(**data) if kind == "completion" else ChatCompletionRequest(**data)
+            # a task of its own, so a cancel can stop it while it is tokenized,
+            # queued or prefilled; the sequences it submitted are cancelled with it
+            task = creating[request_id] = loop.create_task(create(kind, request, session_id, budget, deadline))
+            if request_id in cancelled:
+                task.cancel()
+            try:
+                result, _, num_input_tokens, num_output_tokens = await task
+            finally:
+                creating.pop(request_id, None)
+
+            if request.stream:
+                streams[request_id] = result
+                if request_id in cancelled:
+                    # cancelled right as it was created
+                    result.cancel()
+                send(("start", request_id, num_input_tokens, result.num_streams))
+                async for delta in result:
+                    send(("delta", request_id, delta.text, delta.token_ids, delta.index, delta.finish_reason, delta.logprobs))
+                send(("end", request_id))
+            else:
+                send(("result", request_id, result, num_input_tokens, num_output_tokens))
+        except ValueError as e:
+            send(("error", request_id, "value", str(e)))
+        except DeadlineExceeded as e:
+            send(("error", request_id, "deadline", str(e)))
+        except GenerationFailed as e:
+            send(("error", request_id, "failed", str(e)))
+        except asyncio.CancelledError:
+            send(("error", request_id, "cancelled", "the request was cancelled"))
+        except Exception as e:
+            logging.error(f"Inference worker request failed: {e}", exc_info=True)
+            send(("error", request_id, "error", str(e)))
+        finally:
+            streams.pop(request_id, None)
+            cancelled.discard(request_id)
+            send(("status", model_pool.get_loaded_models(), model_pool.get_speculative_decoding_stats()))
+
+    def receive():
+        try:
+            return conn.recv()
+        except (EOFError, OSError):
+            return None
+
+    while True:
+        # the server process holds the other end, so it is gone when this fails
+        message = await loop.run_in_executor(None, receive)
+        if message is None:
+            return
+        if message[0] == "cancel":
+            request_id = message[1]
+            if request_id in streams:
+                streams[request_id].cancel()
+            elif request_id in tasks:
+                cancelled.add(request_id)
+                if request_id in creating:
+                    creating[request_id].cancel()
+            continue
+        request_id = message[1]
+        task = tasks[request_id] = loop.create_task(handle(*message))
+        task.add_done_callback(lambda _, request_id=request_id: tasks.pop(request_id, None))
+
+# Global instance of the WorkerPool
+worker_pool = WorkerPool()
@@ -9,6 +9,9 @@ class NodeStatus:
     models_supported: List[str] = None
     models_running: List[str] = None
     models_downloaded: List[str] = None
+    speculative_decoding: dict = None
+    admission: dict = None
+    response_cache: dict = None
     # TODO: Add more fields here
 
 @dataclass
@@ -1,10 +1,16 @@
 from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
 from .models import NodeStatus
 from app.chain.wallet import wallet
 from app.chain.node_registry import node_registry
 from .utils import get_session_tokens_used
 from app.cost import cost_calculator
 from app.models.storage import model_storage
+from app.inference.pool import model_pool
+from app.inference.workers import worker_pool
+from app.inference.admission import admission_controller
+from app.inference.response_cache import response_cache
+from app.inference.preload import model_preloader
 
 management_router = APIRouter()
 
@@ -12,12 +18,28 @@ management_router = APIRouter()
 def ping():
     return "pong"
 
+@management_router.get('/ready')
+async def ready():
+    # unlike /ping, fails until the preloaded models are loaded and warmed
+    # up, and again whenever one of them has been unloaded
+    is_ready = await model_preloader.is_ready()
+    return JSONResponse(
+        status_code=200 if is_ready else 503,
+        content={'ready': is_ready, 'models': await model_preloader.get_states()},
+    )
+
 @management_router.get('/v1/status')
 def status():
+    # with worker processes, models are loaded there and not in this process
+    pool = worker_pool if worker_pool.is_enabled() else model_pool
     node_status: NodeStatus = {
         'node_id': node_registry.node_id,
         'supported_models': model_storage.get_supported_models(),
-        'has_capacity': True,
+        'models_running': pool.get_loaded_models(),
+        'speculative_decoding': pool.get_speculative_decoding_stats(),
+        'has_capacity': admission_controller.has_capacity(),
+        'admission': admission_controller.get_stats(),
+        'response_cache': response_cache.get_stats(),
         'costs_per_1000_tokens': cost_calculator.get_full_cost_map(),
     }
     return node_status
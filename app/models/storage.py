@@ -253,6 +253,13 @@ class ModelStorage:
         model_path = await self._download_model(ipfs_hash, model_dir)
         return model_path
 
+    def get_quantized_model_path(self, model_name: str, precision: str) -> str:
+        """
+        Where the quantized version of a downloaded model is cached. It is
+        kept inside the model's directory, so it is deleted together with it.
+        """
+        return os.path.join(self._parse_model_dir(model_name), "quantized", f"{precision}.pt")
+
     async def get_model_dir(self, model_name: str, download_if_not_saved: bool = False) -> str:
         lower_model_name = model_name.lower()
         # Check if the model is already downloaded
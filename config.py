@@ -39,6 +39,100 @@ class Config:
         'tinyllama/tinyllama-1.1b-chat-v1.0',
     ]
 
+    # Maximum number of sequences decoded together by the batching scheduler
+    INFERENCE_MAX_BATCH_SIZE = 16
+    # Prompt tokens prefilled per scheduler step. Longer prompts are prefilled
+    # in chunks between decode steps of the running batch: smaller chunks keep
+    # the other streams' inter-token latency low, larger ones give the long
+    # prompt a shorter time to first token. None prefills prompts in one go.
+    INFERENCE_PREFILL_CHUNK_SIZE = 512
+    # Largest n or best_of a request may ask for. Every one of them is a
+    # sequence with its own copy of the prompt's KV cache, all admitted at
+    # once, so it is capped at INFERENCE_MAX_BATCH_SIZE.
+    INFERENCE_MAX_BEST_OF = 8
+    # Worker threads for model loading, tokenization and decoding outputs.
+    # Each model's decode loop runs on a thread of its own.
+    INFERENCE_MAX_WORKERS = 4
+
+    # Bytes of responses kept for deterministic requests (temperature 0 or a
+    # fixed seed), and for how many seconds. 0 disables the response cache.
+    RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+    RESPONSE_CACHE_TTL = 10 * 60
+
+    # Compiled guided decoding FSMs (guided_json, guided_regex, guided_choice)
+    # kept per model, a repeated schema skips compilation
+    GUIDED_DECODING_CACHE_SIZE = 32
+
+    # Inference requests handled at once, further requests wait in a queue
+    INFERENCE_MAX_CONCURRENCY = 32
+    # Requests allowed to wait for a slot, more are rejected with a 429
+    INFERENCE_MAX_QUEUE_DEPTH = 64
+    # Longest a request may take, from its arrival, before generation stops
+    # with finish_reason "length", so no request holds a model indefinitely.
+    # Requests whose prompt can't be prefilled in time fail with a 504,
+    # streamed or not. Clients can ask for less with an X-Request-Timeout
+    # header, in seconds.
+    # None for no limit.
+    MAX_GENERATION_SECONDS = 5 * 60
+
+    # Run inference in this many separate worker processes instead of the
+    # server process. 0 keeps inference in the server process.
+    INFERENCE_WORKER_PROCESSES = 0
+    # Load safetensors weights memory-mapped and in their stored dtype, so
+    # processes loading the same model share its pages. Always on in
+    # worker processes.
+    MMAP_MODEL_WEIGHTS = False
+
+    # Memory the resident models may use in total, in bytes. Least recently
+    # used models are unloaded to stay under it. None uses 80% of the
+    # GPU memory, or of the system RAM on CPU-only nodes.
+    MODEL_MEMORY_BUDGET_BYTES = None
+
+    # Bytes of KV cache kept around to reuse across chat turns of a session.
+    # 0 disables the prefix cache.
+    PREFIX_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+    # Speculative decoding, per target model. The draft model must be one of
+    # the supported models, it proposes `num_speculative_tokens` tokens that
+    # the target verifies in one pass. A draft with another vocabulary only
+    # proposes the tokens both share (e.g. tinyllama for mistral), and isn't
+    # used if that is less than half of the target's.
+    # e.g. {'mistralai/mistral-7b-v0.1': {'draft_model': '...', 'num_speculative_tokens': 4}}
+    SPECULATIVE_DECODING = {}
+
+    # Compiled serving, per model: decode steps run through torch.compile on
+    # a KV cache preallocated for INFERENCE_MAX_BATCH_SIZE sequences of
+    # `max_context` tokens. Compilation happens when the model is loaded, the
+    # cache counts toward the model's memory. Needs a model that supports a
+    # static KV cache, e.g. llama, and transformers 4.38; with other versions
+    # models decode eagerly.
+    # e.g. {'tinyllama/tinyllama-1.1b-chat-v1.0': {'max_context': 2048}}
+    COMPILED_MODELS = {}
+
+    # Models loaded and warmed up with a short generation when the server
+    # starts, in order and in the background. /ready reports the node ready
+    # while all of them are loaded, /ping answers regardless.
+    # e.g. ['mistralai/mistral-7b-v0.1']
+    PRELOAD_MODELS = []
+
+    # Inference engine per model, 'default' for models not listed:
+    # 'transformers' runs the model in this process through the scheduler,
+    # 'vllm' through vLLM (which has to be installed, built for CPU on
+    # machines without a GPU) and 'stub' loads only the tokenizer and
+    # generates deterministic tokens, to benchmark the node without real
+    # weights. Other keys are options of the engine, e.g. vLLM EngineArgs or
+    # the stub's 'tokens_per_second'.
+    # e.g. {'mistralai/mistral-7b-v0.1': {'engine': 'vllm', 'dtype': 'bfloat16'}}
+    INFERENCE_ENGINES = {}
+
+    # Precision models are loaded in: 'auto' keeps the checkpoint's default,
+    # 'bf16' loads bfloat16 weights where the hardware supports them and
+    # 'int8' dynamically quantizes the linear layers (cpu only). Quantized
+    # models are cached next to the downloaded weights.
+    MODEL_LOAD_PRECISION = {
+        'default': 'auto',
+    }
+
     USD_COST_PER_1000_TOKENS = {
         'default': 0.01,
         'mistralai/mistral-7b-v0.1': 0.02,
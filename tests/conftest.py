@@ -0,0 +1,86 @@
+import os
+import tempfile
+
+# importing app loads config.py, which writes its config file under the home
+# directory; keep that out of the real one
+os.environ["HOME"] = tempfile.mkdtemp(prefix="priva-tests-")
+
+import pytest
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+TRAINING_TEXT = "Hello world! The quick brown fox jumps over the lazy dog. " * 20
+
+
+def _train_tokenizer(vocab_size: int, special_tokens: list) -> PreTrainedTokenizerFast:
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=special_tokens,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator([TRAINING_TEXT], trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>", pad_token="<pad>")
+
+
+def _create_model(tokenizer, seed: int) -> LlamaForCausalLM:
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer), hidden_size=64, intermediate_size=128,
+        num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2,
+        max_position_embeddings=512, bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.pad_token_id,
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+@pytest.fixture(scope="session")
+def tokenizer():
+    """
+    A small byte-level BPE tokenizer, trained on ASCII text only, so any
+    other character takes several tokens.
+    """
+    return _train_tokenizer(320, ["<pad>", "<s>", "</s>"])
+
+
+@pytest.fixture(scope="session")
+def model(tokenizer):
+    """
+    A randomly initialized two layer llama, small enough to run on the CPU.
+    """
+    return _create_model(tokenizer, seed=0)
+
+
+@pytest.fixture(scope="session")
+def draft_tokenizer():
+    """
+    A tokenizer with another vocabulary than `tokenizer`: fewer merges, and
+    its special tokens first.
+    """
+    return _train_tokenizer(300, ["<s>", "</s>", "<pad>"])
+
+
+@pytest.fixture(scope="session")
+def draft_model(draft_tokenizer):
+    """
+    Another random llama, on the vocabulary of `draft_tokenizer`.
+    """
+    return _create_model(draft_tokenizer, seed=1)
+
+
+@pytest.fixture
+def loaded_model(model, tokenizer):
+    """
+    The model, resident in the model pool and served by a scheduler.
+    """
+    from app.inference.pool import LoadedModel, model_pool
+    from app.inference.scheduler import Scheduler
+
+    scheduler = Scheduler(model, tokenizer, max_batch_size=8)
+    loaded = LoadedModel("test/tiny-llama", model, tokenizer, scheduler, 0)
+    model_pool.add(loaded)
+    yield loaded
+    model_pool._models.pop(loaded.name, None)
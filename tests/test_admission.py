@@ -0,0 +1,96 @@
+import asyncio
+import json
+from types import SimpleNamespace
+import pytest
+from fastapi.responses import JSONResponse
+from app.inference.admission import AdmissionController, AdmissionRejected, admission_controller
+from app.inference.routes import _run_admitted
+
+
+def _controller(max_concurrency: int = 1, max_queue_depth: int = 2) -> AdmissionController:
+    controller = AdmissionController()
+    controller.init_config(SimpleNamespace(
+        INFERENCE_MAX_CONCURRENCY=max_concurrency, INFERENCE_MAX_QUEUE_DEPTH=max_queue_depth, MAX_GENERATION_SECONDS=None,
+    ))
+    return controller
+
+
+def test_requests_wait_in_order_and_overflow_is_rejected():
+    async def run():
+        controller = _controller()
+        first = await controller.admit()
+        admitted = []
+
+        async def wait_for_slot(name):
+            ticket = await controller.admit()
+            admitted.append(name)
+            return ticket
+
+        waiters = [asyncio.ensure_future(wait_for_slot(name)) for name in ("second", "third")]
+        await asyncio.sleep(0)
+        assert controller.num_waiting == 2
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.admit()
+        assert rejected.value.retry_after >= 1
+        assert controller.num_rejected == 1
+
+        first.release()
+        second = await waiters[0]
+        # releasing twice doesn't free another slot
+        first.release()
+        await asyncio.sleep(0)
+        assert admitted == ["second"]
+        second.release()
+        (await waiters[1]).release()
+        assert admitted == ["second", "third"]
+        assert controller.num_running == 0
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiters_give_up_their_place():
+    async def run():
+        controller = _controller()
+        ticket = await controller.admit()
+        waiter = asyncio.ensure_future(controller.admit())
+        await asyncio.sleep(0)
+
+        waiter.cancel()
+        await asyncio.sleep(0)
+        assert controller.num_waiting == 0
+        ticket.release()
+        assert controller.num_running == 0
+
+    asyncio.run(run())
+
+
+def test_retry_after_follows_the_service_times():
+    controller = _controller(max_concurrency=2)
+    controller._service_times.extend([10.0, 20.0])
+    controller._waiters.extend([object()] * 3)
+
+    # 4 requests ahead, through 2 slots, 15s each
+    assert controller._estimate_retry_after() == 30
+
+
+def test_rejected_requests_get_a_429_with_retry_after(monkeypatch):
+    monkeypatch.setattr(admission_controller, "max_concurrency", 1)
+    monkeypatch.setattr(admission_controller, "max_queue_depth", 0)
+    monkeypatch.setattr(admission_controller, "num_running", 0)
+
+    async def handler():
+        return JSONResponse({"ok": True})
+
+    async def run():
+        ticket = await admission_controller.admit()
+        try:
+            return await _run_admitted(handler)
+        finally:
+            ticket.release()
+
+    response = asyncio.run(run())
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert "capacity" in json.loads(response.body)["error"]
+    assert asyncio.run(_run_admitted(handler)).status_code == 200
+    assert admission_controller.num_running == 0
@@ -0,0 +1,77 @@
+import asyncio
+import pytest
+from app.inference.budget import SessionBudgets, TokenBudget
+from app.inference.models import CompletionRequest
+from app.inference.scheduler import Scheduler, Sequence
+from app.inference.services import create_completion
+
+
+def _sequence(tokenizer, prompt: str, budget: TokenBudget) -> Sequence:
+    return Sequence(
+        tokenizer.encode(prompt, add_special_tokens=False), max_new_tokens=20,
+        logit_bias={tokenizer.eos_token_id: -100.0}, budget=budget,
+    )
+
+
+def test_generation_stops_when_the_budget_runs_out(model, tokenizer):
+    scheduler = Scheduler(model, tokenizer, max_batch_size=4)
+    budget = TokenBudget(3)
+    sequence = _sequence(tokenizer, "Hello", budget)
+
+    scheduler.submit(sequence)
+    assert sequence.wait(timeout=30)
+
+    assert sequence.finish_reason == "length"
+    assert len(sequence.output_ids) == 3
+    assert budget.is_exhausted
+
+
+def test_sequences_of_a_session_share_its_budget(model, tokenizer):
+    scheduler = Scheduler(model, tokenizer, max_batch_size=4)
+    budget = TokenBudget(7)
+    sequences = [_sequence(tokenizer, prompt, budget) for prompt in ("Hello", "The quick brown fox")]
+
+    scheduler.submit_all(sequences)
+    assert all(sequence.wait(timeout=30) for sequence in sequences)
+
+    # never more tokens than the session can pay for
+    assert sum(len(sequence.output_ids) for sequence in sequences) == 7
+    assert all(sequence.finish_reason == "length" for sequence in sequences)
+    assert budget.num_tokens == 0
+
+
+def test_requests_bill_their_prompt_and_output(loaded_model):
+    request = CompletionRequest(
+        model=loaded_model.name, prompt="Hello", max_tokens=50, temperature=0,
+        logit_bias={str(loaded_model.tokenizer.eos_token_id): -100.0},
+    )
+    budget = TokenBudget(10)
+
+    choices, _, num_input_tokens, num_output_tokens = asyncio.run(create_completion(request, budget))
+
+    assert choices[0].finish_reason == "length"
+    assert num_input_tokens + num_output_tokens == 10
+    assert budget.is_exhausted
+    # a prompt the session can't pay for isn't generated at all
+    with pytest.raises(ValueError, match="cost limit"):
+        asyncio.run(create_completion(request, TokenBudget(num_input_tokens - 1)))
+
+
+def test_session_budgets_live_while_requests_hold_them():
+    budgets = SessionBudgets()
+    ledger = [100]
+
+    first = budgets.acquire(1, lambda: ledger[0])
+    second = budgets.acquire(1, lambda: ledger[0])
+    assert first is second
+    first.consume(30)
+    budgets.release(1, first)
+    assert budgets.acquire(1, lambda: ledger[0]) is first
+    budgets.release(1, first)
+    budgets.release(1, second)
+
+    # the next request starts over from the ledger
+    ledger[0] = 70
+    third = budgets.acquire(1, lambda: ledger[0])
+    assert third is not first and third.num_tokens == 70
+    assert budgets.acquire(2, lambda: None) is None
@@ -0,0 +1,36 @@
+from app.inference.detokenizer import IncrementalDetokenizer
+
+
+def _detokenize(tokenizer, prompt_ids, output_ids, **kwargs) -> list:
+    detokenizer = IncrementalDetokenizer(tokenizer, prompt_ids, **kwargs)
+    chunks = [detokenizer.add([token_id]) for token_id in output_ids]
+    return chunks + [detokenizer.flush()]
+
+
+def test_token_by_token_text_matches_decoding_at_once(tokenizer):
+    prompt_ids = tokenizer.encode("The quick brown", add_special_tokens=False)
+    output_ids = tokenizer.encode(" fox jumps  over the wörld, 你好!", add_special_tokens=False)
+
+    chunks = _detokenize(tokenizer, prompt_ids, output_ids)
+
+    # leading spaces come out right, and multi-byte characters whole
+    assert "".join(chunks) == " fox jumps  over the wörld, 你好!"
+    assert not any("�" in chunk for chunk in chunks)
+    # a character split across tokens is held back until it is complete
+    assert "" in chunks[:-1]
+
+
+def test_special_tokens_are_skipped(tokenizer):
+    output_ids = tokenizer.encode("Hello", add_special_tokens=False) + [tokenizer.eos_token_id]
+
+    assert "".join(_detokenize(tokenizer, [], output_ids)) == "Hello"
+    assert "".join(_detokenize(tokenizer, [], output_ids, skip_special_tokens=False)) == "Hello</s>"
+
+
+def test_flush_returns_incomplete_text(tokenizer):
+    output_ids = tokenizer.encode("你", add_special_tokens=False)
+    detokenizer = IncrementalDetokenizer(tokenizer)
+
+    assert detokenizer.add(output_ids[:1]) == ""
+    assert detokenizer.flush() == tokenizer.decode(output_ids[:1])
+    assert detokenizer.flush() == ""
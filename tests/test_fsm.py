@@ -0,0 +1,61 @@
+import re
+import pytest
+from app.inference.fsm import compile_regex
+
+
+def _matches(dfa, text: str) -> bool:
+    state = dfa.walk(dfa.initial_state, text)
+    return state is not None and dfa.is_accepting(state)
+
+
+@pytest.mark.parametrize("pattern, texts", [
+    ("abc", ["abc", "ab", "abcd", ""]),
+    ("a|bc|", ["a", "bc", "", "b", "abc"]),
+    ("(ab)+c?", ["ab", "abab", "ababc", "c", "aba", ""]),
+    ("(?:ab)*", ["", "ab", "abab", "a"]),
+    ("(?P<year>[0-9]{4})-(?P<month>[0-9]{2})", ["2024-01", "24-01", "2024-1"]),
+    ("a{3}", ["aa", "aaa", "aaaa"]),
+    ("a{2,}", ["a", "aa", "aaaaa"]),
+    ("a{,2}", ["", "a", "aa", "aaa"]),
+    ("a{1,3}?b", ["b", "ab", "aaab", "aaaab"]),
+    ("x{2}y{0}", ["xx", "xxy"]),
+    ("a{", ["a{", "a"]),
+    ("a{,2}b{", ["b{", "aab{", "aaab{", "ab"]),
+    ("a*?b+?c??d{2}+", ["bdd", "aabbcdd", "d"]),
+    ("[a-cx-z]+", ["abc", "xyz", "d", "aXz"]),
+    ("[^a-c\n]", ["d", "a", "\n", "é"]),
+    ("[-a]", ["-", "a", "b"]),
+    ("[a-]", ["-", "a"]),
+    ("[]a]", ["]", "a", "b"]),
+    ("[\\]\\\\]", ["]", "\\", "a"]),
+    ("[\\d.]+", ["1.5", "a"]),
+    ("\\d\\w\\s", ["1a ", "1a\t", "a1 ", "1_ "]),
+    ("\\D\\W\\S", ["a-b", "1-b", "a b"]),
+    (".+", ["any thing", "with\nnewline", "ümlaut"]),
+    ("\\.\\*\\+\\?\\(\\)\\[\\]\\{\\}\\|\\^\\$", [".*+?()[]{}|^$", "x"]),
+    ("\\n\\t\\x41\\u00e9", ["\n\tAé", "\n\tA"]),
+    ("^abc$", ["abc", "^abc$"]),
+    ("café|naïve", ["café", "naïve", "cafe"]),
+])
+def test_regex_matches_like_python(pattern, texts):
+    dfa = compile_regex(pattern)
+
+    for text in texts:
+        assert _matches(dfa, text) == bool(re.fullmatch(pattern, text)), text
+
+
+def test_walk_stops_on_impossible_prefixes():
+    dfa = compile_regex("[0-9]+(\\.[0-9]+)?")
+
+    assert dfa.walk(dfa.initial_state, "12.") is not None
+    assert not dfa.is_accepting(dfa.walk(dfa.initial_state, "12."))
+    assert dfa.walk(dfa.initial_state, "12.a") is None
+    assert dfa.walk(dfa.initial_state, "a") is None
+
+
+@pytest.mark.parametrize("pattern", [
+    "(?=a)b", "(?i)a", "(a)\\1", "\\bword", "*a", "a**", "a{2}*", "a*?+", "[b-a]", "(ab", "ab)", "[ab", "\\x4", "a{3,2}", "a{2000}",
+])
+def test_unsupported_regexes_are_rejected(pattern):
+    with pytest.raises(ValueError):
+        compile_regex(pattern)
@@ -0,0 +1,170 @@
+import json
+import re
+import pytest
+from app.inference.fsm import compile_regex
+from app.inference.json_schema import build_regex_from_schema
+
+PERSON = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string", "minLength": 1, "maxLength": 8},
+        "age": {"type": "integer"},
+        "height": {"type": "number"},
+        "alive": {"type": "boolean"},
+        "spouse": {"type": ["string", "null"]},
+    },
+}
+
+
+def _matches(pattern: str, document: str) -> bool:
+    dfa = compile_regex(pattern)
+    state = dfa.walk(dfa.initial_state, document)
+    matches = state is not None and dfa.is_accepting(state)
+    # the automaton has to agree with Python's own regex engine
+    assert matches == bool(re.fullmatch(pattern, document)), document
+    return matches
+
+
+def _dumps(document) -> list:
+    # the spacing a model may choose between tokens
+    return [json.dumps(document), json.dumps(document, separators=(",", ":"))]
+
+
+@pytest.mark.parametrize("schema, valid, invalid", [
+    (
+        PERSON,
+        [{"name": "Ada", "age": 36, "height": 1.65, "alive": False, "spouse": None},
+         {"name": "Ada \"A\"", "age": -1, "height": 2e-3, "alive": True, "spouse": "William"}],
+        [{"name": "", "age": 36, "height": 1.65, "alive": False, "spouse": None},
+         {"name": "Ada Lovelace", "age": 36, "height": 1.65, "alive": False, "spouse": None},
+         {"name": "Ada", "age": 36.5, "height": 1.65, "alive": False, "spouse": None},
+         {"age": 36, "name": "Ada", "height": 1.65, "alive": False, "spouse": None},
+         {"name": "Ada", "age": 36, "height": 1.65, "alive": False}],
+    ),
+    (
+        {"type": "object", "properties": {"a": {"type": "integer"}, "b": {"type": "integer"}, "c": {"type": "integer"}},
+         "required": ["b"]},
+        [{"b": 1}, {"a": 0, "b": 1}, {"b": 1, "c": 2}, {"a": 0, "b": 1, "c": 2}],
+        [{}, {"a": 0}, {"a": 0, "c": 2}, {"b": 1, "a": 0}],
+    ),
+    (
+        {"type": "object", "properties": {"a": {"type": "integer"}, "b": {"type": "integer"}}, "required": []},
+        [{}, {"a": 0}, {"b": 1}, {"a": 0, "b": 1}],
+        [{"b": 1, "a": 0}, {"c": 2}],
+    ),
+    (
+        {"type": "object", "properties": {"outer": {"type": "object", "properties": {
+            "inner": {"type": "array", "items": {"type": "object", "properties": {"x": {"type": "number"}}}}}}}},
+        [{"outer": {"inner": []}}, {"outer": {"inner": [{"x": 1}, {"x": -0.5}]}}],
+        [{"outer": {}}, {"outer": {"inner": [{"y": 1}]}}, {"outer": {"inner": {"x": 1}}}],
+    ),
+    (
+        {"type": "array", "items": {"type": "integer"}, "minItems": 2, "maxItems": 3},
+        [[1, 2], [1, 2, 3]],
+        [[], [1], [1, 2, 3, 4], [1, "2"]],
+    ),
+    (
+        {"type": "array", "items": {"type": "boolean"}, "maxItems": 2},
+        [[], [True], [True, False]],
+        [[True, False, True]],
+    ),
+    (
+        {"type": "array", "maxItems": 0},
+        [[]],
+        [[1]],
+    ),
+    (
+        {"enum": ["red", "green", 3, None, {"a": 1, "b": [True, "x"]}, []]},
+        ["red", "green", 3, None, {"a": 1, "b": [True, "x"]}, []],
+        ["blue", "Red", 4, {"a": 1}, {"b": [True, "x"], "a": 1}, [None]],
+    ),
+    (
+        {"const": "fixed"},
+        ["fixed"],
+        ["other", "fixe"],
+    ),
+    (
+        {"anyOf": [{"type": "integer"}, {"type": "string", "maxLength": 2}]},
+        [1, "ab", ""],
+        ["abc", 1.5, None],
+    ),
+    (
+        {"oneOf": [{"type": "null"}, {"type": "array", "items": {"type": "null"}}]},
+        [None, [], [None, None]],
+        [[1], False],
+    ),
+    (
+        {"allOf": [{"type": "string", "pattern": "^[a-z]+\\d$"}]},
+        ["abc1", "z0"],
+        ["abc", "Abc1", "abc12"],
+    ),
+    (
+        {"type": "string", "format": "date-time"},
+        ["2024-02-29T12:30:00Z", "2024-02-29T12:30:00.5+01:00"],
+        ["2024-02-29", "2024-13-01T00:00:00Z", "2024-02-29T24:00:00Z"],
+    ),
+    (
+        {"type": "string", "format": "uuid"},
+        ["123e4567-e89b-12d3-a456-426614174000"],
+        ["123e4567e89b12d3a456426614174000", "not-a-uuid"],
+    ),
+    (
+        {"type": "string"},
+        ["", "plain", "quote \" and backslash \\", "line\nbreak", "ümlaut ✓"],
+        [1, None],
+    ),
+    (
+        {"type": "object", "additionalProperties": {"type": "integer"}},
+        [{}, {"a": 1}, {"a": 1, "b": 2}],
+        [{"a": "1"}],
+    ),
+    (
+        {"type": "object", "additionalProperties": False},
+        [{}],
+        [{"a": 1}],
+    ),
+    (
+        {"type": "object"},
+        [{}, {"a": [1, "b", None]}, {"a": {"b": True}}],
+        [[], "a"],
+    ),
+    (
+        {"$defs": {"point": {"type": "object", "properties": {"x": {"type": "integer"}, "y": {"type": "integer"}}}},
+         "type": "array", "items": {"$ref": "#/$defs/point"}},
+        [[], [{"x": 1, "y": 2}, {"x": -3, "y": 0}]],
+        [[{"x": 1}], [{"x": 1, "y": 2.5}]],
+    ),
+])
+def test_schema_regex_matches_valid_documents_only(schema, valid, invalid):
+    pattern = build_regex_from_schema(json.dumps(schema))
+
+    for document in valid:
+        for text in _dumps(document):
+            assert _matches(pattern, text), text
+    for document in invalid:
+        for text in _dumps(document):
+            assert not _matches(pattern, text), text
+
+
+def test_schema_regex_rejects_malformed_json():
+    pattern = build_regex_from_schema(PERSON)
+    document = json.dumps({"name": "Ada", "age": 36, "height": 1.65, "alive": False, "spouse": None})
+
+    assert _matches(pattern, document)
+    assert not _matches(pattern, document[:-1])
+    assert not _matches(pattern, document.replace('"Ada"', "'Ada'"))
+    assert not _matches(pattern, document.replace(", ", ",  "))
+    assert not _matches(pattern, document.replace("36", "036"))
+    assert not _matches(pattern, document + "\n")
+
+
+@pytest.mark.parametrize("schema", [
+    {"$ref": "https://example.com/schema.json"},
+    {"$ref": "#/$defs/missing"},
+    {"$defs": {"node": {"type": "object", "properties": {"next": {"$ref": "#/$defs/node"}}}}, "$ref": "#/$defs/node"},
+    {"allOf": [{"type": "string"}, {"maxLength": 2}]},
+    {"type": "date"},
+])
+def test_unsupported_schemas_are_rejected(schema):
+    with pytest.raises(ValueError):
+        build_regex_from_schema(schema)
@@ -0,0 +1,14 @@
+import torch
+from app.inference.logits_processors import create_sequence_logit_bias_processor
+
+
+def test_sequence_logit_bias_processor_biases_one_sequence():
+    processor = create_sequence_logit_bias_processor({1: 2.5, 3: -500.0, 4: 0.0})
+    logits = torch.zeros(6)
+
+    biased = processor([7, 8], logits)
+
+    # biases are clamped to OpenAI's range, and the input is left alone
+    assert biased.tolist() == [0.0, 2.5, 0.0, -100.0, 0.0, 0.0]
+    assert logits.tolist() == [0.0] * 6
+    assert processor([], torch.ones(6, dtype=torch.float16)).dtype == torch.float16
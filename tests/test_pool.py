@@ -0,0 +1,60 @@
+import pytest
+from app.inference.pool import LoadedModel, ModelPool
+
+
+@pytest.fixture
+def pool():
+    pool = ModelPool()
+    pool.memory_budget_bytes = 100
+    return pool
+
+
+def _add(pool: ModelPool, name: str, size_bytes: int, replaced=()) -> LoadedModel:
+    loaded = LoadedModel(name, None, f"{name} tokenizer", None, size_bytes)
+    pool.add(loaded, replaced)
+    return loaded
+
+
+def test_least_recently_used_models_make_room(pool):
+    _add(pool, "a", 20)
+    _add(pool, "b", 30)
+    _add(pool, "c", 30)
+    pool.acquire("a")
+
+    replaced = pool.make_room(40, keep=["c"])
+
+    assert replaced == ["b"]
+    assert pool.get_loaded_models() == ["c", "a"]
+    assert pool.make_room(50) == []
+
+
+def test_replaced_models_are_evicted_before_a_load_that_would_exceed_the_budget(pool):
+    a = _add(pool, "a", 40)
+    _add(pool, "b", 30)
+
+    replaced = pool.make_room(60)
+
+    assert replaced == ["a"]
+    assert pool.get_loaded_models() == ["b"]
+    assert a.tokenizer is None
+    assert pool.get_used_memory() + 60 <= pool.memory_budget_bytes
+    _add(pool, "c", 60, replaced)
+    assert pool.get_loaded_models() == ["b", "c"]
+
+
+def test_evicted_models_unload_once_their_requests_finish(pool):
+    a = _add(pool, "a", 40)
+    _add(pool, "b", 30)
+    pool.acquire("a")
+    pool.acquire("b")
+
+    replaced = pool.make_room(60)
+
+    # a takes no new requests, but its running one finishes first
+    assert replaced == ["a"]
+    assert pool.get_loaded_models() == ["b"]
+    assert a.tokenizer is not None
+    assert pool.get_used_memory() == 70
+    pool.release(a)
+    assert a.tokenizer is None
+    assert pool.get_used_memory() == 30
@@ -0,0 +1,92 @@
+from types import SimpleNamespace
+import pytest
+import torch
+from app.inference.prefix_cache import PrefixCache
+from app.inference.scheduler import Scheduler, Sequence
+
+
+def _past(num_tokens: int) -> tuple:
+    # one layer, 2 * num_tokens * 16 bytes
+    return ((torch.zeros((1, 1, num_tokens, 4)), torch.zeros((1, 1, num_tokens, 4))),)
+
+
+@pytest.fixture
+def cache():
+    cache = PrefixCache()
+    cache.init_config(SimpleNamespace(PREFIX_CACHE_MAX_BYTES=2 * 2 * 10 * 16))
+    return cache
+
+
+def test_longest_common_prefix_is_reused(cache):
+    cache.put("model", 1, [1, 2, 3, 4], _past(4))
+
+    num_cached, past = cache.get("model", 1, [1, 2, 3, 9, 9])
+    assert num_cached == 3
+    assert past[0][0].shape[2] == 3
+    # at least the last token is prefilled again, for its logits
+    assert cache.get("model", 1, [1, 2, 3, 4])[0] == 3
+    assert cache.get("model", 1, [9, 2, 3]) == (0, None)
+    assert cache.get("model", 2, [1, 2, 3, 4]) == (0, None)
+    assert cache.get("other", 1, [1, 2, 3, 4]) == (0, None)
+
+
+def test_sessions_keep_their_latest_turn_only(cache):
+    cache.put("model", 1, [1, 2, 3], _past(3))
+    cache.put("model", 1, [1, 2, 3, 4, 5], _past(5))
+
+    assert len(cache.cache) == 1
+    assert cache.get("model", 1, [1, 2, 3, 4, 5, 6])[0] == 5
+
+
+def test_least_recently_used_sessions_are_evicted(cache):
+    cache.put("model", 1, list(range(10)), _past(10))
+    cache.put("model", 2, list(range(10)), _past(10))
+    # session 1 was used last
+    assert cache.get("model", 1, list(range(11)))[0] == 10
+
+    cache.put("model", 3, list(range(10)), _past(10))
+
+    assert cache.get("model", 2, list(range(11))) == (0, None)
+    assert cache.get("model", 1, list(range(11)))[0] == 10
+    assert cache.get("model", 3, list(range(11)))[0] == 10
+    assert ("model", 2) not in cache._session_keys
+    # larger than the whole cache, so never kept
+    cache.put("model", 4, list(range(30)), _past(30))
+    assert cache.get("model", 4, list(range(31))) == (0, None)
+
+
+def test_cleared_models_lose_their_entries(cache):
+    cache.put("model", 1, [1, 2, 3], _past(3))
+    cache.put("other", 1, [1, 2, 3], _past(3))
+
+    cache.clear_model("model")
+
+    assert cache.get("model", 1, [1, 2, 3, 4]) == (0, None)
+    assert cache.get("other", 1, [1, 2, 3, 4])[0] == 3
+
+
+def test_next_turn_from_the_cache_generates_what_it_would_uncached(model, tokenizer):
+    scheduler = Scheduler(model, tokenizer, max_batch_size=4)
+    no_eos = {tokenizer.eos_token_id: -100.0}
+    saved = []
+    first_turn = Sequence(
+        tokenizer.encode("Hello world!", add_special_tokens=False), max_new_tokens=5, logit_bias=no_eos,
+        cache_callback=lambda token_ids, past: saved.append((token_ids, past)),
+    )
+    scheduler.submit(first_turn)
+    assert first_turn.wait(timeout=30)
+
+    token_ids, past = saved[0]
+    next_turn_ids = first_turn.input_ids + first_turn.output_ids + tokenizer.encode(" The quick", add_special_tokens=False)
+    assert next_turn_ids[:len(token_ids)] == token_ids
+    num_cached = len(token_ids)
+    cached = Sequence(
+        next_turn_ids, max_new_tokens=5, logit_bias=no_eos,
+        cached_past=tuple((k[:, :, :num_cached], v[:, :, :num_cached]) for k, v in past), num_cached_tokens=num_cached,
+    )
+    uncached = Sequence(next_turn_ids, max_new_tokens=5, logit_bias=no_eos)
+    for sequence in (cached, uncached):
+        scheduler.submit(sequence)
+        assert sequence.wait(timeout=30)
+
+    assert cached.output_ids == uncached.output_ids
@@ -0,0 +1,67 @@
+import copy
+import pytest
+import torch
+from app.inference.pool import estimate_model_dir_size, get_model_memory_size
+from app.inference.quantization import (
+    load_quantized_model, quantize_int8, resolve_load_precision, save_quantized_model
+)
+from app.inference.services import _load_model
+
+
+@pytest.fixture(scope="module")
+def model_dir(model, tokenizer, tmp_path_factory):
+    path = tmp_path_factory.mktemp("tiny-llama")
+    model.save_pretrained(path)
+    tokenizer.save_pretrained(path)
+    return str(path)
+
+
+def _next_token_logits(model, input_ids) -> torch.Tensor:
+    with torch.inference_mode():
+        return model(input_ids=torch.tensor([input_ids])).logits[0, -1].float()
+
+
+def test_bf16_models_load_in_bfloat16(model_dir, model, tokenizer):
+    _, bf16_model = _load_model(model_dir, "bf16")
+
+    assert all(parameter.dtype == torch.bfloat16 for parameter in bf16_model.parameters())
+    parameter_bytes = sum(parameter.nelement() * parameter.element_size() for parameter in bf16_model.parameters())
+    assert estimate_model_dir_size(model_dir, torch.bfloat16) == parameter_bytes
+    assert estimate_model_dir_size(model_dir) == 2 * parameter_bytes
+    assert get_model_memory_size(bf16_model) < get_model_memory_size(model)
+    input_ids = tokenizer.encode("Hello world", add_special_tokens=False)
+    assert torch.allclose(_next_token_logits(bf16_model, input_ids), _next_token_logits(model, input_ids), atol=0.1)
+
+
+def test_int8_models_are_quantized_and_cached(model_dir, model, tokenizer, tmp_path):
+    quantized_path = str(tmp_path / "int8" / "model.pt")
+    _, int8_model = _load_model(model_dir, "int8", quantized_path)
+    save_quantized_model(int8_model, quantized_path)
+
+    assert any(isinstance(module, torch.ao.nn.quantized.dynamic.Linear) for module in int8_model.modules())
+    assert get_model_memory_size(int8_model) < get_model_memory_size(model)
+    input_ids = tokenizer.encode("Hello world", add_special_tokens=False)
+    expected = _next_token_logits(model, input_ids)
+    assert torch.allclose(_next_token_logits(int8_model, input_ids), expected, atol=0.1)
+    # loaded again from the cache, without quantizing
+    _, cached_model = _load_model(model_dir, "int8", quantized_path)
+    assert torch.equal(_next_token_logits(cached_model, input_ids), _next_token_logits(int8_model, input_ids))
+
+
+def test_quantized_models_of_another_torch_version_are_not_loaded(model, tmp_path, monkeypatch):
+    quantized_path = str(tmp_path / "model.pt")
+    save_quantized_model(quantize_int8(copy.deepcopy(model)), quantized_path)
+    assert load_quantized_model(quantized_path) is not None
+
+    monkeypatch.setattr(torch, "__version__", "0.0.1")
+    assert load_quantized_model(quantized_path) is None
+    assert load_quantized_model(str(tmp_path / "missing.pt")) is None
+
+
+def test_unusable_precisions_fall_back_to_auto(monkeypatch):
+    monkeypatch.setattr("app.inference.quantization.cpu_supports_bf16", lambda: False)
+
+    assert resolve_load_precision("int8", torch.device("cpu")) == "int8"
+    assert resolve_load_precision("int8", torch.device("cuda")) == "auto"
+    assert resolve_load_precision("bf16", torch.device("cpu")) == "auto"
+    assert resolve_load_precision("fp4", torch.device("cpu")) == "auto"
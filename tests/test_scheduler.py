@@ -0,0 +1,192 @@
+from types import SimpleNamespace
+from app.inference.compiled_decoding import CompiledDecoder, is_transformers_supported
+from app.inference.executor import InferenceExecutor
+from app.inference.scheduler import Scheduler, Sequence
+
+
+def test_max_new_tokens_zero_scores_the_prompt_only(model, tokenizer):
+    scheduler = Scheduler(model, tokenizer, max_batch_size=4)
+    input_ids = tokenizer.encode("Hello world", add_special_tokens=False)
+    scoring = Sequence(input_ids, max_new_tokens=0, logprobs=2, prompt_logprobs=2)
+    # never stops early on EOS
+    generating = Sequence(input_ids, max_new_tokens=3, logit_bias={tokenizer.eos_token_id: -100.0})
+
+    scheduler.submit_all([scoring, generating])
+    assert scoring.wait(timeout=30) and generating.wait(timeout=30)
+
+    assert scoring.finish_reason == "length"
+    assert scoring.output_ids == []
+    assert scoring.output_logprobs == []
+    assert len(scoring.prompt_logprobs) == len(input_ids)
+    # the other sequence of the batch still generates
+    assert len(generating.output_ids) == 3
+
+
+def _greedy(tokenizer, prompt: str, max_new_tokens: int) -> Sequence:
+    return Sequence(
+        tokenizer.encode(prompt, add_special_tokens=False), max_new_tokens=max_new_tokens,
+        logit_bias={tokenizer.eos_token_id: -100.0},
+    )
+
+
+def test_batched_sequences_generate_what_they_would_alone(model, tokenizer):
+    prompts = [("Hello world", 6), ("The quick brown fox", 2), ("A", 9), ("lazy dog. Hello", 4), ("jumps", 1)]
+    alone = []
+    for prompt, max_new_tokens in prompts:
+        sequence = _greedy(tokenizer, prompt, max_new_tokens)
+        Scheduler(model, tokenizer, max_batch_size=1).submit(sequence)
+        assert sequence.wait(timeout=30)
+        alone.append(sequence.output_ids)
+
+    scheduler = Scheduler(model, tokenizer, max_batch_size=2)
+    batch_sizes = []
+    decode_step = scheduler._decode_step
+
+    def record_decode_step():
+        batch_sizes.append(len(scheduler._batch))
+        decode_step()
+
+    scheduler._decode_step = record_decode_step
+    sequences = [_greedy(tokenizer, prompt, max_new_tokens) for prompt, max_new_tokens in prompts]
+    scheduler.submit_all(sequences)
+    assert all(sequence.wait(timeout=30) for sequence in sequences)
+
+    assert [sequence.output_ids for sequence in sequences] == alone
+    assert all(sequence.finish_reason == "length" for sequence in sequences)
+    # finished sequences leave the batch, and waiting ones take their slot
+    assert max(batch_sizes) == 2
+    assert len(batch_sizes) < sum(max_new_tokens for _, max_new_tokens in prompts)
+    assert scheduler.num_running == 0
+
+
+def test_cancelled_sequences_leave_the_batch(model, tokenizer):
+    scheduler = Scheduler(model, tokenizer, max_batch_size=4)
+    cancelled = _greedy(tokenizer, "Hello", 400)
+    running = _greedy(tokenizer, "world", 20)
+    cancelled.add_start_callback(lambda sequence: sequence.cancel())
+
+    scheduler.submit_all([cancelled, running])
+    assert cancelled.wait(timeout=30) and running.wait(timeout=30)
+
+    assert cancelled.finish_reason == "cancelled"
+    assert len(cancelled.output_ids) < 400
+    assert running.finish_reason == "length"
+    assert len(running.output_ids) == 20
+
+
+def test_forks_share_one_prefill(model, tokenizer):
+    input_ids = tokenizer.encode("The quick brown fox", add_special_tokens=False)
+    no_eos = {tokenizer.eos_token_id: -100.0}
+    scheduler = Scheduler(model, tokenizer, max_batch_size=4)
+    prefilled = []
+    forward_prompts = scheduler._forward_prompts
+
+    def record_forward_prompts(sequences):
+        prefilled.append(len(sequences))
+        return forward_prompts(sequences)
+
+    scheduler._forward_prompts = record_forward_prompts
+    group = object()
+    forks = [
+        Sequence(input_ids, max_new_tokens=8, do_sample=True, seed=seed, prefill_group=group, logit_bias=no_eos, prompt_logprobs=1)
+        for seed in range(3)
+    ]
+    scheduler.submit_all(forks)
+    assert all(fork.wait(timeout=30) for fork in forks)
+
+    assert prefilled == [1]
+    assert all(fork.prompt_logprobs == forks[0].prompt_logprobs for fork in forks)
+    assert len({tuple(fork.output_ids) for fork in forks}) == 3
+    # every fork continues from the shared prefill as it would from its own
+    for seed, fork in enumerate(forks):
+        alone = Sequence(input_ids, max_new_tokens=8, do_sample=True, seed=seed, logit_bias=no_eos)
+        scheduler.submit(alone)
+        assert alone.wait(timeout=30)
+        assert alone.output_ids == fork.output_ids
+
+
+def test_chunked_prefill_generates_what_one_prefill_would(model, tokenizer):
+    input_ids = tokenizer.encode("The quick brown fox jumps over the lazy dog. " * 4, add_special_tokens=False)
+    no_eos = {tokenizer.eos_token_id: -100.0}
+    outputs = []
+    for prefill_chunk_size in (None, 8):
+        scheduler = Scheduler(model, tokenizer, max_batch_size=4, prefill_chunk_size=prefill_chunk_size)
+        sequence = Sequence(input_ids, max_new_tokens=6, logit_bias=no_eos, prompt_logprobs=1)
+        scheduler.submit(sequence)
+        assert sequence.wait(timeout=30)
+        outputs.append(sequence)
+
+    assert outputs[1].output_ids == outputs[0].output_ids
+    assert len(outputs[1].prompt_logprobs) == len(input_ids)
+    for chunked, whole in zip(outputs[1].prompt_logprobs[1:], outputs[0].prompt_logprobs[1:]):
+        assert chunked.token_id == whole.token_id
+        assert abs(chunked.logprob - whole.logprob) < 1e-4
+
+
+def test_running_sequences_decode_between_prefill_chunks(model, tokenizer):
+    scheduler = Scheduler(model, tokenizer, max_batch_size=4, prefill_chunk_size=8)
+    running = _greedy(tokenizer, "Hello", 200)
+    long_prompt = Sequence(
+        tokenizer.encode("The quick brown fox jumps over the lazy dog. " * 4, add_special_tokens=False), max_new_tokens=1,
+    )
+    num_decoded_per_chunk = []
+    prefill_chunk = scheduler._prefill_chunk
+
+    def record_prefill_chunk():
+        num_decoded_per_chunk.append(len(running.output_ids))
+        prefill_chunk()
+
+    scheduler._prefill_chunk = record_prefill_chunk
+    running.add_start_callback(lambda _: scheduler.submit(long_prompt))
+    scheduler.submit(running)
+    assert long_prompt.wait(timeout=30)
+    running.cancel()
+    assert running.wait(timeout=30)
+
+    assert len(num_decoded_per_chunk) >= len(long_prompt.input_ids) // 8
+    # one decode step of the running sequence after every chunk
+    assert all(later == earlier + 1 for earlier, later in zip(num_decoded_per_chunk, num_decoded_per_chunk[1:]))
+
+
+def test_decode_loop_leaves_the_executor_free(model, tokenizer):
+    executor = InferenceExecutor()
+    executor.init_config(SimpleNamespace(INFERENCE_MAX_WORKERS=1))
+    scheduler = Scheduler(model, tokenizer, max_batch_size=4)
+    sequence = Sequence(
+        tokenizer.encode("Hello", add_special_tokens=False), max_new_tokens=400,
+        logit_bias={tokenizer.eos_token_id: -100.0},
+    )
+
+    scheduler.submit(sequence)
+    # the executor's only worker still runs short tasks while the model decodes
+    assert executor.submit(tokenizer.encode, "world").result(timeout=10)
+    assert not sequence.is_finished
+    sequence.cancel()
+    assert sequence.wait(timeout=30)
+
+
+def test_compiled_decoding_matches_eager_decoding(model, tokenizer):
+    compiled_decoder = CompiledDecoder(model, max_batch_size=4, max_context=64)
+    compiled_decoder.warm_up()
+    prompts = ["Hello world", "The quick brown fox", "A"]
+    outputs = []
+    for decoder in (None, compiled_decoder):
+        scheduler = Scheduler(model, tokenizer, max_batch_size=4, compiled_decoder=decoder)
+        sequences = [
+            Sequence(
+                tokenizer.encode(prompt, add_special_tokens=False), max_new_tokens=12,
+                logit_bias={tokenizer.eos_token_id: -100.0},
+            )
+            for prompt in prompts
+        ]
+        scheduler.submit_all(sequences)
+        assert all(sequence.wait(timeout=120) for sequence in sequences)
+        outputs.append([sequence.output_ids for sequence in sequences])
+
+    assert outputs[0] == outputs[1]
+
+
+def test_compiled_decoding_needs_a_supported_transformers_version():
+    assert is_transformers_supported("4.38.2")
+    assert not is_transformers_supported("4.39.0")
+    assert not is_transformers_supported("4.37.2")
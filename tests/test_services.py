@@ -0,0 +1,130 @@
+import asyncio
+import time
+import pytest
+from app.inference.admission import DeadlineExceeded
+from app.inference.budget import TokenBudget
+from app.inference.engine import GenerationFailed
+from app.inference.models import CompletionRequest
+from app.inference.pool import model_pool
+from app.inference.response_cache import response_cache
+from app.inference.services import create_completion
+
+
+@pytest.mark.parametrize("n, best_of", [(5, None), (1, 5), (100, 1000)])
+def test_n_and_best_of_above_the_cap_are_rejected(monkeypatch, n, best_of):
+    monkeypatch.setattr(model_pool, "max_best_of", 4)
+    request = CompletionRequest(model="test/tiny-llama", prompt="Hello", n=n, best_of=best_of)
+
+    with pytest.raises(ValueError, match="at most 4"):
+        asyncio.run(create_completion(request))
+
+
+@pytest.fixture
+def cache_enabled(monkeypatch):
+    class Config:
+        RESPONSE_CACHE_MAX_BYTES = 1024 * 1024
+        RESPONSE_CACHE_TTL = 60
+
+    monkeypatch.setattr(response_cache, "cache", None)
+    response_cache.init_config(Config)
+
+
+def _no_eos(loaded_model) -> dict:
+    return {str(loaded_model.tokenizer.eos_token_id): -100.0}
+
+
+def test_sampled_choices_are_not_cached(loaded_model, cache_enabled):
+    num_hits, num_coalesced = response_cache.num_hits, response_cache.num_coalesced
+    # n > 1 samples every choice, even at the default temperature
+    request = CompletionRequest(model=loaded_model.name, prompt="Hello", n=3, max_tokens=4)
+
+    async def run_identical_requests():
+        await asyncio.gather(create_completion(request), create_completion(request))
+        await create_completion(request)
+
+    asyncio.run(run_identical_requests())
+
+    assert response_cache.num_hits == num_hits
+    assert response_cache.num_coalesced == num_coalesced
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_prompts_not_prefilled_before_the_deadline_fail(loaded_model, stream):
+    request = CompletionRequest(model=loaded_model.name, prompt=["Hello", "world"], max_tokens=4, stream=stream)
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(create_completion(request, deadline=time.monotonic()))
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_failed_prefills_raise(loaded_model, monkeypatch, stream):
+    def fail(sequences):
+        raise RuntimeError("out of memory")
+
+    monkeypatch.setattr(loaded_model.engine, "_prefill", fail)
+    request = CompletionRequest(model=loaded_model.name, prompt="Hello", max_tokens=4, stream=stream)
+
+    with pytest.raises(GenerationFailed):
+        asyncio.run(create_completion(request))
+
+
+def test_cached_results_are_charged_to_the_budget(loaded_model, cache_enabled):
+    request = CompletionRequest(
+        model=loaded_model.name, prompt="Hello", max_tokens=4, temperature=0, logit_bias=_no_eos(loaded_model)
+    )
+    _, _, num_input_tokens, num_output_tokens = asyncio.run(create_completion(request))
+    num_hits = response_cache.num_hits
+
+    budget = TokenBudget(100)
+    asyncio.run(create_completion(request, budget))
+    assert response_cache.num_hits == num_hits + 1
+    assert budget.num_tokens == 100 - num_input_tokens - num_output_tokens
+
+    # a session that can't pay for the cached result doesn't get it either
+    with pytest.raises(ValueError, match="cost limit"):
+        asyncio.run(create_completion(request, TokenBudget(num_input_tokens)))
+    with pytest.raises(ValueError, match="cost limit"):
+        asyncio.run(create_completion(request, TokenBudget(0)))
+
+
+def test_greedy_choices_are_generated_once(loaded_model):
+    request = CompletionRequest(
+        model=loaded_model.name, prompt="Hello", n=3, max_tokens=4, temperature=0, logit_bias=_no_eos(loaded_model)
+    )
+    choices, _, _, num_output_tokens = asyncio.run(create_completion(request))
+
+    assert len(choices) == 3
+    assert len({choice.text for choice in choices}) == 1
+    assert num_output_tokens == 4
+
+
+def test_greedy_choices_are_streamed_from_one_generation(loaded_model):
+    request = CompletionRequest(
+        model=loaded_model.name, prompt="Hello", n=3, max_tokens=4, temperature=0,
+        logit_bias=_no_eos(loaded_model), stream=True,
+    )
+
+    async def read_stream():
+        stream_group, *_ = await create_completion(request)
+        return [delta async for delta in stream_group]
+
+    deltas = asyncio.run(read_stream())
+    texts = ["".join(delta.text for delta in deltas if delta.index == index) for index in range(3)]
+    assert texts[0] and len(set(texts)) == 1
+    assert sum(len(delta.token_ids) for delta in deltas) == 4
+
+
+def test_choices_of_every_prompt_are_returned_in_order(loaded_model):
+    request = CompletionRequest(
+        model=loaded_model.name, prompt=["Hello", "The quick brown fox"], n=2, best_of=3, max_tokens=4, seed=0, temperature=1.0,
+        logit_bias=_no_eos(loaded_model), logprobs=0,
+    )
+    choices, _, num_input_tokens, num_output_tokens = asyncio.run(create_completion(request))
+
+    assert len(choices) == 4
+    # best_of candidates are generated, and billed, even if not returned
+    assert num_output_tokens == 2 * 3 * 4
+    # the best candidates come first, ranked by the logprobs of their tokens
+    for prompt in range(2):
+        scores = [sum(logprob.logprob for logprob in choice.logprobs) for choice in choices[prompt * 2:prompt * 2 + 2]]
+        assert scores == sorted(scores, reverse=True)
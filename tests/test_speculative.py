@@ -0,0 +1,64 @@
+import pytest
+from app.inference.scheduler import Scheduler, Sequence
+from app.inference.speculative import SpeculativeDecoder, create_vocab_translation
+
+
+def _generate(scheduler, tokenizer, max_new_tokens: int = 24, **sequence_params):
+    sequence = Sequence(
+        tokenizer.encode("The quick brown fox", add_special_tokens=False), max_new_tokens=max_new_tokens,
+        # never stops early on EOS
+        logit_bias={tokenizer.eos_token_id: -100.0}, **sequence_params,
+    )
+    scheduler.submit(sequence)
+    assert sequence.wait(timeout=60)
+    return sequence
+
+
+def test_draft_of_the_target_itself_is_always_accepted(model, tokenizer):
+    decoder = SpeculativeDecoder("target", model, num_speculative_tokens=4)
+    speculative = _generate(Scheduler(model, tokenizer, speculative_decoder=decoder), tokenizer)
+    plain = _generate(Scheduler(model, tokenizer), tokenizer)
+
+    assert speculative.output_ids == plain.output_ids
+    assert decoder.num_draft_tokens > 0
+    assert decoder.acceptance_rate == 1.0
+
+
+def test_greedy_speculation_matches_the_target(model, tokenizer, draft_model, draft_tokenizer):
+    translation = create_vocab_translation(model, tokenizer, draft_model, draft_tokenizer)
+    decoder = SpeculativeDecoder("draft", draft_model, num_speculative_tokens=4, translation=translation)
+    speculative = _generate(Scheduler(model, tokenizer, speculative_decoder=decoder), tokenizer)
+    plain = _generate(Scheduler(model, tokenizer), tokenizer)
+
+    assert speculative.output_ids == plain.output_ids
+    assert decoder.num_draft_tokens > 0
+
+
+def test_seeded_speculation_stays_in_the_target_vocabulary(model, tokenizer, draft_model, draft_tokenizer):
+    translation = create_vocab_translation(model, tokenizer, draft_model, draft_tokenizer)
+    decoder = SpeculativeDecoder("draft", draft_model, num_speculative_tokens=4, translation=translation)
+    sequence = _generate(
+        Scheduler(model, tokenizer, speculative_decoder=decoder), tokenizer, do_sample=True, seed=0
+    )
+
+    assert len(sequence.output_ids) == 24
+    assert all(0 <= token_id < model.config.vocab_size for token_id in sequence.output_ids)
+    assert decoder.num_draft_tokens > 0
+
+
+def test_vocab_translation_maps_shared_tokens(model, tokenizer, draft_model, draft_tokenizer):
+    assert create_vocab_translation(model, tokenizer, model, tokenizer) is None
+    translation = create_vocab_translation(model, tokenizer, draft_model, draft_tokenizer)
+    vocab, draft_vocab = tokenizer.get_vocab(), draft_tokenizer.get_vocab()
+
+    assert translation.num_shared_tokens == len(vocab.keys() & draft_vocab.keys())
+    # the special tokens are at other ids in the draft's vocabulary
+    assert translation.to_draft_ids([tokenizer.eos_token_id]) == [draft_tokenizer.eos_token_id]
+    assert tokenizer.eos_token_id != draft_tokenizer.eos_token_id
+
+
+def test_draft_sharing_too_little_vocabulary_is_rejected(model, tokenizer, draft_model, draft_tokenizer, monkeypatch):
+    monkeypatch.setattr(draft_tokenizer, "get_vocab", lambda: {"<unk>": 0})
+
+    with pytest.raises(ValueError, match="draft's vocabulary"):
+        create_vocab_translation(model, tokenizer, draft_model, draft_tokenizer)
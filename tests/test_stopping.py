@@ -0,0 +1,103 @@
+import asyncio
+import torch
+from app.inference.models import CompletionRequest
+from app.inference.scheduler import Scheduler, Sequence
+from app.inference.services import create_completion
+from app.inference.stopping import StopStringChecker, get_partial_stop_length, truncate_at_stop
+from app.inference.streaming import AsyncTextStreamer
+
+
+def test_multi_byte_stop_string_split_across_tokens(tokenizer):
+    stop = "你好"
+    output_ids = tokenizer.encode("Hello 你好 world", add_special_tokens=False)
+    # every character of the stop string takes several tokens
+    assert len(tokenizer.encode(stop, add_special_tokens=False)) > len(stop)
+
+    checker = StopStringChecker([stop])
+    stopped = [checker.is_stopped(tokenizer, output_ids[:i]) for i in range(1, len(output_ids) + 1)]
+
+    first_stop = stopped.index(True) + 1
+    assert tokenizer.decode(output_ids[:first_stop]).endswith(stop)
+    assert not tokenizer.decode(output_ids[:first_stop - 1]).endswith(stop)
+
+
+def test_stop_string_helpers():
+    assert truncate_at_stop("a fox and a dog", ["dog", "fox"]) == "a "
+    assert truncate_at_stop("a fox", ["fox"], start=3) == "a fox"
+    assert truncate_at_stop("a fox", ["cat"]) == "a fox"
+    assert get_partial_stop_length("the fo", ["fox"]) == 2
+    assert get_partial_stop_length("the f", ["fox", "the fix"]) == 5
+    assert get_partial_stop_length("the", ["fox"]) == 0
+
+
+def _greedy(tokenizer, max_new_tokens: int, **kwargs) -> Sequence:
+    return Sequence(
+        tokenizer.encode("The quick brown fox", add_special_tokens=False), max_new_tokens=max_new_tokens,
+        logit_bias={tokenizer.eos_token_id: -100.0}, **kwargs
+    )
+
+
+def _printable_token_index(tokenizer, output_ids) -> int:
+    # the random model mostly generates stray bytes, stop on a word instead
+    return next(
+        i for i, token_id in enumerate(output_ids) if i > 0 and tokenizer.decode([token_id]).strip().isalpha()
+    )
+
+
+def test_generation_halts_at_stop_strings_and_stop_token_ids(model, tokenizer):
+    scheduler = Scheduler(model, tokenizer, max_batch_size=4)
+    unstopped = _greedy(tokenizer, 16)
+    scheduler.submit(unstopped)
+    assert unstopped.wait(timeout=30)
+    text = tokenizer.decode(unstopped.output_ids)
+    index = _printable_token_index(tokenizer, unstopped.output_ids)
+    stop = tokenizer.decode([unstopped.output_ids[index]]).strip()
+
+    by_string = _greedy(tokenizer, 16, stop=[stop])
+    by_token = _greedy(tokenizer, 16, stop_token_ids=[unstopped.output_ids[index]])
+    scheduler.submit_all([by_string, by_token])
+    assert by_string.wait(timeout=30) and by_token.wait(timeout=30)
+
+    assert by_string.finish_reason == "stop"
+    assert len(by_string.output_ids) <= index + 1
+    assert stop in tokenizer.decode(by_string.output_ids)
+    assert text.startswith(tokenizer.decode(by_string.output_ids))
+    assert by_token.finish_reason == "stop"
+    assert by_token.output_ids == unstopped.output_ids[:unstopped.output_ids.index(unstopped.output_ids[index]) + 1]
+
+
+def test_stop_strings_are_never_streamed(tokenizer):
+    prompt_ids = tokenizer.encode("The", add_special_tokens=False)
+    output_ids = tokenizer.encode(" quick brown fox jumps", add_special_tokens=False)
+
+    async def stream(stop):
+        streamer = AsyncTextStreamer(tokenizer, skip_prompt=True, stop=stop)
+        streamer.put(torch.tensor(prompt_ids))
+        for token_id in output_ids:
+            streamer.put(torch.tensor([token_id]))
+        streamer.end("stop")
+        return [delta.text async for delta in streamer]
+
+    texts = asyncio.run(stream(["fox"]))
+    assert "".join(texts) == " quick brown "
+    assert not any("f" in text for text in texts)
+    # text held back for a stop string that never completes comes out in the end
+    assert "".join(asyncio.run(stream(["jumps!"]))) == " quick brown fox jumps"
+
+
+def test_completions_leave_out_the_stop_string(loaded_model):
+    tokenizer = loaded_model.tokenizer
+    request = CompletionRequest(
+        model=loaded_model.name, prompt="The quick brown fox", max_tokens=16, temperature=0,
+        logit_bias={str(tokenizer.eos_token_id): -100.0},
+    )
+    choices, *_ = asyncio.run(create_completion(request))
+    text = choices[0].text
+    output_ids = tokenizer.encode(text, add_special_tokens=False)
+    stop = tokenizer.decode([output_ids[_printable_token_index(tokenizer, output_ids)]]).strip()
+
+    stopped, *_ = asyncio.run(create_completion(request.model_copy(update={"stop": stop})))
+
+    assert stopped[0].text == truncate_at_stop(text, [stop])
+    assert len(stopped[0].text) < len(text)
+    assert stopped[0].finish_reason == "stop"
@@ -0,0 +1,49 @@
+import asyncio
+import torch
+from app.inference.models import CompletionRequest
+from app.inference.services import create_completion
+from app.inference.streaming import AsyncTextStreamer
+
+
+def _stream(tokenizer, prompt_ids, output_ids, **kwargs) -> list:
+    async def run():
+        streamer = AsyncTextStreamer(tokenizer, **kwargs)
+        streamer.put(torch.tensor(prompt_ids))
+        for token_id in output_ids:
+            streamer.put(torch.tensor([token_id]))
+        streamer.end("length")
+        return [delta async for delta in streamer]
+
+    return asyncio.run(run())
+
+
+def test_deltas_carry_the_generated_token_ids(tokenizer):
+    prompt_ids = tokenizer.encode("Hello", add_special_tokens=False)
+    # multi-byte characters take several tokens, and re-encoding the
+    # streamed text wouldn't give back the same ids
+    output_ids = tokenizer.encode(" wörld 你好 fox", add_special_tokens=False)
+
+    deltas = _stream(tokenizer, prompt_ids, output_ids, skip_prompt=False)
+
+    # the echoed prompt is text only, it isn't counted as output
+    assert deltas[0].text == "Hello" and deltas[0].token_ids == []
+    assert [token_id for delta in deltas for token_id in delta.token_ids] == output_ids
+    assert "".join(delta.text for delta in deltas) == tokenizer.decode(prompt_ids + output_ids)
+    assert deltas[-1].finish_reason == "length"
+
+
+def test_streamed_usage_matches_the_generated_tokens(loaded_model):
+    no_eos = {str(loaded_model.tokenizer.eos_token_id): -100.0}
+    request = CompletionRequest(
+        model=loaded_model.name, prompt="Hello wörld", max_tokens=7, temperature=0, logit_bias=no_eos, echo=True,
+    )
+    choices, _, _, num_output_tokens = asyncio.run(create_completion(request))
+
+    async def read_stream():
+        stream_group, *_ = await create_completion(request.model_copy(update={"stream": True}))
+        return [delta async for delta in stream_group]
+
+    deltas = asyncio.run(read_stream())
+    assert num_output_tokens == 7
+    assert sum(len(delta.token_ids) for delta in deltas) == num_output_tokens
+    assert "".join(delta.text for delta in deltas) == choices[0].text
@@ -0,0 +1,81 @@
+from threading import Thread
+import asyncio
+import multiprocessing
+import pytest
+from app.inference.models import CompletionRequest
+from app.inference.workers import _serve
+
+
+@pytest.fixture
+def worker_conn(loaded_model):
+    """
+    The server's end of a pipe to a worker's request loop, which runs in
+    this process on the loaded model.
+    """
+    conn, worker_conn = multiprocessing.Pipe()
+    thread = Thread(target=asyncio.run, args=(_serve(worker_conn),), daemon=True)
+    thread.start()
+    yield conn
+    conn.close()
+    thread.join(timeout=10)
+
+
+def _send(conn, request_id: int, prompt="Hello", **params):
+    request = CompletionRequest(model="test/tiny-llama", prompt=prompt, **params)
+    conn.send(("completion", request_id, request.model_dump(), None, None, None))
+
+
+def _replies(conn, request_id: int) -> list:
+    replies = []
+    while True:
+        assert conn.poll(timeout=60)
+        message = conn.recv()
+        if message[0] == "status" or message[1] != request_id:
+            continue
+        replies.append(message)
+        if message[0] in ("result", "end", "error"):
+            return replies
+
+
+def _no_eos(loaded_model) -> dict:
+    return {str(loaded_model.tokenizer.eos_token_id): -100.0}
+
+
+def test_streamed_request_starts_and_ends(worker_conn, loaded_model):
+    _send(worker_conn, 1, max_tokens=4, stream=True, logit_bias=_no_eos(loaded_model))
+    replies = _replies(worker_conn, 1)
+
+    assert replies[0][0] == "start"
+    assert replies[-1][0] == "end"
+    deltas = [reply for reply in replies if reply[0] == "delta"]
+    assert sum(len(delta[3]) for delta in deltas) == 4
+    assert deltas[-1][5] == "length"
+
+
+def test_request_returns_its_result(worker_conn, loaded_model):
+    _send(worker_conn, 1, max_tokens=4, logit_bias=_no_eos(loaded_model))
+    (reply,) = _replies(worker_conn, 1)
+
+    assert reply[0] == "result"
+    _, _, choices, num_input_tokens, num_output_tokens = reply
+    assert len(choices) == 1 and choices[0].finish_reason == "length"
+    assert num_output_tokens == 4
+
+
+def test_invalid_request_is_a_value_error(worker_conn, loaded_model):
+    _send(worker_conn, 1, prompt=[[]])
+    (reply,) = _replies(worker_conn, 1)
+
+    assert reply[:3] == ("error", 1, "value")
+
+
+def test_cancel_before_the_stream_starts_stops_generation(worker_conn, loaded_model):
+    _send(worker_conn, 1, max_tokens=400, stream=True, logit_bias=_no_eos(loaded_model))
+    worker_conn.send(("cancel", 1))
+    replies = _replies(worker_conn, 1)
+
+    if replies[-1][0] == "error":
+        assert replies[-1][2] == "cancelled"
+    else:
+        # it got as far as its stream, which was cancelled straight away
+        assert sum(len(reply[3]) for reply in replies if reply[0] == "delta") < 400